@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+----------
+Times the hot paths of the pipeline on synthetic data of a given size
+(see :mod:`src.data.synthetic`) and compares them to a stored baseline::
+
+    python benchmarks/run_benchmarks.py --size medium --save-baseline
+    python benchmarks/run_benchmarks.py --size medium --threshold 0.2
+
+Every run is stored as ``reports/benchmarks/<size>-<timestamp>.json``; the
+baselines are committed as ``benchmarks/baselines/<size>.json`` so every
+checkout compares against the same numbers. A benchmark regresses when its
+best time exceeds the baseline's by more than ``threshold``. Benchmarks
+whose dependencies are missing are reported as skipped; one that raises is
+reported as failed and the others still run. The script exits with status
+1 if any benchmark regressed or failed. spaCy benchmarks use a blank
+English pipeline, so ``en_core_web_lg`` is not needed.
+"""
+import collections
+import datetime
+import importlib
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+if str(PROJECT_DIR) not in sys.path:
+    sys.path.insert(0, str(PROJECT_DIR))
+
+from src.data import synthetic  # noqa: E402
+
+RESULTS_DIR = PROJECT_DIR / "reports" / "benchmarks"
+BASELINES_DIR = PROJECT_DIR / "benchmarks" / "baselines"
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, requires=()):
+    """
+    Register a benchmark. The decorated function receives a work directory
+    (holding ``dataset.json`` and ``cermxml/``) and the size, does its setup
+    and returns a callable that runs the timed work and returns the number
+    of items it processed.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, requires)
+        return func
+    return decorator
+
+
+def _blank_nlp():
+    import spacy
+    return spacy.blank("en")
+
+
+def _add_component(nlp, component, name):
+    """ Append a component object to `nlp`, on spaCy 2 or 3 """
+    import spacy
+    if spacy.__version__.split(".")[0] == "2":
+        nlp.add_pipe(component, name=name)
+        return
+    from spacy.language import Language
+    Language.component(name, func=component)
+    nlp.add_pipe(name)
+
+
+def _texts(workdir):
+    with open(os.path.join(workdir, "dataset.json")) as f:
+        return [json.loads(line)["text"] for line in f]
+
+
+@benchmark("make_dataset.extract_info", requires=("bs4", "lxml", "ftfy"))
+def bench_extract_info(workdir, size):
+    from src.data.make_dataset import extract_info
+    xml_dir = os.path.join(workdir, "cermxml")
+    paths = [os.path.join(xml_dir, f) for f in sorted(os.listdir(xml_dir))]
+
+    def run():
+        return sum(1 for path in paths for _ in extract_info(path))
+    return run
+
+
+@benchmark("Normalizer.records", requires=("ftfy",))
+def bench_normalize(workdir, size):
+    from src.data.normalize import Normalizer
+    normalizer = Normalizer()
+    texts = _texts(workdir)
+
+    def run():
+        records = ({"text": text} for text in texts)
+        return sum(1 for _ in normalizer.records(records))
+    return run
+
+
+@benchmark("QualityFilter.records")
+def bench_quality(workdir, size):
+    from src.data.quality import QualityFilter
+    from src.data.records import read_dataset
+    records = list(read_dataset(os.path.join(workdir, "dataset.json")))
+
+    def run():
+        return sum(1 for _ in QualityFilter().records(records))
+    return run
+
+
+@benchmark("Chunker.chunks + length_batches")
+def bench_chunking(workdir, size):
+    from src.data.chunking import Chunker, length_batches
+    from src.data.records import read_dataset
+    records = list(read_dataset(os.path.join(workdir, "dataset.json")))
+    chunker = Chunker()
+
+    def run():
+        return sum(len(batch) for batch in
+                   length_batches(chunker.chunks(records)))
+    return run
+
+
+def _dataset(workdir):
+    from src.data.blockchain_dataset import BlockchainPapersDataset
+    return BlockchainPapersDataset(
+        data_dir=workdir, docs_filename=os.path.join(workdir, "docs.yml"))
+
+
+@benchmark("BlockchainPapersDataset.__iter__", requires=("textacy",))
+def bench_dataset_iter(workdir, size):
+    bpd = _dataset(workdir)
+
+    def run():
+        return sum(1 for _ in bpd)
+    return run
+
+
+@benchmark("BlockchainPapersDataset.records(filters)", requires=("textacy",))
+def bench_dataset_filter(workdir, size):
+    bpd = _dataset(workdir)
+
+    def run():
+        return sum(1 for _ in bpd.records(
+            institution={"European Central Bank", "Bank of England"},
+            min_len=200))
+    return run
+
+
+_recognizer = {}
+
+
+@benchmark("FinancialEntityRecognizer", requires=("spacy",))
+def bench_entity_recognizer(workdir, size):
+    from src.features.entities import FinancialEntityRecognizer
+    # the recognizer registers Doc/Span/Token extensions, which spaCy only
+    # allows once per process
+    if "nlp" not in _recognizer:
+        nlp = _blank_nlp()
+        _add_component(nlp, FinancialEntityRecognizer(nlp),
+                       FinancialEntityRecognizer.name)
+        _recognizer["nlp"] = nlp
+    nlp = _recognizer["nlp"]
+    texts = _texts(workdir)
+
+    def run():
+        return sum(1 for _ in nlp.pipe(texts))
+    return run
+
+
+@benchmark("make_corpus.create_corpus (blank)", requires=("spacy", "textacy"))
+def bench_create_corpus(workdir, size):
+    from src.data.make_corpus import create_corpus, prepare_lang
+    nlp = prepare_lang(_blank_nlp())
+    bpd = _dataset(workdir)
+
+    def run():
+        return len(create_corpus(lang=nlp, dataset=bpd))
+    return run
+
+
+@benchmark("SearchIndex.build")
+def bench_search_build(workdir, size):
+    from src.features.search_index import SearchIndex
+    dataset = os.path.join(workdir, "dataset.json")
+    path = os.path.join(workdir, "search_index")
+
+    def run():
+        index = SearchIndex.build(dataset, path)
+        n = len(index)
+        index.close()
+        return n
+    return run
+
+
+@benchmark("SearchIndex.search")
+def bench_search_query(workdir, size):
+    from src.features.search_index import SearchIndex
+    path = os.path.join(workdir, "search_index_q")
+    index = SearchIndex.build(os.path.join(workdir, "dataset.json"), path)
+    queries = ["scriptless bond", "atomic settlement", "central bank digital",
+               "consensus nodes validation", "delivery versus payment"]
+
+    def run():
+        for query in queries:
+            index.search(query, institution="European Central Bank")
+            index.search(query)
+        return 2 * len(queries)
+    return run
+
+
+@benchmark("CooccurrenceGraph.update", requires=("spacy",))
+def bench_cooccurrence(workdir, size):
+    from src.features.cooccurrence import CooccurrenceGraph
+    from src.data.records import read_dataset
+    dataset = os.path.join(workdir, "dataset.json")
+    nlp = _blank_nlp()
+
+    def run():
+        graph = CooccurrenceGraph(nlp=nlp)
+        graph.update(read_dataset(dataset))
+        return sum(c.paragraphs for c in graph.documents.values())
+    return run
+
+
+@benchmark("TermStatistics.update (tokens, n-grams)")
+def bench_sketches(workdir, size):
+    from src.data.records import read_dataset
+    from src.features.sketches import TermStatistics
+    records = list(read_dataset(os.path.join(workdir, "dataset.json")))
+
+    def run():
+        stats = TermStatistics(entities=False)
+        stats.update(records)
+        return len(records)
+    return run
+
+
+def missing_requirements(requires):
+    missing = []
+    for module in requires:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            missing.append(module)
+    return missing
+
+
+def run_benchmarks(size="small", repeat=5, selected=None, seed=0):
+    """
+    Generate data of `size` and time every (or every `selected`) benchmark.
+
+    Returns:
+        Dict[str, dict]: per benchmark ``min``/``median`` seconds, ``items``
+        and ``items_per_s``; or ``skipped`` with the reason, or ``failed``
+        with the error it raised.
+    """
+    logger = logging.getLogger(__name__)
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as workdir:
+        synthetic.write_dataset(os.path.join(workdir, "dataset.json"),
+                                size, seed)
+        synthetic.write_cermxml(os.path.join(workdir, "cermxml"), size, seed)
+        for name, (func, requires) in BENCHMARKS.items():
+            if selected and name not in selected:
+                continue
+            missing = missing_requirements(requires)
+            if missing:
+                results[name] = {"skipped": "missing " + ", ".join(missing)}
+                logger.warning("skipping %s: %s", name,
+                               results[name]["skipped"])
+                continue
+            try:
+                run = func(workdir, size)
+                run()  # warm up caches, lazy imports, lexemes
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    items = run()
+                    timings.append(time.perf_counter() - start)
+            except Exception as e:
+                results[name] = {"failed": "{}: {}".format(
+                    type(e).__name__, e)}
+                logger.exception("%s failed", name)
+                continue
+            best = min(timings)
+            results[name] = {
+                "min": best,
+                "median": statistics.median(timings),
+                "items": items,
+                "items_per_s": items / best if best else None,
+            }
+            logger.info("%-45s %9.4f s  %10.1f items/s", name, best,
+                        results[name]["items_per_s"] or 0)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ List of ``(name, baseline s, current s)`` slower than allowed """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {})
+        if "min" not in result or "min" not in before:
+            continue
+        if result["min"] > before["min"] * (1 + threshold):
+            regressions.append((name, before["min"], result["min"]))
+    return regressions
+
+
+@click.command()
+@click.option('--size', default='small',
+              type=click.Choice(sorted(synthetic.SIZES)))
+@click.option('--repeat', default=5)
+@click.option('--benchmark', 'selected', multiple=True,
+              type=click.Choice(list(BENCHMARKS)))
+@click.option('--baseline', 'baseline_filename', default=None,
+              type=click.Path(),
+              help='Defaults to benchmarks/baselines/<size>.json.')
+@click.option('--threshold', default=0.15,
+              help='Allowed slowdown against the baseline, as a fraction.')
+@click.option('--save-baseline', is_flag=True,
+              help='Store this run as the new baseline.')
+def main(size, repeat, selected, baseline_filename, threshold,
+         save_baseline):
+    """ Run the benchmark suite and check it against the baseline """
+    logger = logging.getLogger(__name__)
+    results = run_benchmarks(size, repeat, selected)
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "size": size,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "results": results,
+    }
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    run_filename = RESULTS_DIR / "{}-{}.json".format(
+        size, datetime.datetime.now().strftime("%Y%m%dT%H%M%S"))
+    with open(run_filename, "w") as f:
+        json.dump(run, f, indent=2)
+    logger.info("results written to %s", run_filename)
+
+    failed = [name for name, result in results.items()
+              if "failed" in result]
+    for name in failed:
+        logger.error("FAILED %s: %s", name, results[name]["failed"])
+
+    baseline_filename = Path(baseline_filename or BASELINES_DIR / (
+        "{}.json".format(size)))
+    regressions = []
+    if save_baseline:
+        baseline_filename.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_filename, "w") as f:
+            json.dump(run, f, indent=2)
+            f.write("\n")
+        logger.info("baseline saved to %s", baseline_filename)
+    elif not baseline_filename.is_file():
+        logger.warning("no baseline at %s; run with --save-baseline",
+                       baseline_filename)
+    else:
+        with open(baseline_filename) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, threshold)
+        for name, before, after in regressions:
+            logger.error("REGRESSION %s: %.4f s -> %.4f s (+%.0f%%)", name,
+                         before, after, 100 * (after / before - 1))
+        if not regressions:
+            logger.info("no regressions beyond %.0f%%", 100 * threshold)
+    if regressions or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
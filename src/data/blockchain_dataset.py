@@ -11,6 +11,9 @@ Records include the following data:
     * ``date``: Date of publication.
     * ``url``: URL at which work can be found online.
     * ``filename``: Identifier of the publication within the dataset.
+On disk, records only hold ``text``, ``section_id``, ``paragraph_id`` and the
+``doc_id`` of their publication; the other fields are joined in from the
+metadata catalog compiled from docs.yml (see :mod:`src.data.catalog`).
 This dataset was compiled by David Mimno from the Oxford Text Archive and
 stored in his GitHub repo to avoid unnecessary scraping of the OTA site. It is
 downloaded from that repo, and excluding some light cleaning of its metadata,
@@ -30,6 +33,8 @@ import textacy.io as tio
 from textacy.datasets import utils
 from textacy.datasets.dataset import Dataset
 
+from src.data.catalog import Catalog, catalog_path, require_catalog
+
 LOGGER = logging.getLogger(__name__)
 
 NAME = "blockchain_papers_dataset"
@@ -43,6 +48,7 @@ META = {
 DOWNLOAD_URL = "https://github.com/mvaz/nlp_blockchain_institutions/archive/blockchain_papers_dataset.zip"
 DOWNLOAD_ROOT = "https://github.com/mvaz/nlp_blockchain_institutions/archive/"
 DEFAULT_DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "interim"))
+DEFAULT_DOCS = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "docs.yml"))
 
 class BlockchainPapersDataset(Dataset):
     """
@@ -64,64 +70,59 @@ class BlockchainPapersDataset(Dataset):
     Args:
         data_dir (str): Path to directory on disk under which dataset data is stored,
             i.e. ``/path/to/data_dir/blockchain_papers_dataset`` .
+        docs_filename (str): docs.yml the metadata catalog is compiled from;
+            ``None`` to use the catalog next to the dataset as it is.
     Attributes:
         full_date_range (Tuple[str]): First and last dates for which works
             are available, each as an ISO-formatted string (YYYY-MM-DD).
-        authors (Set[str]): Full names of all distinct authors included in this
-            dataset, e.g. "Shakespeare, William".
+        filenames (List[str]): Filenames of all documents in the catalog.
+        institutions (List[str]): Names of all distinct publishing institutions,
+            e.g. "Bank of England".
     """
 
-    full_date_range = ("0018-01-01", "1990-01-01")
-    filenames = [
-        "ecb.miptopical190604.en.pdf",
-        "ecb.stella_project_report_september_2017.pdf",
-        "stella_project_report_march_2018.pdf",
-        "2017-09-distributed-data.pdf",
-        "2018-10-25-blockbaster-final-report-data.pdf",
-        "cryptoassets_taskforce_final_report_final_web.pdf",
-        "monetary-financing-with-interest-bearing-money.pdf",
-        "central-bank-digital-currencies-design-principles-and-balance-sheet-implications.pdf",
-        "BOT_DLT_Scriptless_Bond.pdf",
-        "ecbop172.en.pdf",
-        "d157.pdf",
-        "d174.pdf",
-        "work698.pdf",
-        "r_qt1709f.pdf",
-        "r180313a.pdf",
-        "SDN1808.pdf",
-        "the-economics-of-distributed-ledger-technology-for-securities-settlement.pdf",
-        "2016095pap.pdf",
-        "CBDC_Brazil_R3.pdf",
-        "bnm_gov_my.pdf",
-        #   "bnm_gov_my.pdf",
-        "the-riksbanks-e-krona-project-report-2.pdf",
-        "the-riksbanks-e-krona-project-report-1.pdf"
-    ]
-
-    institutions = [
-        "European Central Bank",
-        "Bundesbank",
-        "Deutsche Börse",
-        "UK Government",
-        "Bank of England",
-        "Bank of Thailand",
-        "Bank of International Settlements",
-        "International Monetary Fund",
-        "Federal Reserve Board",
-        "R3",
-        "Central Bank of Malaysia",
-        #   "The Institute and Faculty of Actuaries (IFoA)",
-        "Sveriges Riksbank"
-    ]
-
-
-    def __init__(self, data_dir=os.path.join(DEFAULT_DATA_DIR, NAME)):
+    def __init__(self, data_dir=os.path.join(DEFAULT_DATA_DIR, NAME),
+                 docs_filename=DEFAULT_DOCS):
         super(BlockchainPapersDataset, self).__init__(NAME, meta=META)
         self.data_dir = data_dir
+        self.docs_filename = docs_filename
         self._filename = "dataset.json"
         self._filepath = os.path.join(self.data_dir, self._filename)
         # self._metadata_filepath = os.path.join(self.data_dir, "master", "metadata.tsv")
         self._metadata = META
+        self._catalog = None
+
+    @property
+    def catalog(self):
+        """
+        :class:`Catalog`: docs.yml metadata of the documents, compiled next
+            to the dataset file (recompiled if ``docs_filename`` changed).
+
+        Raises:
+            MissingCatalogError: without a docs.yml to compile and no
+                catalog next to the dataset.
+        """
+        if self._catalog is None:
+            if self.docs_filename and os.path.isfile(self.docs_filename):
+                self._catalog = Catalog.compile(
+                    self.docs_filename, catalog_path(self._filepath))
+            else:
+                self._catalog = require_catalog(self._filepath)
+        return self._catalog
+
+    @property
+    def filenames(self):
+        """ List[str]: filenames of all documents in the catalog """
+        return self.catalog.filenames
+
+    @property
+    def institutions(self):
+        """ List[str]: distinct (co-)publishing institutions """
+        return self.catalog.institutions
+
+    @property
+    def full_date_range(self):
+        """ Tuple[str]: first and (exclusive) last publication dates """
+        return self.catalog.date_range or ("0000-01-01", "9999-12-31")
 
     @property
     def filepath(self):
@@ -166,7 +167,7 @@ class BlockchainPapersDataset(Dataset):
             force=force,
         )
 
-    def __iter__(self):
+    def _iter_raw(self):
         if not os.path.isfile(self._filepath):
             raise OSError(
                 "dataset file {} not found;\n"
@@ -175,8 +176,12 @@ class BlockchainPapersDataset(Dataset):
         mode = "rb" if compat.PY2 else "rt"  # TODO: check this
         for record in tio.read_json(self._filepath, mode=mode, lines=True):
             yield record
-    
-    # FIXME
+
+    def __iter__(self):
+        catalog = self.catalog
+        for record in self._iter_raw():
+            yield catalog.join(record)
+
     def _get_filters( 
         self,
         filename,
@@ -191,34 +196,32 @@ class BlockchainPapersDataset(Dataset):
             filters.append(
                 lambda record: len(record.get("text", "")) >= min_len
             )
-        if date_range is not None:
-            date_range = utils.validate_and_clip_range_filter(
-                date_range, self.full_date_range, val_type=compat.string_types)
-            filters.append(
-                lambda record: (
-                    record.get("date")
-                    and date_range[0] <= record["date"] < date_range[1]
-                )
-            )
+        # metadata filters become one set of matching doc_ids
         if filename is not None:
             filename = utils.validate_set_member_filter(
                 filename, compat.string_types, valid_vals=self.filenames)
-            filters.append(lambda record: record.get("filename") in filename)
         if institution is not None:
             institution = utils.validate_set_member_filter(
                 institution, compat.string_types, valid_vals=self.institutions)
-            filters.append(lambda record: record.get("institution") in institution)
+        if date_range is not None:
+            date_range = utils.validate_and_clip_range_filter(
+                date_range, self.full_date_range, val_type=compat.string_types)
+        if filename is not None or institution is not None or date_range is not None:
+            doc_ids = self.catalog.select(filename, institution, date_range)
+            record_doc_id = self.catalog.record_doc_id
+            filters.append(lambda record: record_doc_id(record) in doc_ids)
         return filters
 
 
     def _filtered_iter(self, filters):
+        catalog = self.catalog
         if filters:
-            for record in self:
+            for record in self._iter_raw():
                 if all(filter_(record) for filter_ in filters):
-                    yield record
+                    yield catalog.join(record)
         else:
-            for record in self:
-                yield record
+            for record in self._iter_raw():
+                yield catalog.join(record)
 
 
     def texts(self, filename=None, institution=None, date_range=None, min_len=None, limit=None):
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata Catalog
+----------------
+docs.yml compiled into an indexed SQLite database, kept next to the
+dataset file::
+
+    data/interim/blockchain_papers_dataset/
+        dataset.json        <- {"doc_id": 3, "section_id": ..., "text": ...}
+        catalog.sqlite      <- doc_id -> filename, institution, date, ...
+
+Dataset records refer to their publication by a compact integer
+``doc_id`` instead of repeating its docs.yml entry on every paragraph;
+:func:`src.data.records.read_dataset` and :class:`BlockchainPapersDataset`
+join the entry back in from an in-memory copy of the catalog. Documents
+keep their ``doc_id`` across rebuilds, so editing docs.yml only recompiles
+the catalog, not the dataset. Files the dataset holds but docs.yml no longer (or never)
+lists stay in the catalog with only their ``filename``, so every
+``doc_id`` in a dataset can be resolved.
+
+The catalog is rebuilt only when the sha256 of docs.yml changed. Filters
+(:meth:`Catalog.select`) run against indexed columns and return the set of
+matching ``doc_id``, which records are then checked against.
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+import click
+import yaml
+from dotenv import find_dotenv, load_dotenv
+
+CATALOG = "catalog.sqlite"
+SCHEMA_VERSION = "1"
+
+DATE_RE = re.compile(r"^(\d{4})(?:[/-](\d{1,2}))?(?:[/-](\d{1,2}))?")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS source (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    listed INTEGER NOT NULL DEFAULT 1,
+    date TEXT,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS institutions (
+    institution TEXT NOT NULL,
+    doc_id INTEGER NOT NULL REFERENCES documents (doc_id),
+    PRIMARY KEY (institution, doc_id)
+);
+CREATE INDEX IF NOT EXISTS documents_date ON documents (date);
+"""
+
+
+class MissingCatalogError(ValueError):
+    """ Records refer to their metadata by ``doc_id``, but there is no
+        catalog to look it up in """
+
+
+def normalize_date(value):
+    """ Turn docs.yml style dates (``2018/3/13``) into ISO ``2018-03-13`` """
+    if not value:
+        return None
+    match = DATE_RE.match(str(value))
+    if not match:
+        return None
+    year, month, day = match.groups()
+    return "{}-{:02d}-{:02d}".format(year, int(month or 1), int(day or 1))
+
+
+def split_institutions(value):
+    """ docs.yml lists co-publishers as ``"Bundesbank, Deutsche Börse"`` """
+    if not value:
+        return []
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def catalog_path(dataset_filename):
+    """ Where the catalog of `dataset_filename` is kept """
+    return os.path.join(os.path.dirname(os.path.abspath(dataset_filename)),
+                        CATALOG)
+
+
+def _missing(dataset_filename):
+    return MissingCatalogError(
+        "records of {} have a doc_id but {} is missing; compile it with "
+        "`python src/data/catalog.py build docs.yml {}`".format(
+            dataset_filename, catalog_path(dataset_filename),
+            dataset_filename))
+
+
+def require_catalog(dataset_filename):
+    """
+    The catalog next to `dataset_filename`.
+
+    Raises:
+        MissingCatalogError: if it has not been compiled.
+    """
+    catalog = Catalog.for_dataset(dataset_filename)
+    if catalog is None:
+        raise _missing(dataset_filename)
+    return catalog
+
+
+def join_metadata(records, dataset_filename):
+    """
+    Yield `records` with the docs.yml metadata of their ``doc_id`` joined in
+    from the catalog next to `dataset_filename`. Records without a
+    ``doc_id`` (older datasets) are yielded as they are.
+
+    Raises:
+        MissingCatalogError: if a record has a ``doc_id`` and the catalog
+            is missing, instead of passing on records without metadata.
+    """
+    catalog = Catalog.for_dataset(dataset_filename)
+    for record in records:
+        if catalog is not None:
+            yield catalog.join(record)
+        elif record.get("doc_id") is not None:
+            raise _missing(dataset_filename)
+        else:
+            yield record
+
+
+def _sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_entries(docs_filename, metadata_path="pdfs"):
+    """ docs.yml entries by filename, the last one winning """
+    logger = logging.getLogger(__name__)
+    with open(docs_filename) as f:
+        entries = yaml.safe_load(f)[metadata_path]
+    by_filename = {}
+    for entry in entries:
+        if entry["filename"] in by_filename:
+            logger.warning("duplicate docs.yml entry for %s",
+                           entry["filename"])
+        by_filename[entry["filename"]] = entry
+    return by_filename
+
+
+class Catalog(object):
+    """
+    Args:
+        path (str): The SQLite file. Only compiling and registering new
+            filenames create it; lookups in a missing file raise
+            :class:`MissingCatalogError`.
+
+    Lookups (:meth:`get`, :meth:`join`, :meth:`doc_id`) go to a copy of the
+    documents table loaded on first use, so the object can be used from
+    any thread or forked process; only compiling and registering new
+    filenames touch the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._documents = None
+        self._ids = None
+
+    @classmethod
+    def compile(cls, docs_filename, path):
+        """ The catalog at `path`, rebuilt first if docs.yml changed """
+        catalog = cls(path)
+        catalog.update(docs_filename)
+        return catalog
+
+    @classmethod
+    def for_dataset(cls, dataset_filename):
+        """ The catalog next to `dataset_filename`, or ``None`` """
+        path = catalog_path(dataset_filename)
+        return cls(path) if os.path.isfile(path) else None
+
+    @contextlib.contextmanager
+    def _connect(self, create=False):
+        if not create:
+            if not os.path.isfile(self.path):
+                raise MissingCatalogError(
+                    "{} does not exist; compile it with `python "
+                    "src/data/catalog.py build`".format(self.path))
+            db = sqlite3.connect(
+                Path(self.path).resolve().as_uri() + "?mode=ro",
+                timeout=60, uri=True)
+        else:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            if create:
+                db.executescript(_SCHEMA)
+            yield db
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connect(create=True) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @property
+    def source(self):
+        """ Dict[str, str]: the docs.yml the catalog was compiled from """
+        if not os.path.isfile(self.path):
+            return {}
+        with self._connect() as db:
+            return dict(db.execute("SELECT key, value FROM source"))
+
+    def is_stale(self, docs_filename):
+        source = self.source
+        return (source.get("schema") != SCHEMA_VERSION
+                or source.get("sha256") != _sha256(docs_filename))
+
+    def update(self, docs_filename, force=False):
+        """
+        Recompile the catalog from `docs_filename` unless it is unchanged.
+
+        Returns:
+            bool: whether the catalog was rebuilt.
+        """
+        logger = logging.getLogger(__name__)
+        if not force and not self.is_stale(docs_filename):
+            return False
+        sha256 = _sha256(docs_filename)
+        entries = load_entries(docs_filename)
+        with self._transaction() as db:
+            known = dict(db.execute("SELECT filename, doc_id FROM documents"))
+            for filename, entry in entries.items():
+                row = (normalize_date(entry.get("date")),
+                       json.dumps(entry, sort_keys=True, default=str))
+                if filename in known:
+                    db.execute(
+                        "UPDATE documents SET listed = 1, date = ?, "
+                        "metadata = ? WHERE doc_id = ?",
+                        row + (known[filename],))
+                else:
+                    db.execute(
+                        "INSERT INTO documents (filename, date, metadata) "
+                        "VALUES (?, ?, ?)", (filename,) + row)
+            for filename in set(known) - set(entries):
+                db.execute(
+                    "UPDATE documents SET listed = 0, date = NULL, "
+                    "metadata = ? WHERE doc_id = ?",
+                    (json.dumps({"filename": filename}), known[filename]))
+            ids = dict(db.execute("SELECT filename, doc_id FROM documents"))
+            db.execute("DELETE FROM institutions")
+            db.executemany(
+                "INSERT OR IGNORE INTO institutions VALUES (?, ?)",
+                [(institution, ids[filename])
+                 for filename, entry in entries.items()
+                 for institution in split_institutions(
+                     entry.get("institution"))])
+            db.executemany(
+                "INSERT OR REPLACE INTO source VALUES (?, ?)",
+                [("schema", SCHEMA_VERSION),
+                 ("docs", os.path.abspath(docs_filename)),
+                 ("sha256", sha256)])
+        self._documents = self._ids = None
+        logger.info("compiled %d docs.yml entries into %s", len(entries),
+                    self.path)
+        return True
+
+    def _load(self, create=False):
+        if self._documents is None:
+            with self._connect(create) as db:
+                rows = db.execute(
+                    "SELECT doc_id, filename, metadata FROM documents"
+                ).fetchall()
+            self._documents = dict((doc_id, json.loads(metadata))
+                                   for doc_id, _, metadata in rows)
+            self._ids = dict((filename, doc_id)
+                             for doc_id, filename, _ in rows)
+        return self._documents
+
+    def get(self, doc_id):
+        """ The docs.yml entry of `doc_id` """
+        try:
+            return self._load()[doc_id]
+        except KeyError:
+            raise KeyError("doc_id {} is not in {}".format(doc_id, self.path))
+
+    def doc_id(self, filename):
+        """ The ``doc_id`` of `filename`, registered if not yet known """
+        self._load(create=True)
+        if filename not in self._ids:
+            with self._transaction() as db:
+                db.execute(
+                    "INSERT OR IGNORE INTO documents "
+                    "(filename, listed, metadata) VALUES (?, 0, ?)",
+                    (filename, json.dumps({"filename": filename})))
+            self._documents = self._ids = None
+            self._load()
+        return self._ids[filename]
+
+    def join(self, record):
+        """ Add the metadata of its ``doc_id`` to `record`, in place;
+            records without one (older datasets) are left as they are """
+        doc_id = record.get("doc_id")
+        if doc_id is not None:
+            record.update(self.get(doc_id))
+        return record
+
+    def record_doc_id(self, record):
+        """ ``doc_id`` of `record`, looked up by filename if not stored """
+        doc_id = record.get("doc_id")
+        if doc_id is None:
+            self._load()
+            doc_id = self._ids.get(record.get("filename"))
+        return doc_id
+
+    @property
+    def filenames(self):
+        """ List[str]: every filename that may appear in the dataset """
+        self._load()
+        return sorted(self._ids)
+
+    @property
+    def institutions(self):
+        """ List[str]: distinct publishers, co-publishers split """
+        with self._connect() as db:
+            return [institution for institution, in db.execute(
+                "SELECT DISTINCT institution FROM institutions "
+                "ORDER BY institution")]
+
+    @property
+    def date_range(self):
+        """
+        Tuple[str]: first publication date and the day after the last one,
+        as ISO strings, or ``None`` if no entry has a date.
+        """
+        with self._connect() as db:
+            first, last = db.execute(
+                "SELECT MIN(date), MAX(date) FROM documents "
+                "WHERE listed = 1").fetchone()
+        if first is None:
+            return None
+        end = datetime.date(*map(int, last.split("-")))
+        return first, (end + datetime.timedelta(days=1)).isoformat()
+
+    def select(self, filename=None, institution=None, date_range=None):
+        """
+        ``doc_id`` of the documents matching all given filters.
+
+        Args:
+            filename (Set[str]): Any of these filenames.
+            institution (Set[str]): Published (or co-published) by any of
+                these institutions.
+            date_range (Tuple[str]): ISO ``[start, end)``.
+
+        Returns:
+            Set[int]
+        """
+        clauses, params = [], []
+        if filename is not None:
+            filename = sorted(filename)
+            clauses.append("filename IN ({})".format(
+                ", ".join("?" * len(filename))))
+            params.extend(filename)
+        if institution is not None:
+            institution = sorted(institution)
+            clauses.append(
+                "doc_id IN (SELECT doc_id FROM institutions "
+                "WHERE institution IN ({}))".format(
+                    ", ".join("?" * len(institution))))
+            params.extend(institution)
+        if date_range is not None:
+            clauses.append("date >= ? AND date < ?")
+            params.extend(date_range)
+        query = "SELECT doc_id FROM documents"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._connect() as db:
+            return set(doc_id for doc_id, in db.execute(query, params))
+
+
+@click.group()
+def cli():
+    """ Compile and inspect the docs.yml metadata catalog """
+
+
+@cli.command()
+@click.argument('docs_filename', default='docs.yml', type=click.Path(exists=True))
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path())
+@click.option('--force', is_flag=True, help='Rebuild even if docs.yml is unchanged.')
+def build(docs_filename, dataset_filename, force):
+    """ Compile docs.yml into the catalog next to `dataset_filename` """
+    logger = logging.getLogger(__name__)
+    catalog = Catalog(catalog_path(dataset_filename))
+    if not catalog.update(docs_filename, force=force):
+        logger.info("%s is up to date", catalog.path)
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path())
+@click.option('--institution', multiple=True)
+@click.option('--start', default=None, help='ISO date, inclusive.')
+@click.option('--end', default=None, help='ISO date, exclusive.')
+def show(dataset_filename, institution, start, end):
+    """ List the catalogued documents matching the filters """
+    catalog = Catalog.for_dataset(dataset_filename)
+    if catalog is None:
+        raise click.ClickException("no catalog next to {}".format(
+            dataset_filename))
+    date_range = None
+    if start or end:
+        full = catalog.date_range or ("0000-01-01", "9999-12-31")
+        date_range = (start or full[0], end or full[1])
+    doc_ids = catalog.select(institution=set(institution) or None,
+                             date_range=date_range)
+    for doc_id in sorted(doc_ids):
+        meta = catalog.get(doc_id)
+        click.echo("{:>4}  {:<10}  {:<40}  {}".format(
+            doc_id, normalize_date(meta.get("date")) or "-",
+            meta.get("institution") or "-", meta["filename"]))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
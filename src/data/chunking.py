@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Paragraph Chunking
+------------------
+CERMINE's ``<p>`` elements range from single table cells to multi-page
+blobs. Before the spaCy stages, :class:`Chunker` turns the dataset records
+into chunks of predictable size:
+
+    * paragraphs longer than ``max_chars`` are split at sentence ends
+      (falling back to any whitespace, and only then to a hard cut);
+    * fragments shorter than ``min_chars`` are merged into a neighbouring
+      paragraph of the same section, separated by a blank line.
+
+Fields describing a single paragraph (the prefilter's ``quality`` label)
+do not carry over to a merged chunk: they are recomputed on its text by
+the chunker's ``labeler`` or left out.
+
+Every chunk keeps ``spans``, ``[chunk_start, chunk_end, key, offset]``
+lists saying which characters came from which record (``key`` as in
+:func:`src.data.records.record_key`, ``offset`` into that record's text), so
+:func:`locate` can map entity or keyterm offsets back to the original
+paragraph.
+
+:func:`length_batches` then groups chunks of similar length, so that each
+``nlp.pipe`` batch has a bounded number of characters; :func:`pipe` runs a
+pipeline over them and yields ``(chunk, doc)`` pairs.
+"""
+import bisect
+import re
+
+from src.data.records import record_key
+from src.profiling import get_tracer
+
+MAX_CHARS = 2000
+MIN_CHARS = 100
+SEPARATOR = "\n\n"
+# set per paragraph, so not valid for a chunk merged from several
+PARAGRAPH_FIELDS = ("quality",)
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])([\"')\]]*)\s+(?=\S)")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def split_text(text, max_chars=MAX_CHARS):
+    """
+    ``(start, end)`` offsets of consecutive pieces of `text`, each at most
+    `max_chars` long, cut after the last sentence end (or whitespace) that
+    fits. Whitespace at the cuts is left out of the pieces.
+    """
+    pieces = []
+    start = 0
+    n = len(text)
+    while n - start > max_chars:
+        limit = start + max_chars
+        end = None
+        for pattern in (_SENTENCE_END_RE, _WHITESPACE_RE):
+            cuts = [m for m in pattern.finditer(text, start, limit + 1)
+                    if m.start() > start]
+            if cuts:
+                # the closing quotes / brackets of a sentence stay with it
+                end = cuts[-1].end(1) if pattern.groups else cuts[-1].start()
+                next_start = cuts[-1].end()
+                break
+        if end is None:
+            end = next_start = limit
+        pieces.append((start, end))
+        start = next_start
+    if start < n:
+        pieces.append((start, n))
+    return pieces
+
+
+class Chunker(object):
+    """
+    Args:
+        max_chars (int): Longest chunk; paragraphs above it are split.
+        min_chars (int): Pieces shorter than this are merged with a
+            neighbour of the same section when the result still fits.
+        field (str): Record field holding the text.
+        labeler (callable): Recomputes the ``quality`` label of merged
+            chunks from their text, e.g. :meth:`QualityFilter.label`;
+            without it merged chunks have no label.
+    """
+
+    def __init__(self, max_chars=MAX_CHARS, min_chars=MIN_CHARS, field="text",
+                 labeler=None):
+        if min_chars > max_chars:
+            raise ValueError("`min_chars` must not exceed `max_chars`")
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+        self.field = field
+        self.labeler = labeler
+
+    def _pieces(self, records):
+        for record in records:
+            text = record.get(self.field) or ""
+            key = record_key(record)
+            for start, end in split_text(text, self.max_chars):
+                yield record, key, start, end
+
+    def chunks(self, records):
+        """
+        Yield chunk records for dataset `records`, in order. A chunk carries
+        the metadata of its first record (less :data:`PARAGRAPH_FIELDS` if
+        merged), ``chunk_id`` (``"<filename>#<n>"``), ``text`` and
+        ``spans``.
+        """
+        current = None
+        counters = {}
+        for record, key, start, end in self._pieces(records):
+            text = record[self.field][start:end]
+            group = (record.get("filename"), record.get("section_id"))
+            if current is not None and current["group"] == group and (
+                    len(text) < self.min_chars
+                    or current["length"] < self.min_chars) and (
+                    current["length"] + len(SEPARATOR) + len(text)
+                    <= self.max_chars):
+                offset = current["length"] + len(SEPARATOR)
+                current["texts"].append(text)
+                current["spans"].append([offset, offset + len(text), key,
+                                         start])
+                current["length"] = offset + len(text)
+                continue
+            if current is not None:
+                yield self._chunk(current, counters)
+            current = {"group": group, "record": record, "texts": [text],
+                       "spans": [[0, len(text), key, start]],
+                       "length": len(text)}
+        if current is not None:
+            yield self._chunk(current, counters)
+
+    def _chunk(self, current, counters):
+        chunk = {k: v for k, v in current["record"].items()
+                 if k not in (self.field, "paragraph_id")}
+        filename = chunk.get("filename")
+        n = counters.get(filename, 0)
+        counters[filename] = n + 1
+        chunk["chunk_id"] = "{}#{}".format(filename, n)
+        chunk[self.field] = SEPARATOR.join(current["texts"])
+        chunk["spans"] = current["spans"]
+        if len(current["texts"]) > 1:
+            for key in PARAGRAPH_FIELDS:
+                chunk.pop(key, None)
+            if self.labeler is not None:
+                chunk["quality"] = self.labeler(chunk[self.field])
+        return chunk
+
+
+def locate(chunk, start, end=None):
+    """
+    Map the character offsets `start`:`end` of `chunk` back to the record
+    they came from.
+
+    Returns:
+        Tuple[str, int, int]: record key and offsets into its text, or
+        ``None`` if `start` falls on a separator. A range running over a
+        separator is clipped to the record holding `start`.
+    """
+    spans = chunk["spans"]
+    end = start if end is None else end
+    i = bisect.bisect_right([span[0] for span in spans], start) - 1
+    if i < 0:
+        return None
+    chunk_start, chunk_end, key, offset = spans[i]
+    if start >= chunk_end:
+        return None
+    return (key, offset + start - chunk_start,
+            offset + min(end, chunk_end) - chunk_start)
+
+
+def length_batches(chunks, batch_chars=50000, batch_size=256, window=4096,
+                   field="text"):
+    """
+    Group `chunks` into batches of similar length. Up to `window` chunks are
+    read at a time and sorted by length, then cut into batches of at most
+    `batch_size` chunks and `batch_chars` characters (a single longer chunk
+    makes a batch of its own).
+
+    Yields:
+        List[dict]: chunks; their order across batches is not the input
+        order.
+    """
+    def flush(buffered):
+        buffered.sort(key=lambda c: len(c[field]))
+        batch, chars = [], 0
+        for chunk in buffered:
+            length = len(chunk[field])
+            if batch and (len(batch) >= batch_size
+                          or chars + length > batch_chars):
+                yield batch
+                batch, chars = [], 0
+            batch.append(chunk)
+            chars += length
+        if batch:
+            yield batch
+
+    buffered = []
+    for chunk in chunks:
+        buffered.append(chunk)
+        if len(buffered) >= window:
+            for batch in flush(buffered):
+                yield batch
+            buffered = []
+    for batch in flush(buffered):
+        yield batch
+
+
+def pipe(nlp, chunks, batch_chars=50000, batch_size=256, window=4096,
+         field="text"):
+    """
+    Run the spaCy pipeline `nlp` over length-bucketed batches of `chunks`.
+
+    Yields:
+        Tuple[dict, :class:`spacy.tokens.Doc`]: chunk and its doc, in
+        batch order.
+    """
+    tracer = get_tracer()
+    for batch in length_batches(chunks, batch_chars, batch_size, window,
+                                field):
+        longest = len(batch[-1][field])
+        if longest > nlp.max_length:
+            raise ValueError(
+                "chunk of {} characters exceeds nlp.max_length ({}); lower "
+                "Chunker.max_chars".format(longest, nlp.max_length))
+        with tracer.stage("chunking/pipe", event=False) as span:
+            docs = list(nlp.pipe((c[field] for c in batch),
+                                 batch_size=len(batch)))
+            span.count(len(batch))
+        for chunk, doc in zip(batch, docs):
+            yield chunk, doc
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+Distributed Corpus Build
+------------------------
+Builds the textacy corpus with any number of workers on any number of
+machines sharing a run directory::
+
+    corpus_run/
+        queue.sqlite          <- work units, leases and results
+        parts/unit-000012.a1.acy
+
+The coordinator (``init``) splits ``dataset.json`` into work units of one
+whole document each, recorded as the byte ranges of the dataset file its
+records occupy; documents are never split, as the prefilter's header
+detection needs all of their paragraphs. The sha256 and size of the
+dataset are stored with the queue, and workers refuse to read units of a
+dataset that changed since (``local`` starts a new run instead). Workers
+(``worker``) claim a
+unit by taking a lease on it, read its records, run the quality prefilter,
+the chunker if enabled and the spaCy pipeline over them and save a partial
+corpus. While a
+unit is processed its lease is renewed in the background; the unit is
+handed to another worker when the lease runs out (the worker died or
+stalled) and it is retried up to ``max_attempts`` times when processing
+fails. A result is only accepted from the worker holding the current lease.
+``merge`` loads the parts in unit order into the final corpus.
+
+The queue is a SQLite database, so the run directory must live on storage
+with working file locks. ``local`` runs the whole thing on one machine with
+several worker processes::
+
+    python src/data/distributed_corpus.py local data/interim/blockchain_papers_dataset/dataset.json data/processed/corpus.acy --workers 4
+"""
+import collections
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+QUEUE = "queue.sqlite"
+PARTS = "parts"
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    filename TEXT,
+    ranges TEXT NOT NULL,
+    paragraphs INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    output TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until);
+"""
+
+
+def _units(dataset_filename):
+    """ ``(document, ranges, paragraphs)`` per document (``doc_id``, or
+        filename in datasets without one), in order of first appearance;
+        ``ranges`` are the ``[offset, length]`` byte ranges of the dataset
+        holding its records, as json """
+    units = collections.OrderedDict()
+    with open(dataset_filename, "rb") as f:
+        offset = 0
+        previous = None
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                document = record.get("doc_id", record.get("filename"))
+                unit = units.setdefault(document, [[], 0])
+                if document == previous:
+                    unit[0][-1][1] = offset + len(line) - unit[0][-1][0]
+                else:
+                    unit[0].append([offset, len(line)])
+                unit[1] += 1
+                previous = document
+            offset += len(line)
+    for document, (ranges, paragraphs) in units.items():
+        yield document, json.dumps(ranges), paragraphs
+
+
+class WorkQueue(object):
+    """
+    Durable queue of work units in `run_dir`, shared by coordinator,
+    workers and merge step.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.parts_dir = os.path.join(run_dir, PARTS)
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(run_dir, QUEUE), timeout=60,
+                                  isolation_level=None)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Write transaction holding the database lock from the start """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    @property
+    def meta(self):
+        return dict(self.db.execute("SELECT key, value FROM meta"))
+
+    @property
+    def dataset_filename(self):
+        return self.meta["dataset"]
+
+    def create(self, dataset_filename, options=None):
+        """
+        Split `dataset_filename` into units. `options` (json-serializable)
+        are stored for the workers, e.g. the spaCy pipeline to load.
+
+        Returns:
+            int: number of units.
+        """
+        from src.pipeline import file_digest
+        if self.db.execute("SELECT COUNT(*) FROM units").fetchone()[0]:
+            raise ValueError("{} already holds a run".format(self.run_dir))
+        dataset_filename = os.path.abspath(dataset_filename)
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [("dataset", dataset_filename),
+                 ("dataset_size", str(os.path.getsize(dataset_filename))),
+                 ("dataset_sha256", file_digest(dataset_filename)),
+                 ("options", json.dumps(options or {}))])
+            db.executemany(
+                "INSERT INTO units (filename, ranges, paragraphs) "
+                "VALUES (?, ?, ?)", _units(dataset_filename))
+        return self.db.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+
+    def matches(self, dataset_filename=None):
+        """ Whether the run was created from `dataset_filename` (its own
+            dataset by default) as it is now: same path, size and sha256 """
+        from src.pipeline import file_digest
+        meta = self.meta
+        path = os.path.abspath(dataset_filename or meta.get("dataset", ""))
+        return (meta.get("dataset") == path and os.path.isfile(path)
+                and meta.get("dataset_size") == str(os.path.getsize(path))
+                and meta.get("dataset_sha256") == file_digest(path))
+
+    def check_dataset(self):
+        """
+        Raises:
+            ValueError: if the dataset changed since the run was created,
+                so the byte ranges of the units no longer hold its records.
+        """
+        if not self.matches():
+            raise ValueError(
+                "{} changed since the run in {} was created; start a new "
+                "run".format(self.meta.get("dataset"), self.run_dir))
+
+    def reset(self):
+        """ Forget the run: units, metadata and parts """
+        with self._transaction() as db:
+            db.execute("DROP TABLE IF EXISTS units")
+            db.execute("DELETE FROM meta")
+        self.db.executescript(_SCHEMA)
+        shutil.rmtree(self.parts_dir)
+        os.makedirs(self.parts_dir)
+
+    def claim(self, worker, lease_seconds, max_attempts=3):
+        """
+        Lease the next pending unit, or one whose lease has run out.
+
+        Returns:
+            Tuple[int, List[List[int]], int]: unit id, ``[offset, length]``
+            byte ranges in the dataset and attempt number, or ``None`` if
+            there is nothing to claim right now.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id, ranges, attempts FROM units "
+                "WHERE (state = ? OR (state = ? AND lease_until < ?)) "
+                "AND attempts < ? ORDER BY id LIMIT 1",
+                (PENDING, LEASED, now, max_attempts)).fetchone()
+            if row is None:
+                # stalled units out of attempts are given up on
+                db.execute(
+                    "UPDATE units SET state = ?, error = 'lease expired' "
+                    "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, LEASED, now, max_attempts))
+                return None
+            db.execute(
+                "UPDATE units SET state = ?, worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (LEASED, worker, now + lease_seconds, row[0]))
+        return row[0], json.loads(row[1]), row[2] + 1
+
+    def renew(self, unit_id, worker, lease_seconds):
+        """ Extend a lease; False if `worker` no longer holds it """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE units SET lease_until = ? "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                (time.time() + lease_seconds, unit_id, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker, output):
+        """ Record the part of a unit; False if the lease was lost """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE units SET state = ?, output = ?, error = NULL "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                (DONE, output, unit_id, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def fail(self, unit_id, worker, error, max_attempts=3):
+        """ Give a unit back for a retry, or fail it for good """
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE units SET state = CASE WHEN attempts < ? THEN ? "
+                "ELSE ? END, error = ?, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                (max_attempts, PENDING, FAILED, error, unit_id, worker,
+                 LEASED))
+
+    def counts(self):
+        """ Dict[str, int]: number of units per state """
+        return dict(self.db.execute(
+            "SELECT state, COUNT(*) FROM units GROUP BY state"))
+
+    def unfinished(self):
+        """ Whether units are pending or leased """
+        counts = self.counts()
+        return bool(counts.get(PENDING) or counts.get(LEASED))
+
+    def read_unit(self, ranges):
+        """ Records in byte `ranges` of the dataset, metadata joined in """
+        from src.data.catalog import join_metadata
+        records = []
+        with open(self.dataset_filename, "rb") as f:
+            for offset, length in ranges:
+                f.seek(offset)
+                records.extend(json.loads(line)
+                               for line in f.read(length).splitlines()
+                               if line.strip())
+        return list(join_metadata(records, self.dataset_filename))
+
+    def parts(self):
+        """ ``(id, part filename or None)`` of every unit, in dataset order;
+            paths are resolved here, as machines may mount the run
+            directory in different places """
+        return [(unit_id, output and os.path.join(self.parts_dir, output))
+                for unit_id, output in self.db.execute(
+                    "SELECT id, output FROM units ORDER BY id")]
+
+
+class _UnitDataset(object):
+    """ The records of one unit, as :func:`make_corpus.create_corpus`
+        expects from a :class:`BlockchainPapersDataset` """
+
+    def __init__(self, records):
+        self._records = records
+
+    def __iter__(self):
+        return (dict(r) for r in self._records)
+
+    def records(self):
+        for record in self:
+            yield record.pop("text"), record
+
+
+class CorpusPartBuilder(object):
+    """
+    Default unit processor: prefilter, optionally chunk, and parse the
+    records of a unit into a textacy corpus saved at the given path. The
+    spaCy pipeline is loaded once per worker.
+    """
+
+    def __init__(self, lang="en_core_web_lg", chunking=False, prefilter=True,
+                 drop_junk=False):
+        self.lang = lang
+        self.chunking = chunking
+        self.prefilter = prefilter
+        self.drop_junk = drop_junk
+        self._nlp = None
+
+    def __call__(self, records, output_filename):
+        from src.data.chunking import Chunker
+        from src.data.make_corpus import create_corpus, prepare_lang
+        from src.data.quality import QualityFilter
+        if self._nlp is None:
+            self._nlp = prepare_lang(self.lang)
+        prefilter = QualityFilter(drop=self.drop_junk) \
+            if self.prefilter else None
+        chunker = Chunker(labeler=prefilter and prefilter.label) \
+            if self.chunking else None
+        corpus = create_corpus(
+            lang=self._nlp, dataset=_UnitDataset(records), chunker=chunker,
+            prefilter=prefilter)
+        corpus.save(output_filename)
+        return len(corpus)
+
+
+class _Heartbeat(threading.Thread):
+    """ Renews a lease until stopped; notes when the lease is lost """
+
+    def __init__(self, run_dir, unit_id, worker, lease_seconds):
+        super(_Heartbeat, self).__init__(daemon=True)
+        self.args = run_dir, unit_id, worker, lease_seconds
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        run_dir, unit_id, worker, lease_seconds = self.args
+        queue = WorkQueue(run_dir)  # sqlite connections are per thread
+        try:
+            while not self.stopped.wait(lease_seconds / 3.0):
+                if not queue.renew(unit_id, worker, lease_seconds):
+                    self.lost = True
+                    return
+        finally:
+            queue.close()
+
+
+def run_worker(run_dir, processor=None, worker=None, lease_seconds=600,
+               max_attempts=3, poll_seconds=5, max_units=None):
+    """
+    Claim and process units until none are left.
+
+    Args:
+        processor (callable): ``processor(records, output_filename)``;
+            a :class:`CorpusPartBuilder` with the run's options if omitted.
+        worker (str): Worker id; host, pid and a random suffix by default.
+        max_units (int): Stop after this many units.
+
+    Returns:
+        int: number of units this worker completed.
+    """
+    logger = logging.getLogger(__name__)
+    worker = worker or "{}:{}:{}".format(
+        socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+    queue = WorkQueue(run_dir)
+    completed = 0
+    try:
+        queue.check_dataset()
+        if processor is None:
+            processor = CorpusPartBuilder(
+                **json.loads(queue.meta["options"]))
+        while max_units is None or completed < max_units:
+            unit = queue.claim(worker, lease_seconds, max_attempts)
+            if unit is None:
+                if not queue.unfinished():
+                    break
+                time.sleep(poll_seconds)  # wait for other leases
+                continue
+            unit_id, ranges, attempt = unit
+            output = os.path.join(queue.parts_dir, "unit-{:06d}.a{}.acy".format(
+                unit_id, attempt))
+            tmp = output + ".tmp"
+            heartbeat = _Heartbeat(run_dir, unit_id, worker, lease_seconds)
+            heartbeat.start()
+            try:
+                records = queue.read_unit(ranges)
+                processor(records, tmp)
+                os.replace(tmp, output)
+            except Exception as e:
+                logger.error("%s: unit %d failed: %s", worker, unit_id, e)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                queue.fail(unit_id, worker, repr(e), max_attempts)
+                continue
+            finally:
+                heartbeat.stopped.set()
+                heartbeat.join()
+            if heartbeat.lost or not queue.complete(
+                    unit_id, worker, os.path.basename(output)):
+                logger.warning("%s: lease on unit %d lost, discarding",
+                               worker, unit_id)
+                os.remove(output)
+                continue
+            completed += 1
+            logger.info("%s: unit %d done (%d records)", worker, unit_id,
+                        len(records))
+    finally:
+        queue.close()
+    return completed
+
+
+def merge_parts(run_dir, corpus_filename, lang=None, allow_partial=False):
+    """
+    Assemble the parts of all done units, in dataset order, into one corpus
+    at `corpus_filename`.
+
+    Raises:
+        RuntimeError: if units are unfinished or failed and not
+            `allow_partial`.
+    """
+    import textacy
+    from src.data.make_corpus import prepare_lang
+    logger = logging.getLogger(__name__)
+    queue = WorkQueue(run_dir)
+    try:
+        queue.check_dataset()
+        counts = queue.counts()
+        missing = sum(n for state, n in counts.items() if state != DONE)
+        if missing and not allow_partial:
+            raise RuntimeError("{} units are not done: {}".format(
+                missing, counts))
+        options = json.loads(queue.meta["options"])
+        nlp = prepare_lang(lang or options.get("lang", "en_core_web_lg"))
+        corpus = textacy.Corpus(nlp)
+        for unit_id, output in queue.parts():
+            if output is None:
+                logger.warning("unit %d missing from the corpus", unit_id)
+                continue
+            corpus.add_docs(iter(textacy.Corpus.load(nlp, output)))
+    finally:
+        queue.close()
+    corpus.save(corpus_filename)
+    return corpus
+
+
+@click.group()
+def cli():
+    """ Build the corpus with workers sharing a run directory """
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('run_dir', default='data/interim/corpus_run', type=click.Path())
+@click.option('--lang', default='en_core_web_lg')
+@click.option('--chunk', is_flag=True,
+              help='Split long paragraphs and merge short fragments.')
+@click.option('--drop-junk', is_flag=True,
+              help='Leave out paragraphs the quality prefilter rejects.')
+def init(dataset_filename, run_dir, lang, chunk, drop_junk):
+    """ Split DATASET_FILENAME into work units in RUN_DIR """
+    logger = logging.getLogger(__name__)
+    queue = WorkQueue(run_dir)
+    try:
+        n = queue.create(dataset_filename, {
+            "lang": lang, "chunking": chunk,
+            "drop_junk": drop_junk})
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        queue.close()
+    logger.info("%d units queued in %s", n, run_dir)
+
+
+@cli.command()
+@click.argument('run_dir', default='data/interim/corpus_run', type=click.Path(exists=True))
+@click.option('--lease', 'lease_seconds', default=600,
+              help='Seconds before a silent worker loses its unit.')
+@click.option('--max-attempts', default=3)
+@click.option('--max-units', default=None, type=int)
+def worker(run_dir, lease_seconds, max_attempts, max_units):
+    """ Process units of RUN_DIR until none are left """
+    logger = logging.getLogger(__name__)
+    n = run_worker(run_dir, lease_seconds=lease_seconds,
+                   max_attempts=max_attempts, max_units=max_units)
+    logger.info("completed %d units", n)
+
+
+@cli.command()
+@click.argument('run_dir', default='data/interim/corpus_run', type=click.Path(exists=True))
+def status(run_dir):
+    """ Count the units of RUN_DIR by state """
+    queue = WorkQueue(run_dir)
+    for state, n in sorted(queue.counts().items()):
+        click.echo("{:<8} {}".format(state, n))
+    for unit_id, error in queue.db.execute(
+            "SELECT id, error FROM units WHERE state = ?", (FAILED,)):
+        click.echo("unit {} failed: {}".format(unit_id, error))
+    queue.close()
+
+
+@cli.command()
+@click.argument('run_dir', default='data/interim/corpus_run', type=click.Path(exists=True))
+@click.argument('corpus_filename', default='data/processed/corpus.acy', type=click.Path())
+@click.option('--allow-partial', is_flag=True,
+              help='Merge even if some units failed.')
+def merge(run_dir, corpus_filename, allow_partial):
+    """ Assemble the parts of RUN_DIR into CORPUS_FILENAME """
+    logger = logging.getLogger(__name__)
+    corpus = merge_parts(run_dir, corpus_filename,
+                         allow_partial=allow_partial)
+    logger.info("%s written to %s", corpus, corpus_filename)
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('corpus_filename', default='data/processed/corpus.acy', type=click.Path())
+@click.option('--run-dir', default='data/interim/corpus_run', type=click.Path())
+@click.option('--workers', default=4)
+@click.option('--lang', default='en_core_web_lg')
+@click.option('--chunk', is_flag=True,
+              help='Split long paragraphs and merge short fragments.')
+def local(dataset_filename, corpus_filename, run_dir, workers, lang, chunk):
+    """ init, several worker processes on this machine, then merge """
+    logger = logging.getLogger(__name__)
+    queue = WorkQueue(run_dir)
+    try:
+        if queue.counts() and not queue.matches(dataset_filename):
+            # resuming would read the units' byte ranges from another file
+            logger.warning("%s holds a run over another version of %s, "
+                           "starting over", run_dir, dataset_filename)
+            queue.reset()
+        if not queue.counts():
+            queue.create(dataset_filename, {"lang": lang, "chunking": chunk})
+    finally:
+        queue.close()
+    processes = [multiprocessing.Process(target=run_worker, args=(run_dir,))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    corpus = merge_parts(run_dir, corpus_filename)
+    logger.info("%s written to %s", corpus, corpus_filename)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
@@ -5,41 +5,43 @@
 # Author: Johannes Bergs
 
 import click
+import collections
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
 import yaml
-from pprint import pprint
-import os
-import wget
-
-def download_url(url: str, file_output):
-    logger = logging.getLogger(__name__)
-    logger.info('downloading single document: ' + url)
-    wget.download(url, file_output)
 
 
 @click.command()
 @click.argument('docs', type=click.File('r'))
 @click.argument('output_filepath', type=click.Path(exists=True))
-def main(docs, output_filepath):
+@click.option('--store-dir', default=None, type=click.Path(),
+              help='Content-addressed blob store; defaults to data/raw/pdf_store.')
+@click.option('--no-refresh', is_flag=True,
+              help='Only fetch documents that are not stored yet.')
+def main(docs, output_filepath, store_dir, no_refresh):
     """ Downloads docs specified in input yaml file `docs` into
-    specified `output_filepath`.
+    specified `output_filepath`, revalidating the ones already stored.
     """
+    from src.data.pdf_store import PDFStore
     logger = logging.getLogger(__name__)
     logger.info('downloading documents to external data')
     logger.info(docs)
     logger.info(output_filepath)
 
     config = yaml.safe_load(docs)
-    pprint(config['pdfs'])
+    store = PDFStore(output_filepath, store_dir)
+    statuses = collections.Counter()
     for doc in config['pdfs']:
         try:
-            download_url(doc['url'], os.path.join(output_filepath, doc['filename']))
+            fetched = store.fetch(doc['url'], doc['filename'],
+                                  refresh=not no_refresh)
+            statuses[fetched.status] += 1
         except Exception as e:
-            logger.error(e)
-
+            statuses['failed'] += 1
+            logger.error('%s: %s', doc['url'], e)
+    logger.info(', '.join('{} {}'.format(n, s) for s, n in statuses.items()))
 
 
 if __name__ == '__main__':
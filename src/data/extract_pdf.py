@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+In-process PDF extraction
+-------------------------
+A pdfminer.six alternative to running CERMINE over ``data/external``.
+Runs of consecutive pages of a PDF are laid out in parallel worker
+processes, each parsing the file once for its run; the text boxes of each
+page are turned into paragraphs, and boxes set in a noticeably larger font
+than the page's body text start a new section. Running headers and footers
+(boxes at the top or bottom of a page repeating those of an earlier page,
+digits aside) and bare page numbers are left out.
+
+Records are yielded page by page, in order, as soon as each page is done,
+with the same ``section_id`` / ``paragraph_id`` / ``text`` fields as
+:func:`make_dataset.get_paragraphs` plus the 1-based ``page``; as there,
+text keeps its line breaks until it is normalized. A paragraph
+running over a page break is held back until the next page arrives and
+then joined.
+
+A document is written to the dataset only once all its pages are
+extracted, so one failing half-way is left out rather than written in part.
+"""
+import concurrent.futures
+import logging
+import os
+import re
+import statistics
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LAParams, LTChar, LTTextContainer
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+
+from src.data.catalog import Catalog, catalog_path
+from src.data.make_dataset import write_to_dataset
+from src.data.normalize import Normalizer
+from src.data.pdf_store import PDFStore
+from src.profiling import get_tracer
+
+# a box is a heading if its font is this much larger than the body text
+HEADING_RATIO = 1.15
+HEADING_MAX_WORDS = 20
+# pages laid out per task; each task parses the PDF once
+PAGES_PER_TASK = 4
+# boxes at either end of a page checked for running headers and footers
+EDGE_BOXES = 2
+_SENTENCE_END = re.compile(r"[.!?:;\"')\]]\s*$")
+_DIGITS = re.compile(r"\d+")
+_PAGE_NUMBER = re.compile(r"^(page\s*)?\d+(\s*(of|/)\s*\d+)?$", re.I)
+
+
+def count_pages(filename):
+    with open(filename, "rb") as f:
+        document = PDFDocument(PDFParser(f))
+        return sum(1 for _ in PDFPage.create_pages(document))
+
+
+def _font_size(box):
+    sizes = [char.size for line in box for char in line
+             if isinstance(char, LTChar)]
+    return statistics.median(sizes) if sizes else 0.0, len(sizes)
+
+
+def _page_boxes(page):
+    boxes = []
+    for element in page:
+        if not isinstance(element, LTTextContainer):
+            continue
+        text = element.get_text().strip()
+        if text:
+            boxes.append((text, _font_size(element)))
+    weighted = [size for _, (size, n) in boxes for _ in range(n)]
+    body = statistics.median(weighted) if weighted else 0.0
+    return [
+        (text, bool(body) and size > body * HEADING_RATIO
+         and len(text.split()) <= HEADING_MAX_WORDS)
+        for text, (size, _) in boxes]
+
+
+def extract_page_range(filename, start, stop, laparams=None):
+    """
+    Text boxes of pages `start` to `stop` (0-based, exclusive), parsing
+    the PDF once.
+
+    Returns:
+        List[List[Tuple[str, bool]]]: per page, ``(text, is_heading)``
+        pairs in reading order.
+    """
+    return [_page_boxes(page) for page in extract_pages(
+        filename, page_numbers=range(start, stop),
+        laparams=laparams or LAParams())]
+
+
+def extract_page(filename, page_number, laparams=None):
+    """ Text boxes of page `page_number` (0-based) in reading order """
+    return extract_page_range(filename, page_number, page_number + 1,
+                              laparams)[0]
+
+
+def _edge_key(text):
+    return _DIGITS.sub("#", " ".join(text.lower().split()))
+
+
+def _continues(previous, text):
+    """ Whether `text` carries on the paragraph `previous` over a page """
+    return (not _SENTENCE_END.search(previous)
+            and text[:1].islower())
+
+
+class _Sectioner(object):
+    """ Numbers sections and paragraphs like CERMINE's JATS output """
+
+    def __init__(self):
+        self.section = 0
+        self.paragraph = 0
+        self.pending = None
+        # texts at the top and bottom of the pages seen so far
+        self.edges = set()
+
+    def _strip_running(self, boxes):
+        """ `boxes` without running headers, footers and page numbers """
+        n = len(boxes)
+        edge = set(range(min(EDGE_BOXES, n))) | set(
+            range(max(n - EDGE_BOXES, 0), n))
+        keys = dict((i, _edge_key(boxes[i][0])) for i in edge)
+        kept = [box for i, box in enumerate(boxes)
+                if i not in edge or not (
+                    keys[i] in self.edges
+                    or _PAGE_NUMBER.match(boxes[i][0].strip()))]
+        self.edges.update(keys.values())
+        return kept
+
+    def _record(self, text, page):
+        record = {
+            'section_id': 'sec-{}'.format(self.section),
+            'paragraph_id': self.paragraph,
+            'text': text,
+            'page': page,
+        }
+        self.paragraph += 1
+        return record
+
+    def feed(self, page, boxes):
+        """ Records completed by the boxes of `page` (1-based) """
+        records = []
+        for i, (text, is_heading) in enumerate(self._strip_running(boxes)):
+            # a paragraph carried over from the previous page keeps its
+            # first page
+            start = page
+            if self.pending is not None:
+                pending_text, pending_page = self.pending
+                if i == 0 and not is_heading and _continues(pending_text,
+                                                            text):
+                    text = pending_text + '\n' + text
+                    start = pending_page
+                else:
+                    records.append(self._record(pending_text, pending_page))
+                self.pending = None
+            if is_heading:
+                self.section += 1
+                self.paragraph = 0
+                continue
+            self.pending = (text, start)
+        return records
+
+    def flush(self):
+        if self.pending is None:
+            return []
+        record = self._record(*self.pending)
+        self.pending = None
+        return [record]
+
+
+def page_ranges(n_pages, pages_per_task=PAGES_PER_TASK):
+    """ ``(start, stop)`` runs of at most `pages_per_task` pages """
+    return [(start, min(start + pages_per_task, n_pages))
+            for start in range(0, n_pages, pages_per_task)]
+
+
+def extract_info(filename, executor=None, max_workers=None,
+                 pages_per_task=PAGES_PER_TASK):
+    """
+    Yield the paragraph records of the PDF `filename`, page by page.
+
+    Args:
+        executor (:class:`concurrent.futures.Executor`): Pool to lay pages
+            out in; a process pool of `max_workers` is created if omitted.
+        max_workers (int): ``0`` lays the pages out in this process, e.g.
+            when documents are already extracted in parallel.
+        pages_per_task (int): Consecutive pages laid out by one task.
+    """
+    tracer = get_tracer()
+    ranges = page_ranges(count_pages(filename), pages_per_task)
+    own_executor = executor is None and max_workers != 0
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+    try:
+        sectioner = _Sectioner()
+        runs = (executor.map if executor is not None else map)(
+            extract_page_range, [filename] * len(ranges),
+            [start for start, _ in ranges], [stop for _, stop in ranges])
+        pages = (boxes for run in runs for boxes in run)
+        for page, boxes in enumerate(
+                tracer.iterate('extract_pdf/page', pages), 1):
+            for record in sectioner.feed(page, boxes):
+                yield record
+        for record in sectioner.flush():
+            yield record
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+@click.command()
+@click.argument('input_filepath', default='data/external', type=click.Path(exists=True))
+@click.argument('metadata_file', default='docs.yml', type=click.File('r'))
+@click.argument('output_filepath', type=click.Path(), default='data/interim/blockchain_papers_dataset/dataset.json')
+@click.option('--workers', default=None, type=int,
+              help='Worker processes; defaults to the number of CPUs.')
+@click.option('--keep-urls', is_flag=True,
+              help='Do not strip URLs while normalizing the text.')
+def main(input_filepath, metadata_file, output_filepath, workers, keep_urls):
+    """ Build the dataset straight from the PDFs in `input_filepath`,
+        without CERMINE.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('extracting pdfs from %s into %s', input_filepath,
+                output_filepath)
+    catalog = Catalog.compile(metadata_file.name, catalog_path(output_filepath))
+    normalizer = Normalizer(urls=not keep_urls)
+
+    store = PDFStore(input_filepath)
+    sink = write_to_dataset(output_filepath)
+    sink.__next__()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for filename in sorted(os.listdir(input_filepath)):
+            if not filename.endswith('.pdf'):
+                continue
+            filepath = os.path.join(input_filepath, filename)
+            logger.info('Processing %s', filepath)
+            doc_id = catalog.doc_id(filename)
+            try:
+                store.check(filepath)
+                # held back until the whole document is extracted
+                paragraphs = list(normalizer.records(
+                    extract_info(filepath, executor)))
+            except Exception as e:
+                logger.error('%s left out: %s', filepath, e)
+                continue
+            for paragraph in paragraphs:
+                paragraph['doc_id'] = doc_id
+                sink.send(paragraph)
+    sink.close()
+    logger.info('finished')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -7,7 +7,11 @@ from dotenv import find_dotenv, load_dotenv
 
 import spacy
 import textacy
-from blockchain_dataset import BlockchainPapersDataset
+from src.data.blockchain_dataset import BlockchainPapersDataset
+from src.data.chunking import Chunker, length_batches
+from src.data.quality import QualityFilter, threshold_option
+from src.profiling import enable as enable_tracing
+from src.profiling import get_tracer
 
 # en = textacy.load_spacy_lang("en_core_web_lg")
 # patterns = [
@@ -63,7 +67,7 @@ tech = {
 
 def _safe_add_pipe(lang, pipename, pipe):
     try:
-        lang.remove_pipe(name='pipename')
+        lang.remove_pipe(name=pipename)
     except ValueError as e:
         pass
     lang.add_pipe(pipe, name=pipename)
@@ -72,7 +76,8 @@ def _safe_add_pipe(lang, pipename, pipe):
 
 def prepare_lang(lang="en_core_web_lg"):
     from spacy.pipeline import EntityRuler
-    nlp = spacy.load('en_core_web_lg')
+    # a loaded pipeline (e.g. ``spacy.blank('en')``) can be passed as is
+    nlp = spacy.load(lang) if isinstance(lang, str) else lang
     ruler = EntityRuler(nlp)
     # define the pattern
     patterns = [dict(label = 'ORG', pattern=l) for k in entities for l in entities[k]]
@@ -87,32 +92,91 @@ def prepare_lang(lang="en_core_web_lg"):
     # add the matcher object as a new pipe to the model
     nlp = _safe_add_pipe(nlp, 'tech', ruler)
 
-    return nlp
+    return get_tracer().instrument(nlp)
     
 
-def create_corpus(lang="en_core_web_lg"):
+def _chunked_records(records, chunker, sort_by_length=False):
+    """ (text, metadata) pairs of chunks, in dataset order unless
+        `sort_by_length`; the metadata ``spans`` map offsets back to
+        paragraphs, see chunking.locate """
+    chunks = chunker.chunks(records)
+    if sort_by_length:
+        chunks = (c for batch in length_batches(chunks) for c in batch)
+    for chunk in chunks:
+        yield chunk.pop('text'), chunk
+
+
+def create_corpus(lang="en_core_web_lg", dataset=None, chunker=None,
+                  prefilter=None, sort_by_length=False):
+    """
+    Args:
+        sort_by_length (bool): Feed chunks to the pipeline in batches of
+            similar length (see chunking.length_batches), which is faster
+            but leaves the corpus documents out of dataset order.
+    """
     # nlp = en
     # component = entities.FinancialEntityRecognizer(nlp, entitites._financial_institutions)  # initialise component
     # en.add_pipe(component, before="ner")
-    bpd = BlockchainPapersDataset()
-    corpus = textacy.Corpus(lang, data=bpd.records())
+    tracer = get_tracer()
+    bpd = dataset if dataset is not None else BlockchainPapersDataset()
+    if chunker is None and prefilter is None:
+        records = bpd.records()
+    else:
+        records = iter(bpd)
+        if prefilter is not None:
+            records = prefilter.records(records)
+        if chunker is not None:
+            records = _chunked_records(records, chunker, sort_by_length)
+        else:
+            records = ((r.pop('text'), r) for r in records)
+    records = tracer.iterate('make_corpus/read_records', records)
+    with tracer.stage('make_corpus/corpus') as span:
+        corpus = textacy.Corpus(lang, data=records)
+        span.count(len(corpus))
     return corpus
 
 
 
 @click.command()
 @click.argument('corpus_filename', default='data/processed/corpus.acy', type=click.Path())
-def main(corpus_filename):
+@click.option('--trace', 'trace_filename', default=None, type=click.Path(),
+              help='Profile the run and write the trace to this file.')
+@click.option('--max-chars', default=2000,
+              help='Split longer paragraphs at sentence ends.')
+@click.option('--min-chars', default=100,
+              help='Merge shorter fragments into a neighbouring paragraph.')
+@click.option('--chunk', is_flag=True,
+              help='Split long paragraphs and merge short fragments; by '
+                   'default one corpus document per dataset paragraph.')
+@click.option('--sort-by-length', is_flag=True,
+              help='Group chunks of similar length; faster, but corpus '
+                   'documents are no longer in dataset order.')
+@click.option('--drop-junk', is_flag=True,
+              help='Leave out paragraphs the quality prefilter rejects '
+                   '(they are only labelled otherwise).')
+@click.option('--threshold', multiple=True, callback=threshold_option,
+              help='Override a prefilter threshold, e.g. min_chars=60.')
+def main(corpus_filename, trace_filename, max_chars, min_chars, chunk,
+         sort_by_length, drop_junk, threshold):
     """ Runs data processing scripts to \turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
     logger.info('Create corpus')
     logger.info(os.path.abspath(corpus_filename))
-
-    dlt_en = prepare_lang()
-    corpus = create_corpus(lang=dlt_en)
-    corpus.save(corpus_filename)
+    if trace_filename:
+        enable_tracing(trace_filename)
+
+    with get_tracer().stage('make_corpus/load_lang'):
+        dlt_en = prepare_lang()
+    prefilter = QualityFilter(drop=drop_junk, **threshold)
+    chunker = Chunker(max_chars, min_chars,
+                      labeler=prefilter.label) if chunk else None
+    corpus = create_corpus(lang=dlt_en, chunker=chunker, prefilter=prefilter,
+                           sort_by_length=sort_by_length)
+    prefilter.log_report()
+    with get_tracer().stage('make_corpus/save'):
+        corpus.save(corpus_filename)
 
 
     
@@ -7,31 +7,38 @@ from dotenv import find_dotenv, load_dotenv
 from io import StringIO
 import os
 import re
-import textacy
-import ftfy
 import json
 import yaml
 from bs4 import BeautifulSoup
 
+from src.data.catalog import Catalog, catalog_path
+from src.data.normalize import DEFAULT_NORMALIZER, Normalizer
+from src.data.pdf_store import IntegrityError, PDFStore
+from src.profiling import enable as enable_tracing
+from src.profiling import get_tracer
+
 def get_title(soup):
     return soup.select('article-title')
 
 def extract_info(filename):
     """ Extract all info from articles """
+    tracer = get_tracer()
     with open(filename) as f:
-        xmla = f.read()
-        soup = BeautifulSoup(xmla, features="lxml")
+        with tracer.stage('make_dataset/parse_xml') as span:
+            xmla = f.read()
+            soup = BeautifulSoup(xmla, features="lxml")
+            span.count()
         title = get_title(soup) # FIXME
         # print(title)
-        for p in get_paragraphs(soup):
+        paragraphs = tracer.iterate('make_dataset/paragraphs',
+                                    get_paragraphs(soup))
+        for p in paragraphs:
             # p['title'] = title
             # print(p)
             yield p
 
 def scrub(paragraph):
-    txt = ftfy.fixes.fix_line_breaks(paragraph['text'])
-    txt = textacy.preprocess.normalize_whitespace(txt)
-    return txt
+    return DEFAULT_NORMALIZER(paragraph['text'])
 
 def get_paragraphs(soup):
     """ Extract text from paragraphs """
@@ -43,7 +50,8 @@ def get_paragraphs(soup):
             yield {
                 'section_id': sec['id'],
                 'paragraph_id': i,
-                'text': p.get_text(" ", strip=True).replace('\n', ' ')}
+                # line breaks are kept for normalize to repair hyphenation
+                'text': p.get_text(" ", strip=True)}
 
 
 def write_to_dataset(dataset_filename): 
@@ -56,9 +64,10 @@ def write_to_dataset(dataset_filename):
         try: 
             while True: 
                 paragraph = (yield) 
-                pt = json.dumps(paragraph)
-                f.write(pt)
-                f.write('\n')
+                with get_tracer().stage('make_dataset/write', event=False):
+                    pt = json.dumps(paragraph)
+                    f.write(pt)
+                    f.write('\n')
         except GeneratorExit: 
             logging.info("Finalized dataset!") 
 
@@ -75,7 +84,14 @@ def load_metadata(yaml_file, metadata_path : str ='pdfs'):
 @click.argument('input_filepath', default='data/processed', type=click.Path(exists=True))
 @click.argument('metadata_file', default='docs.yml', type=click.File('r'))
 @click.argument('output_filepath', type=click.Path(), default='data/interim/blockchain_papers_dataset/dataset.json')
-def main(input_filepath, metadata_file, output_filepath):
+@click.option('--trace', 'trace_filename', default=None, type=click.Path(),
+              help='Profile the run and write the trace to this file.')
+@click.option('--keep-urls', is_flag=True,
+              help='Do not strip URLs while normalizing the text.')
+@click.option('--external-dir', default='data/external', type=click.Path(),
+              help='The PDFs CERMINE read, checked against the PDF store.')
+def main(input_filepath, metadata_file, output_filepath, trace_filename,
+         keep_urls, external_dir):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
@@ -83,8 +99,13 @@ def main(input_filepath, metadata_file, output_filepath):
     logger.info('making final data set from raw data')
     logger.info(input_filepath)
     logger.info(output_filepath)
+    if trace_filename:
+        enable_tracing(trace_filename)
+    tracer = get_tracer()
 
-    metadata = load_metadata(metadata_file)
+    # records only carry the doc_id; docs.yml is compiled into the catalog
+    catalog = Catalog.compile(metadata_file.name, catalog_path(output_filepath))
+    normalizer = Normalizer(urls=not keep_urls)
 
     sink = write_to_dataset(output_filepath)
     sink.__next__()
@@ -96,11 +117,21 @@ def main(input_filepath, metadata_file, output_filepath):
         filepath = os.path.join(input_filepath, filename)
         if not os.path.isfile(filepath): continue
 
+        pdf = os.path.join(external_dir, name + ".pdf")
+        if os.path.isfile(pdf):
+            try:
+                PDFStore(external_dir).check(pdf)
+            except IntegrityError as e:
+                logger.error("%s left out: %s", filepath, e)
+                continue
+
         logging.info("Processing " + filepath)
-        meta = metadata.get(name + ".pdf", {})
-        for paragraph in extract_info(filepath):
-            paragraph.update(meta)
-            sink.send(paragraph)
+        doc_id = catalog.doc_id(name + ".pdf")
+        with tracer.stage('make_dataset/document') as span:
+            for paragraph in normalizer.records(extract_info(filepath)):
+                paragraph['doc_id'] = doc_id
+                sink.send(paragraph)
+                span.count()
     sink.close()
 
     logger.info("finished")
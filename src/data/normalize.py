@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Text Normalization
+------------------
+The one place where paragraph text is cleaned up, applied once while the
+dataset is built (``make_dataset`` / ``extract_pdf``) instead of in every
+downstream stage.
+
+Steps, each of which can be switched off:
+    * ``unicode``: mojibake and unicode fixes with :func:`ftfy.fix_text`.
+    * ``hyphenation``: joins words hyphenated over a PDF line break
+      (``distrib-\\nuted`` -> ``distributed``), but keeps the hyphen of
+      compounds broken at their hyphen (``peer-\\nto-peer``,
+      ``blockchain-\\nbased``): those whose halves carry further hyphens
+      or end in a common compound element, and those the same batch of
+      text spells with a hyphen elsewhere.
+    * ``urls``: removes URLs.
+    * ``whitespace``: line breaks, tabs and unicode spaces become single
+      spaces; leading and trailing space is stripped.
+
+Normalized records carry a ``normalization`` tag such as
+``"2:unicode,hyphenation,urls,whitespace"``; :func:`is_normalized` lets a
+downstream stage check it and skip its own cleanup.
+"""
+import re
+
+import ftfy
+
+from src.profiling import get_tracer
+
+NORMALIZATION_VERSION = "2"
+STEPS = ("unicode", "hyphenation", "urls", "whitespace")
+
+# records are normalized in batches; the texts of a batch are joined with
+# this separator so each pattern runs once per batch
+_SEPARATOR = "\x00"
+
+_HYPHENATION_RE = re.compile(
+    r"((?:[^\W\d_]+-)*[^\W\d_]+)-[ \t]*\n[ \t]*([a-z]+(?:-[^\W\d_]+)*)")
+_WORD_RE = re.compile(r"[^\W\d_]+(?:-[^\W\d_]+)*")
+# second halves that make a compound rather than end a split word
+_COMPOUND_ELEMENTS = frozenset((
+    "backed", "based", "border", "centric", "driven", "enabled", "free",
+    "friendly", "level", "linked", "oriented", "party", "related", "scale",
+    "specific", "term", "wide",
+))
+_URL_RE = re.compile(
+    r"(?:https?://|ftp://|www\.)[^\s\x00<>\"]+[^\s\x00<>\".,;:!?)\]']")
+_WHITESPACE_RE = re.compile(r"[^\S\x00]+")
+_EDGE_SPACE_RE = re.compile(r" ?\x00 ?")
+
+
+class Normalizer(object):
+    """
+    Configurable text normalization with precompiled patterns.
+
+    Args:
+        unicode, hyphenation, urls, whitespace (bool): Steps to apply.
+    """
+
+    def __init__(self, unicode=True, hyphenation=True, urls=True,
+                 whitespace=True):
+        self.steps = tuple(step for step, on in zip(
+            STEPS, (unicode, hyphenation, urls, whitespace)) if on)
+
+    @property
+    def version(self):
+        """ str: tag stored with the records this normalizer produced """
+        return "{}:{}".format(NORMALIZATION_VERSION, ",".join(self.steps))
+
+    def __call__(self, text):
+        return self.batch([text])[0]
+
+    def batch(self, texts):
+        """ Normalize a list of texts; returns a list of the same length """
+        tracer = get_tracer()
+        texts = list(texts)
+        if not texts:
+            return []
+        if "unicode" in self.steps:
+            with tracer.stage("normalize/unicode", event=False) as span:
+                texts = [ftfy.fix_text(t) for t in texts]
+                span.count(len(texts))
+        joined = _SEPARATOR.join(t.replace(_SEPARATOR, " ") for t in texts)
+        if "hyphenation" in self.steps:
+            with tracer.stage("normalize/hyphenation", event=False) as span:
+                joined = _dehyphenate(joined)
+                span.count(len(texts))
+        if "urls" in self.steps:
+            with tracer.stage("normalize/urls", event=False) as span:
+                joined = _URL_RE.sub(" ", joined)
+                span.count(len(texts))
+        if "whitespace" in self.steps:
+            with tracer.stage("normalize/whitespace", event=False) as span:
+                joined = _WHITESPACE_RE.sub(" ", joined)
+                joined = _EDGE_SPACE_RE.sub(_SEPARATOR, joined).strip(" ")
+                span.count(len(texts))
+        return joined.split(_SEPARATOR)
+
+    def records(self, records, batch_size=256, field="text"):
+        """
+        Normalize the `field` of dataset `records` in batches, tagging each
+        with :attr:`version`. Yields the records in order.
+        """
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                for normalized in self._apply(batch, field):
+                    yield normalized
+                batch = []
+        for normalized in self._apply(batch, field):
+            yield normalized
+
+    def _apply(self, batch, field):
+        with get_tracer().stage("normalize", event=False) as span:
+            texts = self.batch(r.get(field, "") for r in batch)
+            span.count(len(batch))
+        for record, text in zip(batch, texts):
+            record[field] = text
+            record["normalization"] = self.version
+        return batch
+
+
+def _dehyphenate(text):
+    """ Repair the words of `text` hyphenated over a line break """
+    if _HYPHENATION_RE.search(text) is None:
+        return text
+    words = set(w.lower() for w in _WORD_RE.findall(text))
+
+    def join(match):
+        left, right = match.group(1), match.group(2)
+        compound = "{}-{}".format(left, right)
+        if ("-" in left or "-" in right
+                or right.lower() in _COMPOUND_ELEMENTS
+                or (compound.lower() in words
+                    and (left + right).lower() not in words)):
+            return compound
+        return left + right
+
+    return _HYPHENATION_RE.sub(join, text)
+
+
+DEFAULT_NORMALIZER = Normalizer()
+
+
+def is_normalized(record, required=("whitespace",)):
+    """
+    Whether `record` went through the current normalization with at least
+    the `required` steps.
+    """
+    tag = record.get("normalization")
+    if not tag:
+        return False
+    version, _, steps = tag.partition(":")
+    return (version == NORMALIZATION_VERSION
+            and set(required) <= set(steps.split(",")))
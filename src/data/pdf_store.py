@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Content-Addressed PDF Store
+---------------------------
+Downloaded PDFs are stored once per content, under their SHA-256::
+
+    data/raw/pdf_store/
+        index.json                  <- per url: ETag, Last-Modified, sha256;
+                                       per filename: sha256
+        blobs/3f/3f9a...e1.pdf
+
+and every docs.yml ``filename`` in ``data/external`` is a hard link to its
+blob (a symbolic link, or a copy, where hard links are not possible), so
+the extraction scripts read ``data/external`` as before. The same document
+listed twice, or under a renamed URL, takes the space of one.
+
+Refreshes send ``If-None-Match`` / ``If-Modified-Since`` with the validators
+of the previous download; a ``304 Not Modified`` leaves the link untouched,
+and a changed document only replaces the link when its content differs, so
+the pipeline's content-keyed extraction stages stay cached.
+:meth:`PDFStore.check` verifies a file against the digest it was stored
+under before it is extracted.
+
+Writers of ``index.json`` (fetches, ``verify``, ``prune``) hold an
+exclusive ``fcntl`` lock on ``index.json.lock`` for the read-modify-write,
+so pipeline worker processes and concurrent scripts sharing the store do
+not lose each other's entries.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+INDEX = "index.json"
+BLOBS = "blobs"
+USER_AGENT = "nlp_blockchain_institutions"
+_BLOB_RE = re.compile(r"^[0-9a-f]{64}\.pdf$")
+
+Fetch = collections.namedtuple("Fetch", ["status", "sha256", "filename"])
+
+# one lock per store directory, shared by the threads of a process
+_locks = collections.defaultdict(threading.Lock)
+
+
+class IntegrityError(ValueError):
+    """ A file does not match the digest it was stored under """
+
+
+def _sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PDFStore(object):
+    """
+    Args:
+        links_dir (str): Directory holding the docs.yml filenames.
+        store_dir (str): Blob store; ``raw/pdf_store`` next to `links_dir`
+            by default.
+        timeout (float): Seconds to wait for a server.
+    """
+
+    def __init__(self, links_dir="data/external", store_dir=None, timeout=60):
+        self.links_dir = links_dir
+        self.store_dir = store_dir or os.path.join(
+            os.path.dirname(os.path.abspath(links_dir)), "raw", "pdf_store")
+        self.timeout = timeout
+        self._lock = _locks[os.path.abspath(self.store_dir)]
+        # url -> sha256 of what this instance already fetched
+        self._fetched = {}
+        os.makedirs(os.path.join(self.store_dir, BLOBS), exist_ok=True)
+        os.makedirs(self.links_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.store_dir, BLOBS, sha256[:2],
+                            sha256 + ".pdf")
+
+    def _read_index(self):
+        path = os.path.join(self.store_dir, INDEX)
+        if not os.path.isfile(path):
+            return {"urls": {}, "files": {}}
+        with open(path) as f:
+            return json.load(f)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Exclusive access to the index, across threads and processes """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.store_dir, INDEX + ".lock"),
+                      "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_index(self, index):
+        path = os.path.join(self.store_dir, INDEX)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    @property
+    def index(self):
+        # replaced atomically, so reading needs no lock (which a forked
+        # worker process may have inherited in the locked state)
+        return self._read_index()
+
+    def _request(self, url, validators):
+        headers = {"User-Agent": USER_AGENT}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers),
+            timeout=self.timeout)
+
+    def _download(self, response):
+        """ Stream `response` into the store; returns its sha256 """
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(suffix=".part",
+                                   dir=os.path.join(self.store_dir, BLOBS))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: response.read(1 << 16), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.chmod(tmp, 0o644)  # mkstemp creates files private
+            sha256 = digest.hexdigest()
+            blob = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, blob)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sha256
+
+    def link(self, filename, sha256):
+        """
+        Point `filename` in the links directory at blob `sha256`.
+
+        Returns:
+            bool: False if it already did.
+        """
+        blob = self.blob_path(sha256)
+        path = os.path.join(self.links_dir, filename)
+        if os.path.exists(path) and (
+                os.path.samefile(path, blob)
+                or (not os.path.islink(path)
+                    and os.path.getsize(path) == os.path.getsize(blob)
+                    and _sha256(path) == sha256)):
+            return False
+        tmp = path + ".link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(blob), tmp)
+            except OSError:
+                shutil.copyfile(blob, tmp)
+        os.replace(tmp, path)
+        return True
+
+    def fetch(self, url, filename, refresh=True):
+        """
+        Make `filename` hold the current content of `url`.
+
+        Args:
+            refresh (bool): Revalidate with the server even if `filename`
+                is already stored; otherwise only fetch missing documents.
+
+        Returns:
+            :class:`Fetch`: ``status`` is ``"downloaded"`` (new content),
+            ``"unchanged"`` (downloaded, same content as before),
+            ``"not_modified"`` (304) or ``"cached"`` (no request made).
+        """
+        logger = logging.getLogger(__name__)
+        index = self.index
+        known = index["urls"].get(url, {})
+        stored = known.get("sha256")
+        if stored and not os.path.isfile(self.blob_path(stored)):
+            known, stored = {}, None
+        if stored and (url in self._fetched or not refresh):
+            self.link(filename, stored)
+            self._record(url, known, filename, stored)
+            return Fetch("cached", stored, filename)
+        try:
+            response = self._request(url, known if stored else {})
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not stored:
+                raise
+            logger.info("not modified: %s", url)
+            self.link(filename, stored)
+            self._record(url, known, filename, stored)
+            self._fetched[url] = stored
+            return Fetch("not_modified", stored, filename)
+        with response:
+            logger.info("downloading %s", url)
+            sha256 = self._download(response)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        changed = self.link(filename, sha256)
+        self._record(url, validators, filename, sha256)
+        self._fetched[url] = sha256
+        status = "downloaded" if changed or sha256 != stored else "unchanged"
+        return Fetch(status, sha256, filename)
+
+    def _record(self, url, validators, filename, sha256):
+        with self._locked():
+            index = self._read_index()
+            index["urls"][url] = {
+                "etag": validators.get("etag"),
+                "last_modified": validators.get("last_modified"),
+                "sha256": sha256,
+                "checked": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            index["files"][filename] = sha256
+            self._write_index(index)
+
+    def check(self, path):
+        """
+        Verify `path` (a file in the links directory, or a blob) against the
+        digest it was stored under.
+
+        Raises:
+            IntegrityError: on a mismatch. Files the store does not know
+                are not checked.
+        """
+        name = os.path.basename(path)
+        sha256 = self.index["files"].get(name)
+        if sha256 is None and _BLOB_RE.match(name):
+            sha256 = name[:-len(".pdf")]
+        if sha256 is None:
+            return
+        actual = _sha256(path)
+        if actual != sha256:
+            raise IntegrityError("{} has sha256 {}, stored as {}".format(
+                path, actual, sha256))
+
+    def verify(self, repair=True):
+        """
+        Re-hash every blob. With `repair`, corrupt blobs are deleted and
+        forgotten so the next fetch downloads them again unconditionally,
+        and the files of the links directory holding their content (hard
+        links share it, symbolic links point at the deleted blob) are
+        removed, so nothing extracts them in the meantime.
+
+        Returns:
+            List[str]: digests of the corrupt blobs.
+        """
+        logger = logging.getLogger(__name__)
+        corrupt = []
+        blobs_dir = os.path.join(self.store_dir, BLOBS)
+        for root, _, names in os.walk(blobs_dir):
+            for name in names:
+                if not name.endswith(".pdf"):
+                    continue
+                sha256 = name[:-len(".pdf")]
+                if _sha256(os.path.join(root, name)) != sha256:
+                    logger.error("corrupt blob %s", sha256)
+                    corrupt.append(sha256)
+        if repair and corrupt:
+            with self._locked():
+                index = self._read_index()
+                for sha256 in corrupt:
+                    for filename, stored in list(index["files"].items()):
+                        if stored == sha256 and self._unlink_bad(filename,
+                                                                 sha256):
+                            logger.warning("removed %s, which held corrupt "
+                                           "blob %s", filename, sha256)
+                            del index["files"][filename]
+                    os.remove(self.blob_path(sha256))
+                    for url, entry in list(index["urls"].items()):
+                        if entry["sha256"] == sha256:
+                            del index["urls"][url]
+                self._write_index(index)
+        return corrupt
+
+    def _unlink_bad(self, filename, sha256):
+        """ Remove `filename` from the links directory unless it is an
+            intact copy of blob `sha256`; True if it was removed """
+        path = os.path.join(self.links_dir, filename)
+        if not os.path.lexists(path):
+            return True
+        if os.path.islink(path) or _sha256(path) != sha256:
+            os.remove(path)
+            return True
+        return False
+
+    def prune(self):
+        """ Delete blobs no filename refers to; returns their digests """
+        with self._locked():
+            index = self._read_index()
+            referenced = set(index["files"].values())
+            removed = []
+            for root, _, names in os.walk(os.path.join(self.store_dir, BLOBS)):
+                for name in names:
+                    if (name.endswith(".pdf")
+                            and name[:-len(".pdf")] not in referenced):
+                        os.remove(os.path.join(root, name))
+                        removed.append(name[:-len(".pdf")])
+            index["urls"] = dict((u, e) for u, e in index["urls"].items()
+                                 if e["sha256"] in referenced)
+            self._write_index(index)
+        return removed
+
+
+@click.group()
+@click.option('--links-dir', default='data/external', type=click.Path())
+@click.option('--store-dir', default=None, type=click.Path())
+@click.pass_context
+def cli(ctx, links_dir, store_dir):
+    """ Maintain the content-addressed PDF store """
+    ctx.obj = PDFStore(links_dir, store_dir)
+
+
+@cli.command()
+@click.pass_obj
+def verify(store):
+    """ Re-hash all blobs, dropping corrupt ones """
+    corrupt = store.verify()
+    click.echo("{} corrupt blobs".format(len(corrupt)))
+    if corrupt:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.pass_obj
+def prune(store):
+    """ Delete blobs no docs.yml filename links to """
+    click.echo("{} blobs removed".format(len(store.prune())))
+
+
+@cli.command()
+@click.pass_obj
+def stats(store):
+    """ Show how much space content addressing saves """
+    index = store.index
+    blobs = set(index["files"].values())
+    size = sum(os.path.getsize(store.blob_path(b)) for b in blobs
+               if os.path.isfile(store.blob_path(b)))
+    click.echo("{} filenames, {} urls, {} blobs, {:.1f} MiB".format(
+        len(index["files"]), len(index["urls"]), len(blobs), size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Paragraph Quality Prefilter
+---------------------------
+CERMINE output contains table fragments, reference lists, running page
+headers and passages in other languages, all of which would otherwise go
+through ``en_core_web_lg`` at full cost. :class:`QualityFilter` labels
+every paragraph with cheap heuristics before the spaCy stages and can drop
+the ones that are not prose:
+
+    * ``short``: fewer than ``min_chars`` characters.
+    * ``header``: the same text (digits ignored) occurs at least
+      ``header_min_repeats`` times in a document, as running headers and
+      footers do.
+    * ``references``: more than ``max_reference_density`` citations
+      (author and year, "[n]" markers, page numbers), DOIs or "et al." per
+      100 tokens; years alone, as in prose, do not count.
+    * ``numeric``: share of digits among non-space characters above
+      ``max_digit_ratio`` (table cells, figures).
+    * ``punctuation``: share of punctuation above ``max_punct_ratio``.
+    * ``tokens``: mean token length outside ``[min_mean_token,
+      max_mean_token]`` (hyphenation debris, glued words, code).
+    * ``non_english``: share of English stop words among the words below
+      ``min_stopword_ratio``.
+
+Paragraphs passing all checks are labelled ``ok``. Labels are stored in the
+``quality`` field; per document, :attr:`QualityFilter.report` counts the
+paragraphs and characters labelled as junk, i.e. the NLP work avoided when
+they are dropped.
+"""
+import collections
+import itertools
+import json
+import logging
+import re
+import string
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+from src.profiling import get_tracer
+
+OK = "ok"
+LABELS = (OK, "short", "header", "references", "numeric", "punctuation",
+          "tokens", "non_english")
+
+DEFAULT_THRESHOLDS = {
+    "min_chars": 40,
+    "header_min_repeats": 3,
+    "header_max_chars": 200,
+    "max_digit_ratio": 0.3,
+    "max_punct_ratio": 0.15,
+    "min_mean_token": 3.0,
+    "max_mean_token": 12.0,
+    "max_reference_density": 8.0,
+    "min_stopword_ratio": 0.12,
+}
+
+# the most frequent English function words; prose has 35-50% of them
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been but by can could do
+does for from had has have he her his if in into is it its may more most
+no not of on one only or other our out over same should so some such than
+that the their them then there these they this those through to under up
+us was we were what when where which while who will with would you
+""".split())
+
+_PUNCTUATION_RE = re.compile(
+    "[" + re.escape(string.punctuation + "–—‘’“”•·") + "]")
+_SPACE_RE = re.compile(r"\s")
+_DIGIT_RE = re.compile(r"\d")
+_WORD_RE = re.compile(r"[^\W\d_]+")
+_REFERENCE_RE = re.compile(r"""
+    # Nakamoto, 2008 / Nakamoto, S. (2008) / Smith et al. (2017)
+    (?:[A-Z][^\W\d_]+|[A-Z]\.)
+    (?:\s+et\ al\.?|\s+(?:and|&)\s+[A-Z][^\W\d_]+)?
+    (?:,\s*|\s*\()(?:1[89]|20)\d\d[a-z]?\b
+  | \[\d+(?:\s*[,–-]\s*\d+)*\]           # [3], [4, 7], [1-5]
+  | \bpp?\.\s*\d+                        # p. 12, pp. 3-9
+  | \b(?i:doi)\b | \bet\ al\b
+""", re.VERBOSE)
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def features(text):
+    """ Cheap per-paragraph statistics the labels are based on """
+    n_chars = (len(text) - len(_SPACE_RE.findall(text))) or 1
+    tokens = text.split()
+    n_tokens = len(tokens) or 1
+    words = [w.lower() for w in _WORD_RE.findall(text)]
+    return {
+        "chars": len(text),
+        "tokens": len(tokens),
+        "digit_ratio": len(_DIGIT_RE.findall(text)) / n_chars,
+        "punct_ratio": len(_PUNCTUATION_RE.findall(text)) / n_chars,
+        "mean_token": sum(len(t) for t in tokens) / n_tokens,
+        "reference_density": (
+            100.0 * len(_REFERENCE_RE.findall(text)) / n_tokens),
+        "stopword_ratio": (
+            sum(w in STOPWORDS for w in words) / len(words) if words else 0.0),
+    }
+
+
+def _header_key(text):
+    return _DIGITS_RE.sub("#", " ".join(text.lower().split()))
+
+
+class QualityFilter(object):
+    """
+    Args:
+        drop (bool): Leave out paragraphs not labelled ``ok`` instead of
+            only labelling them.
+        field (str): Record field holding the text.
+        **thresholds: Overrides of :data:`DEFAULT_THRESHOLDS`.
+
+    Attributes:
+        report (Dict[str, dict]): per filename, the ``paragraphs`` and
+            ``chars`` seen, how many of them were not labelled ``ok``
+            (``junk_paragraphs``, ``junk_chars``) and a count per label.
+    """
+
+    def __init__(self, drop=False, field="text", **thresholds):
+        unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+        if unknown:
+            raise ValueError("unknown thresholds: {}".format(
+                ", ".join(sorted(unknown))))
+        self.drop = drop
+        self.field = field
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **thresholds)
+        self.report = collections.OrderedDict()
+
+    def label(self, text, repeats=1):
+        """ Label of a paragraph `text` seen `repeats` times in its file """
+        t = self.thresholds
+        if len(text) < t["min_chars"]:
+            return "short"
+        if (repeats >= t["header_min_repeats"]
+                and len(text) <= t["header_max_chars"]):
+            return "header"
+        f = features(text)
+        if f["reference_density"] > t["max_reference_density"]:
+            return "references"
+        if f["digit_ratio"] > t["max_digit_ratio"]:
+            return "numeric"
+        if f["punct_ratio"] > t["max_punct_ratio"]:
+            return "punctuation"
+        if not t["min_mean_token"] <= f["mean_token"] <= t["max_mean_token"]:
+            return "tokens"
+        if f["stopword_ratio"] < t["min_stopword_ratio"]:
+            return "non_english"
+        return OK
+
+    def label_document(self, records):
+        """ Label the paragraph records of one file in place """
+        records = list(records)
+        texts = [r.get(self.field) or "" for r in records]
+        repeats = collections.Counter(_header_key(t) for t in texts)
+        for record, text in zip(records, texts):
+            record["quality"] = self.label(text, repeats[_header_key(text)])
+        return records
+
+    def records(self, records):
+        """
+        Label dataset `records` and yield them, or only the ``ok`` ones if
+        :attr:`drop` is set. Each run of records of a filename is labelled
+        together, so only one document is held in memory; headers are
+        recognized within a run.
+        """
+        tracer = get_tracer()
+        for filename, group in itertools.groupby(
+                records, key=lambda r: r.get("filename")):
+            with tracer.stage("quality/label", event=False) as span:
+                labelled = self.label_document(group)
+                span.count(len(labelled))
+            self._account(filename, labelled)
+            for record in labelled:
+                if not self.drop or record["quality"] == OK:
+                    yield record
+
+    def _account(self, filename, records):
+        entry = self.report.setdefault(filename, collections.OrderedDict(
+            [("paragraphs", 0), ("chars", 0), ("junk_paragraphs", 0),
+             ("junk_chars", 0), ("labels", collections.Counter())]))
+        for record in records:
+            n = len(record.get(self.field) or "")
+            entry["paragraphs"] += 1
+            entry["chars"] += n
+            entry["labels"][record["quality"]] += 1
+            if record["quality"] != OK:
+                entry["junk_paragraphs"] += 1
+                entry["junk_chars"] += n
+
+    def log_report(self):
+        """ Log per document how much NLP work was (or can be) avoided """
+        logger = logging.getLogger(__name__)
+        verb = "dropped" if self.drop else "junk"
+        total = collections.Counter()
+        for filename, entry in self.report.items():
+            junk = ", ".join("{} {}".format(label, n) for label, n in
+                             entry["labels"].most_common() if label != OK)
+            logger.info("%-60s %5d/%5d paragraphs, %7d/%8d chars %s %s",
+                        filename, entry["junk_paragraphs"],
+                        entry["paragraphs"], entry["junk_chars"],
+                        entry["chars"], verb,
+                        "({})".format(junk) if junk else "")
+            for key in ("paragraphs", "chars", "junk_paragraphs",
+                        "junk_chars"):
+                total[key] += entry[key]
+        if total["chars"]:
+            logger.info("NLP work %s: %d of %d paragraphs, %.1f%% of the "
+                        "characters", "avoided" if self.drop else "avoidable",
+                        total["junk_paragraphs"],
+                        total["paragraphs"],
+                        100.0 * total["junk_chars"] / total["chars"])
+
+
+def parse_thresholds(values):
+    """
+    ``["max_digit_ratio=0.4", ...]`` -> threshold overrides
+
+    Raises:
+        ValueError: on an unknown threshold or a value of the wrong type.
+    """
+    thresholds = {}
+    for value in values:
+        name, _, number = value.partition("=")
+        if name not in DEFAULT_THRESHOLDS:
+            raise ValueError("unknown threshold {}".format(name))
+        kind = type(DEFAULT_THRESHOLDS[name])
+        try:
+            thresholds[name] = kind(number)
+        except ValueError:
+            raise ValueError("{} must be {} {}, got {!r}".format(
+                name, "an" if kind is int else "a", kind.__name__, number))
+    return thresholds
+
+
+def threshold_option(ctx, param, values):
+    """ click callback: :func:`parse_thresholds` of a ``--threshold`` """
+    try:
+        return parse_thresholds(values)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@click.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.option('--output', 'output_filename', default=None, type=click.Path(),
+              help='Write the labelled (or filtered) records here.')
+@click.option('--report', 'report_filename', default=None, type=click.Path(),
+              help='Write the per-document report as json.')
+@click.option('--drop', is_flag=True, help='Leave out junk paragraphs.')
+@click.option('--threshold', multiple=True, callback=threshold_option,
+              help='Override a threshold, e.g. max_digit_ratio=0.4.')
+def main(dataset_filename, output_filename, report_filename, drop, threshold):
+    """ Label the paragraphs of the dataset by quality """
+    from src.data.make_dataset import write_to_dataset
+    from src.data.records import read_dataset
+    prefilter = QualityFilter(drop=drop, **threshold)
+    records = prefilter.records(read_dataset(dataset_filename))
+    if output_filename:
+        sink = write_to_dataset(output_filename)
+        sink.__next__()
+        for record in records:
+            sink.send(record)
+        sink.close()
+    else:
+        for _ in records:
+            pass
+    prefilter.log_report()
+    if report_filename:
+        with open(report_filename, 'w') as f:
+            json.dump(prefilter.report, f, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Dataset Records
+---------------
+Reading ``dataset.json`` (one json record per paragraph) with the docs.yml
+metadata of every record joined in from the catalog, and the helpers the
+feature builders share to key and group those records. The feature
+modules (:mod:`src.features`) import them from here.
+"""
+import collections
+import json
+
+from src.data.catalog import join_metadata
+
+
+def read_dataset(dataset_filename):
+    """ Stream records from a dataset file, one json per line, with the
+        docs.yml metadata of their ``doc_id`` joined in from the catalog
+        next to the file (see :mod:`src.data.catalog`) """
+    with open(dataset_filename) as f:
+        records = (json.loads(line) for line in f if line.strip())
+        for record in join_metadata(records, dataset_filename):
+            yield record
+
+
+def record_key(record):
+    """ Stable identifier of a paragraph within the dataset """
+    return "{}#{}#{}".format(
+        record.get("filename"), record.get("section_id"),
+        record.get("paragraph_id"))
+
+
+def group_documents(records):
+    """
+    ``(filename, records)`` per filename, in order of first appearance.
+    Records of a filename are collected even when they are not contiguous,
+    so a document split across the dataset is still seen whole.
+    """
+    documents = collections.OrderedDict()
+    for record in records:
+        documents.setdefault(record.get("filename"), []).append(record)
+    return list(documents.items())
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming dataset build
+-----------------------
+Builds ``dataset.json`` from docs.yml with every document flowing through
+download, extraction, paragraph parsing and the :func:`write_to_dataset`
+sink as soon as it is ready, instead of one stage finishing for all
+documents before the next one starts::
+
+    docs.yml -> [download threads] -> queue -> [page dispatcher]
+             -> process pool (pdfminer page layout) -> queue
+             -> [paragraph assembler + normalizer] -> queue -> sink
+
+All queues are bounded, and the number of pages laid out but not yet
+assembled is capped, so a slow stage holds back the ones before it
+(backpressure) instead of letting work pile up in memory. Records of a
+document stay contiguous in the output; documents are written in the
+order their downloads complete. The records of a document are held back
+until its last page is assembled, so a document failing half-way is left
+out entirely rather than written in part.
+
+An error outside of a single document (the assembler, the sink) stops
+every stage: blocking puts and gets poll a stop event, the queues are
+drained and :meth:`StreamingPipeline.run` re-raises the error.
+"""
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import click
+import yaml
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.catalog import Catalog, catalog_path
+from src.data.extract_pdf import _Sectioner, count_pages, extract_page
+from src.data.make_dataset import write_to_dataset
+from src.data.normalize import Normalizer
+from src.data.pdf_store import PDFStore
+from src.pipeline import cermine_records, download_document
+
+_DONE = object()
+_POLL_S = 0.1
+
+
+class _Stopped(Exception):
+    """ Raised in a stage when another one failed """
+
+
+def _cermine(pdf):
+    return list(cermine_records(pdf))
+
+
+class StreamingPipeline(object):
+    """
+    Args:
+        entries (List[dict]): docs.yml ``pdfs`` entries.
+        external_dir (str): Where PDFs are downloaded to.
+        download_workers (int): Concurrent downloads.
+        extract_workers (int): Processes laying out PDF pages.
+        queue_size (int): Capacity of each queue between stages.
+        max_pending_pages (int): Pages submitted for layout but not yet
+            assembled; defaults to four per extract worker.
+        backend (str): ``"pdfminer"`` or ``"cermine"``.
+        refresh (bool): Download PDFs even if they are already on disk.
+        catalog (:class:`Catalog`): Records get the ``doc_id`` of their
+            document in it; without one, its docs.yml entry is copied in.
+    """
+
+    def __init__(self, entries, external_dir="data/external",
+                 download_workers=4, extract_workers=None, queue_size=8,
+                 max_pending_pages=None, backend="pdfminer", refresh=False,
+                 normalizer=None, catalog=None):
+        self.entries = list(entries)
+        self.external_dir = external_dir
+        self.download_workers = download_workers
+        self.extract_workers = extract_workers or os.cpu_count() or 1
+        self.backend = backend
+        self.refresh = refresh
+        self.normalizer = normalizer or Normalizer()
+        # resolved up front: the catalog is not used from the worker threads
+        self._doc_ids = dict((e["filename"], catalog.doc_id(e["filename"]))
+                             for e in self.entries) if catalog else None
+        self._downloaded = queue.Queue(queue_size)
+        self._extracting = queue.Queue(queue_size)
+        self._records = queue.Queue(queue_size * 64)
+        self._slots = threading.BoundedSemaphore(
+            max_pending_pages or 4 * self.extract_workers)
+        self.stats = {"documents": 0, "failed": 0, "pages": 0, "records": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item):
+        """ `q.put(item)`, giving up with :class:`_Stopped` on a stop """
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return q.put(item, timeout=_POLL_S)
+            except queue.Full:
+                pass
+
+    def _items(self, q):
+        """ Items of `q` up to ``_DONE``, or until the run is stopped """
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=_POLL_S)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _acquire(self):
+        while not self._slots.acquire(timeout=_POLL_S):
+            if self._stop.is_set():
+                raise _Stopped()
+
+    def _guard(self, func, *args):
+        """ Run a stage; its error stops the others and is kept for run """
+        try:
+            func(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logging.getLogger(__name__).error(
+                "%s failed: %r", func.__name__, e)
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            self._stop.set()
+
+    def _drain(self):
+        """ Empty the queues, cancelling pages not laid out yet """
+        for q in (self._downloaded, self._extracting, self._records):
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if q is self._extracting and item is not _DONE:
+                    for future in iter(item[1].get_nowait, _DONE):
+                        if not isinstance(future, Exception):
+                            future.cancel()
+
+    def _download(self, todo):
+        logger = logging.getLogger(__name__)
+        while not self._stop.is_set():
+            try:
+                entry = todo.get_nowait()
+            except queue.Empty:
+                break
+            pdf = os.path.join(self.external_dir, entry["filename"])
+            try:
+                if self.refresh or not os.path.isfile(pdf):
+                    download_document(entry["url"], pdf)
+            except Exception as e:
+                logger.error("download of %s failed: %s", entry["url"], e)
+                with self._lock:
+                    self.stats["failed"] += 1
+                continue
+            self._put(self._downloaded, (entry, pdf))
+
+    def _downloads(self):
+        todo = queue.Queue()
+        for entry in self.entries:
+            todo.put(entry)
+        threads = [threading.Thread(target=self._guard,
+                                    args=(self._download, todo))
+                   for _ in range(self.download_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._put(self._downloaded, _DONE)
+
+    def _dispatch(self, processes, threads):
+        """ Submit the pages of each downloaded PDF for layout """
+        logger = logging.getLogger(__name__)
+        store = PDFStore(self.external_dir)
+        for entry, pdf in self._items(self._downloaded):
+            pages = queue.Queue()
+            self._put(self._extracting, (entry, pages))
+            try:
+                store.check(pdf)
+                if self.backend == "cermine":
+                    pages.put(threads.submit(_cermine, pdf))
+                    continue
+                for number in range(count_pages(pdf)):
+                    # released by the assembler once the page is taken off
+                    # the queue, so at most that many pages are in flight
+                    self._acquire()
+                    pages.put(processes.submit(extract_page, pdf, number))
+            except _Stopped:
+                raise
+            except Exception as e:
+                logger.error("extraction of %s failed: %s", pdf, e)
+                pages.put(e)
+            finally:
+                pages.put(_DONE)
+        self._put(self._extracting, _DONE)
+
+    def _assemble(self):
+        """ Turn laid out pages into normalized dataset records """
+        logger = logging.getLogger(__name__)
+        for entry, pages in self._items(self._extracting):
+            records = self._assemble_document(entry, pages)
+            if records is None:
+                with self._lock:
+                    self.stats["failed"] += 1
+                continue
+            self._emit(entry, records)
+            self.stats["documents"] += 1
+            logger.info("streamed %s", entry["filename"])
+        self._put(self._records, _DONE)
+
+    def _assemble_document(self, entry, pages):
+        """ All records of one document, or ``None`` if it failed """
+        logger = logging.getLogger(__name__)
+        sectioner = _Sectioner()
+        records = []
+        failed = False
+        for number, future in enumerate(iter(pages.get, _DONE), 1):
+            slot = (self.backend != "cermine"
+                    and not isinstance(future, Exception))
+            try:
+                if failed:
+                    future.cancel()
+                    continue
+                if isinstance(future, Exception):
+                    raise future
+                if self.backend == "cermine":
+                    records.extend(future.result())
+                else:
+                    records.extend(sectioner.feed(number, future.result()))
+                    self.stats["pages"] += 1
+            except Exception as e:
+                logger.error("%s: %s", entry["filename"], e)
+                failed = True
+            finally:
+                if slot:
+                    self._slots.release()
+        if failed:
+            return None
+        records.extend(sectioner.flush())
+        return records
+
+    def _emit(self, entry, records):
+        for record in self.normalizer.records(records):
+            if self._doc_ids is None:
+                record.update(entry)
+            else:
+                record["doc_id"] = self._doc_ids[entry["filename"]]
+            self._put(self._records, record)
+
+    def run(self, output_filename):
+        """
+        Stream all entries into `output_filename`.
+
+        Returns:
+            dict: document, page and record counts, ``first_record_s`` and
+            ``total_s`` (seconds since the start).
+
+        Raises:
+            Exception: The error that stopped a stage other than the
+                extraction of a single document.
+        """
+        start = time.perf_counter()
+        first = None
+        sink = write_to_dataset(output_filename)
+        sink.__next__()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                    self.extract_workers) as processes, \
+                    concurrent.futures.ThreadPoolExecutor(
+                        self.download_workers) as threads:
+                workers = [
+                    threading.Thread(target=self._guard,
+                                     args=(self._downloads,)),
+                    threading.Thread(target=self._guard,
+                                     args=(self._dispatch, processes,
+                                           threads)),
+                    threading.Thread(target=self._guard,
+                                     args=(self._assemble,)),
+                ]
+                for worker in workers:
+                    worker.daemon = True
+                    worker.start()
+                try:
+                    for record in self._items(self._records):
+                        sink.send(record)
+                        self.stats["records"] += 1
+                        if first is None:
+                            first = time.perf_counter() - start
+                finally:
+                    # also releases the stages if the sink failed
+                    self._stop.set()
+                    for worker in workers:
+                        worker.join()
+                    self._drain()
+        finally:
+            sink.close()
+        if self._error is not None:
+            raise self._error
+        self.stats["first_record_s"] = first
+        self.stats["total_s"] = time.perf_counter() - start
+        return self.stats
+
+
+@click.command()
+@click.argument('docs', default='docs.yml', type=click.File('r'))
+@click.argument('output_filepath', type=click.Path(), default='data/interim/blockchain_papers_dataset/dataset.json')
+@click.option('--external-dir', default='data/external', type=click.Path(exists=True))
+@click.option('--download-workers', default=4)
+@click.option('--extract-workers', default=None, type=int)
+@click.option('--queue-size', default=8)
+@click.option('--backend', default='pdfminer',
+              type=click.Choice(['pdfminer', 'cermine']))
+@click.option('--refresh', is_flag=True,
+              help='Download PDFs even if already in external-dir.')
+def main(docs, output_filepath, external_dir, download_workers,
+         extract_workers, queue_size, backend, refresh):
+    """ Stream the documents of DOCS into the dataset file """
+    logger = logging.getLogger(__name__)
+    logger.info('streaming documents into %s', output_filepath)
+    entries = yaml.safe_load(docs)['pdfs']
+    catalog = Catalog.compile(docs.name, catalog_path(output_filepath))
+    stream = StreamingPipeline(
+        entries, external_dir, download_workers=download_workers,
+        extract_workers=extract_workers, queue_size=queue_size,
+        backend=backend, refresh=refresh, catalog=catalog)
+    stats = stream.run(output_filepath)
+    logger.info('%(documents)d documents (%(failed)d failed), %(pages)d '
+                'pages, %(records)d records', stats)
+    logger.info('first record after %.2f s, done after %.2f s',
+                stats['first_record_s'] or 0, stats['total_s'])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
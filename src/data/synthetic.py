@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Data
+--------------
+Deterministic generators of CERMINE-style JATS files (``.cermxml``) and
+dataset files (one json record per line) that look enough like the real
+publications to exercise the pipeline, for benchmarks and local runs
+without the PDFs. Like ``make_dataset``, a dataset file holds ``doc_id``
+records and gets a ``docs.yml`` and its compiled catalog alongside.
+
+The same ``seed`` and ``size`` always produce byte-identical output.
+:func:`write_pdf` lays the same kind of text out as a minimal PDF, with
+larger section headings, for testing PDF extraction without CERMINE.
+"""
+import json
+import logging
+import os
+import random
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import click
+import yaml
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.catalog import Catalog, catalog_path
+from src.data.normalize import DEFAULT_NORMALIZER
+
+# number of documents, sections per document, paragraphs per section
+SIZES = {
+    "small": (4, 5, 6),
+    "medium": (22, 12, 10),
+    "large": (100, 20, 15),
+}
+
+_VOCABULARY = (
+    "the of and to in a for is on that by with as are be this which or from "
+    "settlement payment ledger distributed technology central bank banks "
+    "digital currency token tokens securities cash asset assets transfer "
+    "network nodes node consensus validation participants interbank "
+    "liquidity system systems project prototype report design issuance "
+    "redemption scriptless bond bonds atomic delivery versus finality "
+    "privacy scalability resilience governance legal regulatory operator "
+    "wholesale retail account accounts smart contract contracts platform"
+).split()
+
+_MENTIONS = (
+    "European Central Bank", "ECB", "Bank of Japan", "BoE",
+    "Bank of England", "BIS", "DLT", "distributed ledger technology",
+    "blockchain", "Corda", "Hyperledger Fabric", "Ethereum", "CBDC",
+    "central bank digital currency", "smart contracts",
+)
+
+
+def _sentence(rng, min_words=6, max_words=28):
+    words = [rng.choice(_VOCABULARY)
+             for _ in range(rng.randint(min_words, max_words))]
+    if rng.random() < 0.4:
+        words.insert(rng.randrange(len(words)), rng.choice(_MENTIONS))
+    words[0] = words[0].capitalize()
+    return " ".join(words) + "."
+
+
+def paragraph_text(rng, min_sentences=1, max_sentences=8):
+    """ A paragraph of random sentences; occasionally a table-like stub """
+    if rng.random() < 0.05:
+        return " ".join(str(rng.randint(0, 9999)) for _ in range(8))
+    return " ".join(_sentence(rng) for _ in range(
+        rng.randint(min_sentences, max_sentences)))
+
+
+def cermxml_document(rng, n_sections, n_paragraphs, title="Synthetic"):
+    """ A JATS document shaped like CERMINE's ``-outputs jats`` files """
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<article xmlns:xlink="http://www.w3.org/1999/xlink">',
+        '<front><article-meta><title-group><article-title>{}'
+        '</article-title></title-group></article-meta></front>'.format(
+            escape(title)),
+        '<body>',
+    ]
+    for s in range(n_sections):
+        parts.append('<sec id="sec-{}"><title>{}</title>'.format(
+            s, escape(_sentence(rng, 2, 5))))
+        for _ in range(rng.randint(1, n_paragraphs)):
+            # CERMINE keeps the line breaks of the PDF, including words
+            # hyphenated across them
+            text = paragraph_text(rng)
+            words = text.split(" ")
+            lines, line = [], []
+            for word in words:
+                if len(line) >= 12:
+                    if len(word) > 7 and word.isalpha() and word.islower():
+                        cut = len(word) // 2
+                        line.append(word[:cut] + "-")
+                        word = word[cut:]
+                    lines.append(" ".join(line))
+                    line = []
+                line.append(word)
+            lines.append(" ".join(line))
+            parts.append('<p>{}</p>'.format(escape("\n".join(lines))))
+        parts.append('</sec>')
+    parts.append('</body><back/></article>')
+    return "\n".join(parts)
+
+
+def load_documents(metadata_file=None):
+    """ The ``pdfs`` entries of docs.yml, used to label synthetic data """
+    if metadata_file is None:
+        metadata_file = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "..",
+            "docs.yml")
+    with open(metadata_file) as f:
+        return yaml.safe_load(f)["pdfs"]
+
+
+def _plan(size, documents):
+    if size not in SIZES:
+        raise ValueError("`size` must be one of {}".format(sorted(SIZES)))
+    n_documents, n_sections, n_paragraphs = SIZES[size]
+    for i in range(n_documents):
+        meta = dict(documents[i % len(documents)])
+        if i >= len(documents):
+            name, extension = os.path.splitext(meta["filename"])
+            meta["filename"] = "{}-{}{}".format(name, i, extension)
+        yield i, meta, n_sections, n_paragraphs
+
+
+def write_cermxml(output_dir, size="small", seed=0, documents=None):
+    """
+    Write ``<name>.cermxml`` files into `output_dir`, one per docs.yml
+    entry (cycled for the larger sizes).
+
+    Returns:
+        List[str]: paths written.
+    """
+    documents = documents or load_documents()
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, meta, n_sections, n_paragraphs in _plan(size, documents):
+        rng = random.Random("{}-{}".format(seed, i))
+        name = os.path.splitext(meta["filename"])[0]
+        path = os.path.join(output_dir, name + ".cermxml")
+        with open(path, "w") as f:
+            f.write(cermxml_document(rng, n_sections, n_paragraphs,
+                                     title=name))
+        paths.append(path)
+    return paths
+
+
+def plan_documents(size="small", documents=None):
+    """ The docs.yml entries of the documents a dataset of `size` holds """
+    documents = documents or load_documents()
+    return [meta for _, meta, _, _ in _plan(size, documents)]
+
+
+def dataset_records(catalog, size="small", seed=0, documents=None):
+    """
+    Yield dataset records as ``make_dataset`` writes them: normalized text
+    and the ``doc_id`` of the document in `catalog`
+    """
+    documents = documents or load_documents()
+    for i, meta, n_sections, n_paragraphs in _plan(size, documents):
+        rng = random.Random("{}-{}".format(seed, i))
+        doc_id = catalog.doc_id(meta["filename"])
+        for s in range(n_sections):
+            for p in range(rng.randint(1, n_paragraphs)):
+                yield {
+                    "section_id": "sec-{}".format(s),
+                    "paragraph_id": p,
+                    "text": paragraph_text(rng),
+                    "normalization": DEFAULT_NORMALIZER.version,
+                    "doc_id": doc_id,
+                }
+
+
+def write_dataset(dataset_filename, size="small", seed=0, documents=None):
+    """
+    Write a synthetic dataset file, with the ``docs.yml`` of its documents
+    and their catalog next to it; returns the number of records
+    """
+    dirname = os.path.dirname(os.path.abspath(dataset_filename))
+    os.makedirs(dirname, exist_ok=True)
+    docs_filename = os.path.join(dirname, "docs.yml")
+    with open(docs_filename, "w") as f:
+        yaml.safe_dump({"pdfs": plan_documents(size, documents)}, f)
+    catalog = Catalog.compile(docs_filename, catalog_path(dataset_filename))
+    n = 0
+    with open(dataset_filename, "w") as f:
+        for record in dataset_records(catalog, size, seed, documents):
+            f.write(json.dumps(record))
+            f.write("\n")
+            n += 1
+    return n
+
+
+def _pdf_escape(text):
+    return (text.replace("\\", "\\\\").replace("(", "\\(")
+            .replace(")", "\\)"))
+
+
+def _wrap(text, width):
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = (line + " " + word).strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def pdf_pages(rng, n_sections, n_paragraphs, lines_per_page=48):
+    """
+    Lay out sections as pages of ``(font size, line)`` tuples; ``None``
+    marks the blank line between paragraphs.
+    """
+    pages, page = [], []
+    for s in range(n_sections):
+        blocks = [(16, [_sentence(rng, 2, 5).rstrip(".")])]
+        for _ in range(rng.randint(1, n_paragraphs)):
+            blocks.append((10, _wrap(paragraph_text(rng), 90)))
+        for size, lines in blocks:
+            for line in lines:
+                if len(page) >= lines_per_page:
+                    pages.append(page)
+                    page = []
+                page.append((size, line))
+            page.append(None)
+    if page:
+        pages.append(page)
+    return pages
+
+
+def write_pdf(path, pages):
+    """
+    Write `pages` (as returned by :func:`pdf_pages`) as an uncompressed
+    PDF using the standard Helvetica font.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in pages:
+        y = 800
+        ops = []
+        for item in page:
+            if item is None:
+                y -= 10
+                continue
+            size, line = item
+            y -= size + 4
+            ops.append("BT /F1 {} Tf 50 {} Td ({}) Tj ET".format(
+                size, y, _pdf_escape(line)))
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream"
+                       % (len(stream), stream))
+        content = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % content)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += (b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref))
+    with open(path, "wb") as f:
+        f.write(bytes(out))
+
+
+def write_pdfs(output_dir, size="small", seed=0, documents=None):
+    """ Write one synthetic PDF per docs.yml entry; returns their paths """
+    documents = documents or load_documents()
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, meta, n_sections, n_paragraphs in _plan(size, documents):
+        rng = random.Random("{}-{}".format(seed, i))
+        path = os.path.join(output_dir, meta["filename"])
+        write_pdf(path, pdf_pages(rng, n_sections, n_paragraphs))
+        paths.append(path)
+    return paths
+
+
+@click.command()
+@click.argument('output_filepath', type=click.Path())
+@click.option('--size', default='small', type=click.Choice(sorted(SIZES)))
+@click.option('--seed', default=0)
+@click.option('--kind', default='dataset',
+              type=click.Choice(['dataset', 'cermxml', 'pdf']))
+def main(output_filepath, size, seed, kind):
+    """ Generate a synthetic dataset file, or cermxml or pdf files """
+    logger = logging.getLogger(__name__)
+    if kind == 'dataset':
+        n = write_dataset(output_filepath, size, seed)
+        logger.info('wrote %d records to %s', n, output_filepath)
+    else:
+        write = write_cermxml if kind == 'cermxml' else write_pdfs
+        paths = write(output_filepath, size, seed)
+        logger.info('wrote %d files to %s', len(paths), output_filepath)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -10,6 +10,9 @@ import textacy.keyterms
 import ftfy
 
 import entities
+from src.data.normalize import is_normalized
+from src.profiling import enable as enable_tracing
+from src.profiling import get_tracer
 
 # Load English tokenizer, tagger, parser, NER and word vectors
 en = textacy.load_spacy_lang("en_core_web_lg")
@@ -31,31 +34,52 @@ def replace_name_with_placeholder(token):
 
 # Loop through all the entities in a document and check if they are names
 def scrub(paragraph):
-    txt = paragraph['raw_text']
-    txt = textacy.preprocess.normalize_whitespace(txt)
-    text = textacy.preprocess_text(txt, lowercase=True, no_punct=False, fix_unicode=False, no_urls=True)
-    doc = textacy.make_spacy_doc(text, lang=en)
+    tracer = get_tracer()
+    if is_normalized(paragraph, required=('whitespace', 'urls')):
+        # cleaned up once by make_dataset, see src/data/normalize.py
+        text = paragraph['text'].lower()
+    else:
+        # datasets built before normalization have no raw_text
+        txt = paragraph.get('raw_text', paragraph['text'])
+        with tracer.stage('build_features/normalize_whitespace', event=False):
+            txt = textacy.preprocess.normalize_whitespace(txt)
+        with tracer.stage('build_features/preprocess_text', event=False):
+            text = textacy.preprocess_text(txt, lowercase=True, no_punct=False, fix_unicode=False, no_urls=True)
+    with tracer.stage('build_features/make_spacy_doc', event=False) as span:
+        doc = textacy.make_spacy_doc(text, lang=en)
+        span.count(len(doc))
     # doc = nlp(text['raw_text'])
     # for ent in doc.ents:
     #     ent.merge()
     # tokens = map(replace_name_with_placeholder, doc)
+    with tracer.stage('build_features/textrank', event=False):
+        textrank = textacy.keyterms.textrank(doc, normalize="lemma", n_keyterms=10)
+    with tracer.stage('build_features/sgrank', event=False):
+        sgrank = textacy.keyterms.sgrank(doc, ngrams=(1, 2, 3, 4), normalize="lower", n_keyterms=0.1)
+    with tracer.stage('build_features/entities', event=False):
+        ents = list(textacy.extract.entities(doc))
     return {
-        'textrank': textacy.keyterms.textrank(doc, normalize="lemma", n_keyterms=10),
-        'sgrank': textacy.keyterms.sgrank(doc, ngrams=(1, 2, 3, 4), normalize="lower", n_keyterms=0.1),
-        'entities': list(textacy.extract.entities(doc))
+        'textrank': textrank,
+        'sgrank': sgrank,
+        'entities': ents
     }
 
 
 @click.command()
 # @click.argument('docs', type=click.File('r'))
 @click.argument('input_filepath', default='data/processed', type=click.Path(exists=True))
-def main(input_filepath):
+@click.option('--trace', 'trace_filename', default=None, type=click.Path(),
+              help='Profile the run and write the trace to this file.')
+def main(input_filepath, trace_filename):
     """ Runs data processing scripts to \turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
     logger.info('extract features from processed data')
     logger.info(input_filepath)
+    if trace_filename:
+        enable_tracing(trace_filename)
+        get_tracer().instrument(en)
     from pprint import pprint
     # nlp = en
     # component = entities.FinancialEntityRecognizer(nlp, entitites._financial_institutions)  # initialise component
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Entity / Technology Co-occurrence Graph
+---------------------------------------
+Counts which financial institutions (``ORG``) and technologies (``TECH``)
+are mentioned together, per paragraph and per document, and which
+publishing institution mentions them.
+
+Counts are kept per document and summed into slices keyed by
+``(institution, date)`` of the publication, so documents can be merged in
+(or replaced) without recounting the rest of the corpus. Gazetteer
+mentions are found with a single :class:`spacy.matcher.PhraseMatcher`,
+whose cost does not grow with the size of the gazetteer, and every other
+``ORG`` entity the pipeline's NER finds is added under its own name.
+
+Node ids are ``"<LABEL>:<name>"``, e.g. ``"ORG:ECB"`` or ``"TECH:DLT"``;
+publishers appear as ``"PUB:<institution>"``.
+"""
+import collections
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+
+import click
+import spacy
+from dotenv import find_dotenv, load_dotenv
+
+from src.features.entities import gazetteer_matcher_factory
+from src.data.catalog import normalize_date, split_institutions
+from src.data.records import read_dataset
+
+EDGE_SEP = "|"
+DEFAULT_LANG = "en_core_web_lg"
+
+
+def load_lang(lang=DEFAULT_LANG):
+    """ spaCy pipeline with NER, without the components counting skips """
+    return spacy.load(lang, disable=["tagger", "parser"])
+
+
+class DocumentCounts(object):
+    """ Mentions and co-mentions found in a single publication """
+
+    def __init__(self, filename, institution=None, date=None):
+        self.filename = filename
+        self.institution = institution
+        self.date = date
+        self.paragraphs = 0
+        # node -> number of paragraphs mentioning it
+        self.nodes = collections.Counter()
+        # (node, node) -> number of paragraphs mentioning both
+        self.paragraph_edges = collections.Counter()
+
+    @property
+    def key(self):
+        return self.institution, self.date
+
+    @property
+    def document_edges(self):
+        """ Counter: 1 for every pair of nodes mentioned in the document """
+        return collections.Counter(
+            itertools.combinations(sorted(self.nodes), 2))
+
+    @property
+    def publisher_edges(self):
+        """ Counter: paragraphs of the publisher(s) mentioning each node """
+        edges = collections.Counter()
+        for publisher in split_institutions(self.institution):
+            for node, count in self.nodes.items():
+                edges[("PUB:" + publisher, node)] += count
+        return edges
+
+    def add_paragraph(self, nodes):
+        self.paragraphs += 1
+        nodes = sorted(set(nodes))
+        self.nodes.update(nodes)
+        self.paragraph_edges.update(itertools.combinations(nodes, 2))
+
+    def to_dict(self):
+        return {
+            "filename": self.filename,
+            "institution": self.institution,
+            "date": self.date,
+            "paragraphs": self.paragraphs,
+            "nodes": dict(self.nodes),
+            "paragraph_edges": _dump_edges(self.paragraph_edges),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        counts = cls(d["filename"], d["institution"], d["date"])
+        counts.paragraphs = d["paragraphs"]
+        counts.nodes.update(d["nodes"])
+        counts.paragraph_edges.update(_load_edges(d["paragraph_edges"]))
+        return counts
+
+
+class Slice(object):
+    """ Sum of the :class:`DocumentCounts` sharing an (institution, date) """
+
+    def __init__(self):
+        self.documents = 0
+        self.nodes = collections.Counter()
+        self.paragraph_edges = collections.Counter()
+        self.document_edges = collections.Counter()
+        self.publisher_edges = collections.Counter()
+
+    def add(self, counts, sign=1):
+        self.documents += sign
+        for attr in ("nodes", "paragraph_edges", "document_edges",
+                     "publisher_edges"):
+            target = getattr(self, attr)
+            for key, value in getattr(counts, attr).items():
+                target[key] += sign * value
+                if not target[key]:
+                    del target[key]
+
+
+class CooccurrenceGraph(object):
+    """
+    Sparse weighted co-occurrence graph, incrementally updatable.
+
+    Args:
+        nlp (:class:`spacy.language.Language`): Pipeline whose ``ORG``
+            entities are counted along with the gazetteer matches;
+            :func:`load_lang` by default.
+        gazetteers (Dict[str, Dict[str, Tuple[str]]]): label -> canonical
+            name -> surface forms; see
+            :func:`entities.gazetteer_matcher_factory`.
+    """
+
+    def __init__(self, nlp=None, gazetteers=None):
+        self.nlp = nlp if nlp is not None else load_lang()
+        self.matcher = gazetteer_matcher_factory(self.nlp, gazetteers)
+        self.documents = {}
+        self.slices = collections.defaultdict(Slice)
+
+    def __contains__(self, filename):
+        return filename in self.documents
+
+    def __len__(self):
+        return len(self.documents)
+
+    def mentions(self, doc):
+        """
+        Set of node ids mentioned in a spaCy `doc`: the gazetteer matches,
+        plus ``ORG`` entities that overlap none of them, named by their text
+        """
+        strings = self.nlp.vocab.strings
+        nodes = set()
+        matched = set()
+        for match_id, start, end in self.matcher(doc):
+            nodes.add(strings[match_id])
+            matched.update(range(start, end))
+        for ent in doc.ents:
+            if ent.label_ != "ORG" or matched.intersection(
+                    range(ent.start, ent.end)):
+                continue
+            tokens = ent[1:] if ent[0].lower_ == "the" else ent
+            name = " ".join(tokens.text.split())
+            if name:
+                nodes.add("ORG:" + name)
+        return nodes
+
+    def count_document(self, records, counts=None, batch_size=256):
+        """
+        :class:`DocumentCounts` for the paragraph records of one file,
+        added to `counts` if given
+        """
+        records = iter(records)
+        first = next(records)
+        if counts is None:
+            counts = DocumentCounts(
+                first.get("filename"), first.get("institution"),
+                normalize_date(first.get("date")))
+        texts = (r.get("text", "")
+                 for r in itertools.chain([first], records))
+        for doc in self.nlp.pipe(texts, batch_size=batch_size):
+            counts.add_paragraph(self.mentions(doc))
+        return counts
+
+    def add_document(self, counts):
+        """ Merge `counts` in, replacing an earlier version of its file """
+        self.remove_document(counts.filename)
+        self.documents[counts.filename] = counts
+        self.slices[counts.key].add(counts)
+
+    def remove_document(self, filename):
+        counts = self.documents.pop(filename, None)
+        if counts is not None:
+            self.slices[counts.key].add(counts, sign=-1)
+            if not self.slices[counts.key].documents:
+                del self.slices[counts.key]
+
+    def update(self, records, refresh=()):
+        """
+        Count and merge the documents in `records`, streamed one run of
+        consecutive records of a filename at a time. Files already in the
+        graph are skipped unless listed in `refresh`; a later run of a file
+        counted by this update is added to its counts.
+
+        Returns:
+            List[str]: filenames that were (re)counted.
+        """
+        logger = logging.getLogger(__name__)
+        refresh = set(refresh)
+        added = []
+        counted = set()
+        for filename, run in itertools.groupby(
+                records, key=lambda r: r.get("filename")):
+            if filename in counted:
+                counts = self.documents[filename]
+                self.remove_document(filename)
+                self.add_document(self.count_document(run, counts))
+                continue
+            if filename in self and filename not in refresh:
+                continue
+            logger.info("counting co-occurrences in %s", filename)
+            self.add_document(self.count_document(run))
+            added.append(filename)
+            counted.add(filename)
+        return added
+
+    def aggregate(self, institution=None, date_range=None):
+        """
+        Sum the slices matching the filters into one :class:`Slice`.
+
+        Args:
+            institution (str or Set[str]): Publishing institution(s).
+            date_range (Tuple[str]): ISO ``(start, end)``, end exclusive.
+        """
+        if isinstance(institution, str):
+            institution = {institution}
+        total = Slice()
+        for (inst, date), slice_ in self.slices.items():
+            if institution is not None and not (
+                    set(split_institutions(inst)) & set(institution)):
+                continue
+            if date_range is not None and not (
+                    date and (date_range[0] or "") <= date
+                    < (date_range[1] or "9999")):
+                continue
+            total.documents += slice_.documents
+            for attr in ("nodes", "paragraph_edges", "document_edges",
+                         "publisher_edges"):
+                getattr(total, attr).update(getattr(slice_, attr))
+        return total
+
+    def save(self, filename):
+        """ Persist the per-document counts as json """
+        data = {"documents": [c.to_dict() for c in self.documents.values()]}
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename, nlp=None, gazetteers=None):
+        graph = cls(nlp=nlp, gazetteers=gazetteers)
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            for d in data["documents"]:
+                graph.add_document(DocumentCounts.from_dict(d))
+        return graph
+
+
+def _dump_edges(edges):
+    return dict((EDGE_SEP.join(k), v) for k, v in edges.items())
+
+
+def _load_edges(edges):
+    return dict((tuple(k.split(EDGE_SEP)), v) for k, v in edges.items())
+
+
+@click.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('graph_filename', default='data/processed/cooccurrence.json', type=click.Path())
+@click.option('--refresh', multiple=True,
+              help='Recount this filename even if already in the graph.')
+@click.option('--export', 'export_filename', default=None, type=click.Path(),
+              help='Also write the graph (.graphml, .gexf or .json).')
+@click.option('--level', default='paragraph',
+              type=click.Choice(['paragraph', 'document']))
+@click.option('--lang', default=DEFAULT_LANG,
+              help='spaCy pipeline whose NER finds ORG entities.')
+def main(dataset_filename, graph_filename, refresh, export_filename, level,
+         lang):
+    """ Merge new documents of the dataset into the co-occurrence graph """
+    from src.visualization.visualize import write_cooccurrence_graph
+    logger = logging.getLogger(__name__)
+    logger.info('updating %s from %s', graph_filename, dataset_filename)
+
+    graph = CooccurrenceGraph.load(graph_filename, nlp=load_lang(lang))
+    added = graph.update(read_dataset(dataset_filename), refresh=refresh)
+    logger.info('%d new documents, %d in total', len(added), len(graph))
+    graph.save(graph_filename)
+    if export_filename:
+        write_cooccurrence_graph(graph.aggregate(), export_filename,
+                                 level=level)
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
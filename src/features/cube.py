@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Term x Institution x Time Cube
+------------------------------
+Materialized mention counts of gazetteer entities and extra terms by
+publishing institution and publication month, so trend questions ("how
+often did each central bank mention DLT per year") are answered by slicing
+a small array instead of re-reading the corpus.
+
+The cube is a dense ``int32`` array of shape
+``(len(terms), len(institutions), len(periods))`` stored with its axis
+labels in a single ``.npz`` file, alongside the number of paragraphs in each
+``(institution, period)`` cell for normalization. Periods are ``YYYY-MM``
+and can be rolled up to quarters or years at query time. Publications
+without a date in docs.yml are left out.
+
+A co-published document (``"Bundesbank, Deutsche Börse"``) counts in full
+for each of its publishers, so summing the cells of several institutions
+counts it once per co-publisher among them. Totals over all institutions
+are therefore kept separately (``totals``, ``total_paragraphs``), counting
+every document once; :meth:`TermCube.time_series` uses them when no
+institution is given.
+"""
+import collections
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+import spacy
+from dotenv import find_dotenv, load_dotenv
+
+from src.features.entities import (
+    _financial_institution_aliases, _technology_aliases,
+    gazetteer_matcher_factory)
+from src.data.catalog import normalize_date, split_institutions
+from src.data.records import group_documents, read_dataset
+
+GRANULARITIES = ("month", "quarter", "year")
+
+
+def period_of(month, granularity="month"):
+    """ Map a ``YYYY-MM`` period to its month, quarter or year label """
+    if granularity == "month":
+        return month
+    year, m = month.split("-")
+    if granularity == "quarter":
+        return "{}Q{}".format(year, (int(m) - 1) // 3 + 1)
+    if granularity == "year":
+        return year
+    raise ValueError("`granularity` must be one of {}".format(GRANULARITIES))
+
+
+class TermCube(object):
+    """
+    Counts by term, institution and period, with slicing and roll-ups.
+
+    Args:
+        terms (List[str]): Term axis labels, e.g. ``"TECH:DLT"``.
+        institutions (List[str]): Publishing institution axis labels.
+        periods (List[str]): Sorted period labels.
+        counts (:class:`numpy.ndarray`): ``(terms, institutions, periods)``.
+        paragraphs (:class:`numpy.ndarray`): ``(institutions, periods)``
+            number of paragraphs, for normalization.
+        totals (:class:`numpy.ndarray`): ``(terms, periods)`` counts over
+            all institutions, each document counted once; ``None`` where
+            unknown (a cube sliced by institution).
+        total_paragraphs (:class:`numpy.ndarray`): ``(periods,)``, likewise.
+    """
+
+    def __init__(self, terms, institutions, periods, counts, paragraphs,
+                 totals=None, total_paragraphs=None):
+        self.terms = list(terms)
+        self.institutions = list(institutions)
+        self.periods = list(periods)
+        self.counts = counts
+        self.paragraphs = paragraphs
+        self.totals = totals
+        self.total_paragraphs = total_paragraphs
+        self._index = {
+            "term": dict((v, i) for i, v in enumerate(self.terms)),
+            "institution": dict(
+                (v, i) for i, v in enumerate(self.institutions)),
+            "period": dict((v, i) for i, v in enumerate(self.periods)),
+        }
+
+    def __repr__(self):
+        return "TermCube({} terms x {} institutions x {} periods)".format(
+            *self.counts.shape)
+
+    def save(self, filename):
+        """ Write the cube as ``.npz``; only cubes with totals can be saved """
+        if self.totals is None:
+            raise ValueError("a cube sliced by institution has no totals; "
+                             "save the full cube instead")
+        np.savez_compressed(
+            filename, terms=np.array(self.terms),
+            institutions=np.array(self.institutions),
+            periods=np.array(self.periods),
+            counts=self.counts, paragraphs=self.paragraphs,
+            totals=self.totals, total_paragraphs=self.total_paragraphs)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data["terms"].tolist(), data["institutions"].tolist(),
+                       data["periods"].tolist(), data["counts"],
+                       data["paragraphs"], data["totals"],
+                       data["total_paragraphs"])
+
+    def _positions(self, axis, values):
+        if values is None:
+            return slice(None)
+        if isinstance(values, str):
+            values = [values]
+        try:
+            return [self._index[axis][v] for v in values]
+        except KeyError as e:
+            raise ValueError("unknown {}: {}".format(axis, e))
+
+    def slice(self, terms=None, institutions=None, periods=None):
+        """ Sub-cube restricted to the given labels (all if ``None``) """
+        t = self._positions("term", terms)
+        i = self._positions("institution", institutions)
+        p = self._positions("period", periods)
+        counts = self.counts[t][:, i][:, :, p]
+        paragraphs = self.paragraphs[i][:, p]
+        totals = total_paragraphs = None
+        if institutions is None and self.totals is not None:
+            totals = self.totals[t][:, p]
+            total_paragraphs = self.total_paragraphs[p]
+        return TermCube(
+            np.array(self.terms)[t].tolist(),
+            np.array(self.institutions)[i].tolist(),
+            np.array(self.periods)[p].tolist(), counts, paragraphs,
+            totals, total_paragraphs)
+
+    def rollup(self, granularity):
+        """ Cube with periods merged into quarters or years """
+        labels = [period_of(p, granularity) for p in self.periods]
+        periods = sorted(set(labels))
+        index = dict((p, i) for i, p in enumerate(periods))
+        target = np.array([index[label] for label in labels], dtype=np.intp)
+        counts = np.zeros(self.counts.shape[:2] + (len(periods),),
+                          dtype=self.counts.dtype)
+        paragraphs = np.zeros((self.paragraphs.shape[0], len(periods)),
+                              dtype=self.paragraphs.dtype)
+        np.add.at(counts, (slice(None), slice(None), target), self.counts)
+        np.add.at(paragraphs, (slice(None), target), self.paragraphs)
+        totals = total_paragraphs = None
+        if self.totals is not None:
+            totals = np.zeros((self.totals.shape[0], len(periods)),
+                              dtype=self.totals.dtype)
+            total_paragraphs = np.zeros(len(periods),
+                                        dtype=self.total_paragraphs.dtype)
+            np.add.at(totals, (slice(None), target), self.totals)
+            np.add.at(total_paragraphs, target, self.total_paragraphs)
+        return TermCube(self.terms, self.institutions, periods, counts,
+                        paragraphs, totals, total_paragraphs)
+
+    def time_series(self, term, institution=None, granularity="year",
+                    per_paragraphs=None):
+        """
+        Counts of `term` over time, summed over `institution`. With
+        ``None``, the all-institution totals are used, counting every
+        document once; summing several named institutions counts a
+        document once per co-publisher among them.
+
+        Args:
+            per_paragraphs (int): If set, report mentions per this many
+                paragraphs published instead of raw counts.
+        Returns:
+            List[Tuple[str, float]]: ``(period, value)`` in period order.
+        """
+        cube = self.slice(terms=[term], institutions=institution)
+        if granularity != "month":
+            cube = cube.rollup(granularity)
+        if cube.totals is not None:
+            values = cube.totals[0].astype(float)
+            totals = cube.total_paragraphs
+        else:
+            values = cube.counts[0].sum(axis=0).astype(float)
+            totals = cube.paragraphs.sum(axis=0)
+        if per_paragraphs:
+            values = np.divide(values * per_paragraphs, totals,
+                               out=np.zeros_like(values), where=totals > 0)
+        return list(zip(cube.periods, values.tolist()))
+
+    def by_institution(self, term, granularity="year"):
+        """ Dict[str, List[Tuple[str, float]]]: one series per institution """
+        cube = self.slice(terms=[term])
+        if granularity != "month":
+            cube = cube.rollup(granularity)
+        return dict(
+            (inst, list(zip(cube.periods, cube.counts[0, i].tolist())))
+            for i, inst in enumerate(cube.institutions))
+
+
+def count_document(records, nlp, matcher, batch_size=256):
+    """
+    Mentions in the paragraph `records` of one publication.
+
+    Returns:
+        dict: ``month``, ``institutions``, ``paragraphs`` and ``mentions``
+        (term -> count), json-serializable; ``None`` if the publication
+        has no date.
+    """
+    date = normalize_date(records[0].get("date"))
+    if date is None:
+        return None
+    strings = nlp.vocab.strings
+    mentions = collections.Counter()
+    texts = (r.get("text", "") for r in records)
+    for doc in nlp.pipe(texts, batch_size=batch_size):
+        mentions.update(strings[m] for m, _, _ in matcher(doc))
+    return {
+        "month": date[:7],
+        "institutions": split_institutions(records[0].get("institution")),
+        "paragraphs": len(records),
+        "mentions": dict(mentions),
+    }
+
+
+def build_cube(records, terms=(), nlp=None, batch_size=256, documents=None,
+               refresh=()):
+    """
+    Count gazetteer entities and extra `terms` in dataset `records`.
+
+    Args:
+        records (Iterable[dict]): Dataset records.
+        terms (Iterable[str]): Additional phrases, counted as ``TERM:<t>``.
+        documents (dict): filename -> :func:`count_document` result of an
+            earlier run with the same `terms`. Files found here are not
+            counted again unless listed in `refresh`; the dict is updated
+            in place to match `records`, so it can be kept for the next
+            run.
+        refresh (Iterable[str]): Filenames to recount.
+    Returns:
+        :class:`TermCube`
+    """
+    logger = logging.getLogger(__name__)
+    nlp = nlp if nlp is not None else spacy.blank("en")
+    gazetteers = {"ORG": _financial_institution_aliases,
+                  "TECH": _technology_aliases}
+    if terms:
+        gazetteers["TERM"] = dict((t, (t.lower(),)) for t in terms)
+    matcher = gazetteer_matcher_factory(nlp, gazetteers)
+    documents = {} if documents is None else documents
+    refresh = set(refresh)
+
+    seen = set()
+    for filename, group in group_documents(records):
+        seen.add(filename)
+        if filename not in documents or filename in refresh:
+            documents[filename] = count_document(group, nlp, matcher,
+                                                 batch_size)
+    for filename in set(documents) - seen:
+        del documents[filename]
+
+    counts = collections.Counter()
+    paragraphs = collections.Counter()
+    # over all institutions, each document once
+    totals = collections.Counter()
+    total_paragraphs = collections.Counter()
+    undated = 0
+    for document in documents.values():
+        if document is None:
+            undated += 1
+            continue
+        month = document["month"]
+        for institution in document["institutions"]:
+            paragraphs[institution, month] += document["paragraphs"]
+            for term, count in document["mentions"].items():
+                counts[term, institution, month] += count
+        total_paragraphs[month] += document["paragraphs"]
+        for term, count in document["mentions"].items():
+            totals[term, month] += count
+    if undated:
+        logger.warning("%d undated publications left out of the cube",
+                       undated)
+
+    term_labels = sorted(
+        "{}:{}".format(label, name)
+        for label, names in gazetteers.items() for name in names)
+    institution_labels = sorted(set(i for i, _ in paragraphs))
+    period_labels = sorted(total_paragraphs)
+    cube = TermCube(
+        term_labels, institution_labels, period_labels,
+        np.zeros((len(term_labels), len(institution_labels),
+                  len(period_labels)), dtype=np.int32),
+        np.zeros((len(institution_labels), len(period_labels)),
+                 dtype=np.int32),
+        np.zeros((len(term_labels), len(period_labels)), dtype=np.int32),
+        np.zeros(len(period_labels), dtype=np.int32))
+    index = cube._index
+    for (term, institution, month), count in counts.items():
+        cube.counts[index["term"][term], index["institution"][institution],
+                    index["period"][month]] = count
+    for (institution, month), count in paragraphs.items():
+        cube.paragraphs[index["institution"][institution],
+                        index["period"][month]] = count
+    for (term, month), count in totals.items():
+        cube.totals[index["term"][term], index["period"][month]] = count
+    for month, count in total_paragraphs.items():
+        cube.total_paragraphs[index["period"][month]] = count
+    return cube
+
+
+@click.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('cube_filename', default='data/processed/term_cube.npz', type=click.Path())
+@click.option('--term', 'terms', multiple=True,
+              help='Extra phrase to count besides the gazetteers.')
+def main(dataset_filename, cube_filename, terms):
+    """ Materialize the term x institution x month cube of the dataset """
+    logger = logging.getLogger(__name__)
+    logger.info('building %s from %s', cube_filename, dataset_filename)
+    cube = build_cube(read_dataset(dataset_filename), terms=terms)
+    cube.save(cube_filename)
+    logger.info(cube)
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Paragraph Embedding Store
+-------------------------
+Paragraph vectors (mean of the ``en_core_web_lg`` word vectors, L2
+normalized) computed once and kept on disk as a ``float16`` memory-mapped
+matrix whose rows follow the order of the records in ``dataset.json``::
+
+    embeddings/
+        vectors.f16     <- (n, dim) float16, row i = i-th dataset record
+        records.jsonl   <- per row: key, filename, institution, date
+        meta.json       <- vector dimensions
+        ivf.npz         <- coarse centroids and inverted lists
+
+Similar passages are found with an inverted file (IVF) index: vectors are
+clustered with k-means and a query only scans the ``nprobe`` clusters
+closest to it. With institution or date filters, further clusters are
+scanned (closest first) until `k` passages pass the filters.
+:meth:`EmbeddingStore.recall` measures how many of the exact (brute force)
+neighbours the approximate search returns, with or without filters.
+"""
+import json
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.catalog import normalize_date, split_institutions
+from src.data.records import read_dataset, record_key
+
+VECTORS = "vectors.f16"
+RECORDS = "records.jsonl"
+IVF = "ivf.npz"
+
+
+def paragraph_vectors(texts, nlp, batch_size=256):
+    """ Yield one unit-length float32 vector per text """
+    for doc in nlp.pipe(texts, batch_size=batch_size):
+        vector = doc.vector.astype(np.float32)
+        norm = np.linalg.norm(vector)
+        yield vector / norm if norm else vector
+
+
+def kmeans(vectors, k, iterations=20, sample_size=20000, seed=0):
+    """ Spherical k-means centroids of `vectors` (rows unit-length) """
+    rng = np.random.RandomState(seed)
+    n = vectors.shape[0]
+    if n > sample_size:
+        vectors = vectors[np.sort(rng.choice(n, sample_size, replace=False))]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, vectors.shape[0])
+    centroids = vectors[rng.choice(vectors.shape[0], k, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignment == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                centroids[c] = centroid / norm if norm else centroid
+    return centroids
+
+
+class EmbeddingStore(object):
+    """
+    Memory-mapped paragraph vectors plus their IVF index.
+
+    Args:
+        path (str): Directory written by :meth:`build`.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = []
+        with open(self.path / RECORDS) as f:
+            for line in f:
+                self.records.append(json.loads(line))
+        with open(self.path / "meta.json") as f:
+            self.dim = json.load(f)["dim"]
+        if self.records:
+            self.vectors = np.memmap(self.path / VECTORS, dtype=np.float16,
+                                     mode="r", shape=(len(self.records),
+                                                      self.dim))
+        else:
+            # an empty file cannot be memory-mapped
+            self.vectors = np.zeros((0, self.dim), dtype=np.float16)
+        self.keys = dict((r["key"], i) for i, r in enumerate(self.records))
+        self._dates = np.array([r["date"] or "" for r in self.records])
+        self._filenames = np.array(
+            [r["filename"] or "" for r in self.records])
+        self._institution_masks = {}
+        self.centroids = self.lists = self.offsets = None
+        if (self.path / IVF).is_file():
+            with np.load(self.path / IVF) as ivf:
+                self.centroids = ivf["centroids"]
+                self.lists = ivf["lists"]
+                self.offsets = ivf["offsets"]
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def build(cls, records, path, nlp, n_lists=None, batch_size=256):
+        """
+        Embed dataset `records` into a new store at `path` and index it.
+
+        Args:
+            nlp (:class:`spacy.language.Language`): Pipeline with word
+                vectors; only the tokenizer runs, so pass one loaded with
+                ``disable=["tagger", "parser", "ner"]``.
+            n_lists (int): IVF clusters, ``~sqrt(n)`` by default.
+        """
+        logger = logging.getLogger(__name__)
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        rows = []
+
+        def texts():
+            for record in records:
+                rows.append({
+                    "key": record_key(record),
+                    "filename": record.get("filename"),
+                    "institution": split_institutions(
+                        record.get("institution")),
+                    "date": normalize_date(record.get("date")),
+                })
+                yield record.get("text", "")
+
+        dim = nlp.vocab.vectors_length
+        with open(path / VECTORS, "wb") as f:
+            for vector in paragraph_vectors(texts(), nlp, batch_size):
+                f.write(vector.astype(np.float16).tobytes())
+        with open(path / RECORDS, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row))
+                f.write("\n")
+        with open(path / "meta.json", "w") as f:
+            json.dump({"dim": dim}, f)
+        logger.info("embedded %d paragraphs (%d dimensions)", len(rows), dim)
+        store = cls(path)
+        store.build_ivf(n_lists)
+        return store
+
+    def build_ivf(self, n_lists=None, iterations=20):
+        """ Cluster the vectors and write the inverted lists """
+        n = len(self)
+        if not n:
+            return
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        centroids = kmeans(self.vectors, n_lists, iterations)
+        assignment = np.empty(n, dtype=np.int32)
+        for start in range(0, n, 65536):
+            chunk = np.asarray(self.vectors[start:start + 65536],
+                               dtype=np.float32)
+            assignment[start:start + 65536] = np.argmax(
+                chunk @ centroids.T, axis=1)
+        lists = np.argsort(assignment, kind="stable").astype(np.int32)
+        offsets = np.searchsorted(assignment[lists],
+                                  np.arange(len(centroids) + 1))
+        np.savez(self.path / IVF, centroids=centroids, lists=lists,
+                 offsets=offsets)
+        self.centroids, self.lists, self.offsets = centroids, lists, offsets
+
+    def _institution_mask(self, institution):
+        if institution not in self._institution_masks:
+            self._institution_masks[institution] = np.array(
+                [institution in r["institution"] for r in self.records],
+                dtype=bool)
+        return self._institution_masks[institution]
+
+    def mask(self, institution=None, date_range=None):
+        """ Boolean row mask for the filters, ``None`` if there are none """
+        if institution is None and date_range is None:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        if institution is not None:
+            if isinstance(institution, str):
+                institution = [institution]
+            published = np.zeros(len(self), dtype=bool)
+            for name in institution:
+                published |= self._institution_mask(name)
+            mask &= published
+        if date_range is not None:
+            mask &= ((self._dates != "")
+                     & (self._dates >= (date_range[0] or ""))
+                     & (self._dates < (date_range[1] or "9999")))
+        return mask
+
+    def _top(self, candidates, query, k, mask):
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if not len(candidates):
+            return []
+        scores = np.asarray(self.vectors[candidates],
+                            dtype=np.float32) @ query
+        best = np.argsort(-scores)[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+
+    def brute_force(self, query, k=10, institution=None, date_range=None):
+        """ Exact top `k` ``(row, cosine)`` pairs """
+        mask = self.mask(institution, date_range)
+        return self._top(np.arange(len(self)), _unit(query), k, mask)
+
+    def search(self, query, k=10, nprobe=8, institution=None,
+               date_range=None):
+        """
+        Approximate top `k` ``(row, cosine)`` pairs for vector `query`.
+
+        Args:
+            nprobe (int): Number of closest IVF lists to scan; higher is
+                slower and more accurate. With filters, more lists are
+                scanned if these hold fewer than `k` matching passages.
+            institution (str or Set[str]): Publishing institution(s).
+            date_range (Tuple[str]): ISO ``(start, end)``, end exclusive.
+        """
+        return self._search(query, k, nprobe,
+                            self.mask(institution, date_range))
+
+    def _search(self, query, k, nprobe, mask):
+        if self.centroids is None:
+            return self._top(np.arange(len(self)), _unit(query), k, mask)
+        query = _unit(query)
+        order = np.argsort(-(self.centroids @ query))
+        n = max(1, nprobe)
+        while True:
+            candidates = np.concatenate([
+                self.lists[self.offsets[c]:self.offsets[c + 1]]
+                for c in order[:n]])
+            # a selective filter leaves fewer than k of the closest lists'
+            # vectors: probe twice as many lists, until all are scanned
+            if (mask is None or n >= len(order)
+                    or np.count_nonzero(mask[candidates]) >= k):
+                return self._top(candidates, query, k, mask)
+            n *= 2
+
+    def similar(self, key, k=10, exclude_same_file=True, nprobe=8,
+                institution=None, date_range=None):
+        """ Paragraphs most similar to the dataset record `key` """
+        row = self.keys[key]
+        mask = self.mask(institution, date_range)
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        if exclude_same_file:
+            mask &= self._filenames != self._filenames[row]
+        mask[row] = False
+        hits = self._search(self.vectors[row], k, nprobe, mask)
+        return [(self.records[i]["key"], s) for i, s in hits]
+
+    def recall(self, k=10, nprobe=8, n_queries=200, seed=0,
+               institution=None, date_range=None):
+        """
+        Mean recall@k of :meth:`search` against :meth:`brute_force`, with
+        the given filters applied to both; ``nan`` for an empty store.
+        """
+        if not len(self):
+            return float("nan")
+        rng = np.random.RandomState(seed)
+        rows = rng.choice(len(self), min(n_queries, len(self)),
+                          replace=False)
+        total = 0.0
+        for row in rows:
+            query = self.vectors[row]
+            exact = set(i for i, _ in self.brute_force(
+                query, k, institution, date_range))
+            approx = set(i for i, _ in self.search(
+                query, k, nprobe, institution, date_range))
+            total += len(exact & approx) / float(len(exact) or 1)
+        return total / len(rows)
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@click.group()
+def cli():
+    """ Build and query the paragraph embedding store """
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('store_path', default='data/processed/embeddings', type=click.Path())
+@click.option('--lang', default='en_core_web_lg')
+@click.option('--n-lists', default=None, type=int)
+def build(dataset_filename, store_path, lang, n_lists):
+    """ Embed every paragraph of the dataset """
+    import spacy
+    logger = logging.getLogger(__name__)
+    logger.info('embedding %s into %s', dataset_filename, store_path)
+    nlp = spacy.load(lang, disable=["tagger", "parser", "ner"])
+    store = EmbeddingStore.build(read_dataset(dataset_filename), store_path,
+                                 nlp, n_lists=n_lists)
+    logger.info('recall@10 (nprobe=8): %.3f', store.recall())
+
+
+@cli.command()
+@click.argument('key')
+@click.option('--store-path', default='data/processed/embeddings', type=click.Path(exists=True))
+@click.option('--institution', multiple=True)
+@click.option('--start', default=None, help='ISO date, inclusive.')
+@click.option('--end', default=None, help='ISO date, exclusive.')
+@click.option('-k', default=10)
+@click.option('--nprobe', default=8)
+def similar(key, store_path, institution, start, end, k, nprobe):
+    """ Print the paragraphs most similar to dataset record KEY """
+    store = EmbeddingStore(store_path)
+    date_range = (start, end) if start or end else None
+    for other, score in store.similar(key, k=k, nprobe=nprobe,
+                                      institution=institution or None,
+                                      date_range=date_range):
+        click.echo("{:.3f}  {}".format(score, other))
+
+
+@cli.command()
+@click.option('--store-path', default='data/processed/embeddings', type=click.Path(exists=True))
+@click.option('-k', default=10)
+@click.option('--nprobe', multiple=True, type=int, default=(1, 4, 8, 16))
+@click.option('--institution', multiple=True)
+@click.option('--start', default=None, help='ISO date, inclusive.')
+@click.option('--end', default=None, help='ISO date, exclusive.')
+def recall(store_path, k, nprobe, institution, start, end):
+    """ Report recall@k of the IVF search against brute force, without
+        and (if any are given) with filters """
+    store = EmbeddingStore(store_path)
+    date_range = (start, end) if start or end else None
+    filtered = bool(institution or date_range)
+    for n in nprobe:
+        line = "nprobe={:<4d} recall@{}={:.3f}".format(
+            n, k, store.recall(k=k, nprobe=n))
+        if filtered:
+            line += "  filtered={:.3f}".format(store.recall(
+                k=k, nprobe=n, institution=institution or None,
+                date_range=date_range))
+        click.echo(line)
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
@@ -18,6 +18,43 @@ _technology_terms = (u"dlt", u"blockchain", u"distributed ledger technology", u"
 "bitstamp", "bitfinex", )
 # _tech_entity_matcher = EntityMatcher(nlp, terms, "ANIMAL")
 
+# Canonical name -> lowercase surface forms, for matchers that need to know
+# which entity was mentioned rather than just that one was.
+_financial_institution_aliases = {
+    "ECB": ("ecb", "european central bank"),
+    "BoJ": ("boj", "bank of japan"),
+    "BoE": ("boe", "bank of england"),
+    "BdF": ("bdf", "banque de france"),
+    "BIS": ("bis", "bank for international settlements",
+            "bank of international settlements"),
+    "CPMI": ("cpmi", "committee on payments and market infrastructures"),
+    "CPSS": ("cpss", "committee on payment and settlement systems"),
+    "Bundesbank": ("bundesbank", "deutsche bundesbank"),
+    "Deutsche Börse": ("deutsche börse", "deutsche boerse"),
+    "Fed": ("federal reserve", "federal reserve board"),
+    "IMF": ("imf", "international monetary fund"),
+    "BoT": ("bank of thailand",),
+    "Riksbank": ("riksbank", "sveriges riksbank"),
+    "BNM": ("bank negara malaysia", "central bank of malaysia"),
+    "R3": ("r3",),
+    "JP Morgan": ("jp morgan", "j.p. morgan", "jpmorgan"),
+}
+
+_technology_aliases = {
+    "DLT": ("dlt", "distributed ledger technology", "distributed ledger",
+            "distributed ledgers"),
+    "blockchain": ("blockchain", "blockchains"),
+    "CBDC": ("cbdc", "cbdcs", "central bank digital currency",
+             "central bank digital currencies"),
+    "Corda": ("corda",),
+    "Hyperledger": ("hyperledger", "hyperledger fabric"),
+    "Ethereum": ("ethereum",),
+    "Bitcoin": ("bitcoin",),
+    "Stellar": ("stellar",),
+    "smart contract": ("smart contract", "smart contracts"),
+    "consensus": ("consensus mechanism", "consensus algorithm", "pbft"),
+}
+
 def financial_matcher_factory(nlp):
     matcher = PhraseMatcher(nlp.vocab, attr='LOWER')
     patterns = [nlp.make_doc(text) for text in _financial_terms]
@@ -32,6 +69,21 @@ def tech_matcher_factory(nlp):
     return matcher
 
 
+def gazetteer_matcher_factory(nlp, gazetteers=None):
+    """PhraseMatcher whose match ids are ``"<LABEL>:<canonical name>"``, so
+    every alias of an entity resolves to the same key. `gazetteers` maps a
+    label to a dict of canonical name -> surface forms."""
+    if gazetteers is None:
+        gazetteers = {"ORG": _financial_institution_aliases,
+                      "TECH": _technology_aliases}
+    matcher = PhraseMatcher(nlp.vocab, attr='LOWER')
+    for label, aliases in gazetteers.items():
+        for name, forms in aliases.items():
+            patterns = [nlp.make_doc(text) for text in forms]
+            matcher.add("{}:{}".format(label, name), None, *patterns)
+    return matcher
+
+
 class FinancialEntityRecognizer(object):
     """Example of a spaCy v2.0 pipeline component that sets entity annotations
     based on list of single or multiple-word company names. Companies are
@@ -79,11 +131,12 @@ class FinancialEntityRecognizer(object):
                 token._.set("is_financial_org", True)
             # Overwrite doc.ents and add entity – be careful not to replace!
             doc.ents = list(doc.ents) + [entity]
-        for span in spans:
-            # Iterate over all spans and merge them into one token. This is done
-            # after setting the entities – otherwise, it would cause mismatched
-            # indices!
-            span.merge()
+        with doc.retokenize() as retokenizer:
+            for span in spans:
+                # Iterate over all spans and merge them into one token. This is
+                # done after setting the entities – otherwise, it would cause
+                # mismatched indices! (Span.merge is gone in spaCy 3.)
+                retokenizer.merge(span)
         return doc  # don't forget to return the Doc!
 
     def has_financial_org(self, tokens):
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+Paragraph Search Index
+----------------------
+A persistent, BM25-ranked full-text index over the paragraphs of the
+blockchain papers dataset (``dataset.json``, one record per line).
+
+An index is a directory holding a small manifest and a list of immutable
+segments::
+
+    search_index/
+        index.json           <- live segments and deleted paragraphs
+        seg-000001/
+            postings.bin     <- delta + varint compressed posting lists
+            lexicon.json     <- term -> [offset, nbytes, document frequency]
+            docs.jsonl       <- per paragraph: key, length, facets and
+                                    the offset of its text
+            texts.bin        <- paragraph texts, utf-8
+
+Adding records writes a new segment and never touches existing ones, so the
+index can be updated incrementally as new publications are added to the
+dataset. Re-indexing a filename marks its previous paragraphs as deleted;
+:meth:`SearchIndex.compact` folds everything back into a single segment.
+Posting and text files are memory-mapped: only the lists of the queried
+terms are decoded and only the texts of the returned hits are read.
+
+Usage::
+
+    >>> index = SearchIndex.build("dataset.json", "data/processed/search_index")
+    >>> index.search("atomic settlement", institution="Bank of England")
+    [Hit(score=12.3, key='d157.pdf#sec-2#3', ...), ...]
+"""
+import collections
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.catalog import normalize_date, split_institutions
+from src.data.records import read_dataset, record_key
+
+MANIFEST = "index.json"
+POSTINGS = "postings.bin"
+LEXICON = "lexicon.json"
+DOCS = "docs.jsonl"
+TEXTS = "texts.bin"
+
+TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+Hit = collections.namedtuple(
+    "Hit", ["score", "key", "filename", "institution", "date", "text"])
+
+
+def tokenize(text):
+    """ Lowercased alphanumeric tokens of `text` """
+    return TOKEN_RE.findall(text.lower())
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_postings(postings):
+    """ Compress sorted ``(doc_id, tf)`` pairs as varint doc gaps + tf """
+    out = bytearray()
+    previous = 0
+    for doc_id, tf in postings:
+        encode_varint(doc_id - previous, out)
+        encode_varint(tf, out)
+        previous = doc_id
+    return bytes(out)
+
+
+def decode_postings(buf, offset, nbytes):
+    """ Inverse of :func:`encode_postings` over a slice of `buf` """
+    end = offset + nbytes
+    doc_id = 0
+    values = []
+    shift = value = 0
+    for byte in buf[offset:end]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        shift = value = 0
+    for i in range(0, len(values), 2):
+        doc_id += values[i]
+        yield doc_id, values[i + 1]
+
+
+def _map(path):
+    """ ``(file, buffer)``: a read-only map of `path`, ``b""`` if empty """
+    f = open(path, "rb")
+    if not os.fstat(f.fileno()).st_size:
+        return f, b""
+    return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment(object):
+    """ An immutable, memory-mapped slice of the index """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / LEXICON) as f:
+            self.lexicon = json.load(f)
+        self.docs = []
+        with open(self.path / DOCS) as f:
+            for line in f:
+                self.docs.append(json.loads(line))
+        self._file, self._buf = _map(self.path / POSTINGS)
+        self._texts_file, self._texts = _map(self.path / TEXTS)
+        self._facets = None
+
+    @classmethod
+    def write(cls, path, records):
+        """
+        Invert `records` into a new segment directory at `path`; the files
+        are written to ``<path>.tmp`` and renamed into place when complete,
+        so a crash never leaves a partial segment behind.
+        """
+        final = Path(path)
+        path = final.with_name(final.name + ".tmp")
+        if path.exists():
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+        inverted = collections.defaultdict(list)
+        offset = 0
+        with open(path / DOCS, "w") as f, open(path / TEXTS, "wb") as texts:
+            for doc_id, record in enumerate(records):
+                text = record.get("text", "")
+                counts = collections.Counter(tokenize(text))
+                for term, tf in counts.items():
+                    inverted[term].append((doc_id, tf))
+                data = text.encode("utf-8")
+                texts.write(data)
+                f.write(json.dumps({
+                    "key": record_key(record),
+                    "length": sum(counts.values()),
+                    "filename": record.get("filename"),
+                    "institution": split_institutions(
+                        record.get("institution")),
+                    "date": normalize_date(record.get("date")),
+                    "text_offset": offset,
+                    "text_bytes": len(data),
+                }))
+                f.write("\n")
+                offset += len(data)
+        lexicon = {}
+        with open(path / POSTINGS, "wb") as f:
+            offset = 0
+            for term in sorted(inverted):
+                data = encode_postings(inverted[term])
+                f.write(data)
+                lexicon[term] = [offset, len(data), len(inverted[term])]
+                offset += len(data)
+        with open(path / LEXICON, "w") as f:
+            json.dump(lexicon, f)
+        os.rename(path, final)
+        return cls(final)
+
+    def close(self):
+        for buf, f in ((self._buf, self._file),
+                       (self._texts, self._texts_file)):
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+            f.close()
+
+    def text(self, doc_id):
+        """ Text of local document `doc_id`, read from the text map """
+        doc = self.docs[doc_id]
+        start = doc["text_offset"]
+        return self._texts[start:start + doc["text_bytes"]].decode("utf-8")
+
+    def df(self, term):
+        entry = self.lexicon.get(term)
+        return entry[2] if entry else 0
+
+    def postings(self, term):
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return iter(())
+        return decode_postings(self._buf, entry[0], entry[1])
+
+    @property
+    def facets(self):
+        """ Dict[str, Dict[str, Set[int]]]: local doc ids by facet value """
+        if self._facets is None:
+            facets = {
+                "filename": collections.defaultdict(set),
+                "institution": collections.defaultdict(set),
+            }
+            for doc_id, doc in enumerate(self.docs):
+                facets["filename"][doc["filename"]].add(doc_id)
+                for institution in doc["institution"]:
+                    facets["institution"][institution].add(doc_id)
+            self._facets = facets
+        return self._facets
+
+    def allowed(self, filename, institution, date_range, deleted):
+        """ Set of local doc ids passing all filters, ``None`` if all do """
+        allowed = None
+        for facet, values in (("filename", filename),
+                              ("institution", institution)):
+            if values is None:
+                continue
+            ids = set()
+            for value in values:
+                ids |= self.facets[facet].get(value, set())
+            allowed = ids if allowed is None else allowed & ids
+        if date_range is not None:
+            start, end = date_range
+            ids = set(
+                doc_id for doc_id, doc in enumerate(self.docs)
+                if doc["date"] and start <= doc["date"] < end)
+            allowed = ids if allowed is None else allowed & ids
+        if deleted:
+            if allowed is None:
+                allowed = set(range(len(self.docs)))
+            allowed -= deleted
+        return allowed
+
+
+class SearchIndex(object):
+    """
+    BM25 search over dataset paragraphs, persisted under `path`.
+
+    Args:
+        path (str): Directory of the index; created if missing.
+        k1 (float): BM25 term frequency saturation.
+        b (float): BM25 document length normalisation.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = Path(path)
+        self.k1 = k1
+        self.b = b
+        self.path.mkdir(parents=True, exist_ok=True)
+        manifest = self.path / MANIFEST
+        if manifest.is_file():
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"segments": [], "deleted": {}, "next": 1}
+        self.segments = [
+            Segment(self.path / name) for name in self.manifest["segments"]]
+        self._refresh_stats()
+
+    @classmethod
+    def build(cls, dataset_filename, path, **kwargs):
+        """ Create a fresh index at `path` from a dataset file """
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        index = cls(path, **kwargs)
+        index.add_records(read_dataset(dataset_filename))
+        return index
+
+    def __len__(self):
+        return self.num_docs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    @property
+    def filenames(self):
+        """ Set[str]: filenames with at least one live paragraph indexed """
+        return set(
+            doc["filename"]
+            for segment, deleted in self._segments_with_deletions()
+            for doc_id, doc in enumerate(segment.docs)
+            if doc_id not in deleted)
+
+    def _segments_with_deletions(self):
+        for segment in self.segments:
+            deleted = set(self.manifest["deleted"].get(segment.path.name, []))
+            yield segment, deleted
+
+    def _refresh_stats(self):
+        num_docs = total_length = 0
+        for segment, deleted in self._segments_with_deletions():
+            for doc_id, doc in enumerate(segment.docs):
+                if doc_id not in deleted:
+                    num_docs += 1
+                    total_length += doc["length"]
+        self.num_docs = num_docs
+        self.avg_length = total_length / num_docs if num_docs else 0.0
+
+    def _save_manifest(self):
+        tmp = self.path / (MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.path / MANIFEST)
+
+    def delete_filenames(self, filenames):
+        """ Mark every indexed paragraph of `filenames` as deleted """
+        filenames = set(filenames)
+        for segment, deleted in self._segments_with_deletions():
+            ids = deleted | set(
+                doc_id for doc_id, doc in enumerate(segment.docs)
+                if doc["filename"] in filenames)
+            if ids:
+                self.manifest["deleted"][segment.path.name] = sorted(ids)
+        self._save_manifest()
+        self._refresh_stats()
+
+    def add_records(self, records):
+        """
+        Index `records` as a new segment. Paragraphs previously indexed for
+        the same filenames are replaced.
+
+        Returns:
+            int: number of paragraphs added.
+        """
+        records = list(records)
+        if not records:
+            return 0
+        self.delete_filenames(set(r.get("filename") for r in records))
+        name = "seg-{:06d}".format(self.manifest["next"])
+        if (self.path / name).exists():
+            # written by a run that crashed before saving the manifest
+            shutil.rmtree(self.path / name)
+        self.segments.append(Segment.write(self.path / name, records))
+        self.manifest["segments"].append(name)
+        self.manifest["next"] += 1
+        self._save_manifest()
+        self._refresh_stats()
+        logging.getLogger(__name__).info(
+            "indexed %d paragraphs into %s", len(records), name)
+        return len(records)
+
+    def update(self, dataset_filename, refresh=()):
+        """
+        Index the paragraphs of filenames in `dataset_filename` which are not
+        in the index yet, plus those of the filenames in `refresh`.
+        """
+        known = self.filenames - set(refresh)
+        return self.add_records(
+            r for r in read_dataset(dataset_filename)
+            if r.get("filename") not in known)
+
+    def compact(self):
+        """ Rewrite all live paragraphs into a single segment """
+        records = []
+        for segment, deleted in self._segments_with_deletions():
+            for doc_id, doc in enumerate(segment.docs):
+                if doc_id in deleted:
+                    continue
+                _, section_id, paragraph_id = doc["key"].rsplit("#", 2)
+                records.append({
+                    "filename": doc["filename"],
+                    "section_id": section_id,
+                    "paragraph_id": paragraph_id,
+                    "institution": ", ".join(doc["institution"]),
+                    "date": doc["date"],
+                    "text": segment.text(doc_id),
+                })
+        old = list(self.manifest["segments"])
+        self.close()
+        self.segments = []
+        self.manifest["segments"] = []
+        self.manifest["deleted"] = {}
+        self.add_records(records)
+        # add_records saves nothing when no paragraph is left
+        self._save_manifest()
+        self._refresh_stats()
+        for name in old:
+            shutil.rmtree(self.path / name)
+
+    def idf(self, term):
+        df = sum(segment.df(term) for segment in self.segments)
+        return math.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query, filename=None, institution=None, date_range=None,
+               limit=10):
+        """
+        Rank paragraphs against `query` with BM25.
+
+        Document frequencies include deleted paragraphs until the next
+        :meth:`compact`, which slightly skews scores after many updates.
+
+        Args:
+            query (str): Free text; terms are OR-ed.
+            filename (str or Set[str]): Only paragraphs of these filenames.
+            institution (str or Set[str]): Only paragraphs published by ANY
+                of these institutions.
+            date_range (Tuple[str]): ISO ``(start, end)`` publication dates,
+                end exclusive; ``None`` on either side leaves it open.
+            limit (int): Number of hits to return.
+        Returns:
+            List[Hit]: best hits first.
+        """
+        terms = set(tokenize(query))
+        filename = _as_set(filename)
+        institution = _as_set(institution)
+        if date_range is not None:
+            date_range = (date_range[0] or "0000-00-00",
+                          date_range[1] or "9999-99-99")
+        idfs = dict((term, self.idf(term)) for term in terms)
+        k1, b, avg_length = self.k1, self.b, self.avg_length or 1.0
+        scored = []
+        for segment, deleted in self._segments_with_deletions():
+            allowed = segment.allowed(
+                filename, institution, date_range, deleted)
+            if allowed is not None and not allowed:
+                continue
+            scores = collections.defaultdict(float)
+            for term in terms:
+                idf = idfs[term]
+                for doc_id, tf in segment.postings(term):
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = k1 * (1 - b + b * segment.docs[doc_id]["length"]
+                                 / avg_length)
+                    scores[doc_id] += idf * tf * (k1 + 1) / (tf + norm)
+            scored.extend(
+                (score, segment, doc_id) for doc_id, score in scores.items())
+        best = heapq.nlargest(limit, scored, key=lambda s: s[0])
+        hits = []
+        for score, segment, doc_id in best:
+            doc = segment.docs[doc_id]
+            hits.append(Hit(score, doc["key"], doc["filename"],
+                            ", ".join(doc["institution"]), doc["date"],
+                            segment.text(doc_id)))
+        return hits
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return {value}
+    return set(value)
+
+
+@click.group()
+def cli():
+    """ Build and query the paragraph search index """
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('index_path', default='data/processed/search_index', type=click.Path())
+@click.option('--incremental/--rebuild', default=True,
+              help='Only index filenames not yet in the index.')
+@click.option('--refresh', multiple=True,
+              help='Re-index this filename even if already indexed.')
+@click.option('--compact', is_flag=True, help='Merge segments afterwards.')
+def build(dataset_filename, index_path, incremental, refresh, compact):
+    """ Index the paragraphs of `dataset_filename` under `index_path` """
+    logger = logging.getLogger(__name__)
+    logger.info('indexing %s into %s', dataset_filename, index_path)
+    if incremental:
+        index = SearchIndex(index_path)
+        index.update(dataset_filename, refresh=refresh)
+    else:
+        index = SearchIndex.build(dataset_filename, index_path)
+    if compact:
+        index.compact()
+    logger.info('%d paragraphs in %d segments',
+                len(index), len(index.segments))
+    index.close()
+
+
+@cli.command()
+@click.argument('query')
+@click.option('--index-path', default='data/processed/search_index', type=click.Path(exists=True))
+@click.option('--filename', multiple=True)
+@click.option('--institution', multiple=True)
+@click.option('--start', default=None, help='ISO date, inclusive.')
+@click.option('--end', default=None, help='ISO date, exclusive.')
+@click.option('--limit', default=10)
+def query(query, index_path, filename, institution, start, end, limit):
+    """ Print the best paragraphs for `query` """
+    date_range = (start, end) if start or end else None
+    with SearchIndex(index_path) as index:
+        hits = index.search(query, filename=filename or None,
+                            institution=institution or None,
+                            date_range=date_range, limit=limit)
+        for hit in hits:
+            click.echo("{:8.3f}  {}  {}  {}".format(
+                hit.score, hit.key, hit.institution, hit.date))
+            click.echo("          " + hit.text[:200])
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
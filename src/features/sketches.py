@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+Heavy-Hitter Sketches
+---------------------
+Approximate token, n-gram and entity counts per publishing institution in
+fixed memory, however large the corpus grows.
+
+Each ``(institution, kind)`` pair, with kind ``token``, ``ngram`` (2 to 4
+tokens, as used by sgrank) or ``entity`` (gazetteer matches), keeps a
+:class:`HeavyHitters`: a count-min sketch plus the ``k`` items with the
+highest estimated counts.
+
+Error bounds, for a sketch of width ``w`` and depth ``d`` that has counted
+``N`` occurrences in total:
+
+    * count-min estimates never undercount, and overcount by at most
+      ``e / w * N`` with probability at least ``1 - exp(-d)``
+      (:meth:`CountMinSketch.from_error` picks ``w`` and ``d`` for a given
+      ``epsilon`` and ``delta``);
+    * with the same probability, every item counted more than
+      ``N / k + e / w * N`` times is among the top ``k``.
+
+Sketches built with the same width, depth and seed are merged by adding
+their tables, which keeps the bounds with ``N`` the combined total, so
+shards of the dataset can be counted in separate processes
+(:func:`build_statistics` with ``workers``) or separate runs and merged
+afterwards. Items are hashed with blake2b, not :func:`hash`, so indices are
+the same in every process.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+from pathlib import Path
+
+import click
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.catalog import split_institutions
+from src.data.records import read_dataset
+from src.features.search_index import tokenize
+
+KINDS = ("token", "ngram", "entity")
+NGRAM_RANGE = (2, 4)
+
+
+def _hashes(items, seed):
+    """ Two 32 bit hashes per item, for double hashing """
+    key = seed.to_bytes(8, "little")
+    digests = b"".join(
+        hashlib.blake2b(item.encode("utf-8"), digest_size=8, key=key).digest()
+        for item in items)
+    h = np.frombuffer(digests, dtype="<u8")
+    return h & 0xFFFFFFFF, (h >> np.uint64(32)) | np.uint64(1)
+
+
+class CountMinSketch(object):
+    """
+    Args:
+        width (int): Counters per row; the error is ``e / width`` of the
+            total count.
+        depth (int): Rows; the error bound fails with probability
+            ``exp(-depth)``.
+        seed (int): Hash seed; only sketches with equal seeds merge.
+    """
+
+    def __init__(self, width=2 ** 14, depth=4, seed=0, table=None, total=0):
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.table = (table if table is not None
+                      else np.zeros((depth, width), dtype=np.uint32))
+        self.total = total
+        self._rows = np.arange(depth, dtype=np.uint64)[:, None]
+
+    @classmethod
+    def from_error(cls, epsilon=2e-4, delta=0.02, seed=0):
+        """ Sketch overcounting by at most `epsilon` * total with
+            probability ``1 - delta`` """
+        return cls(int(math.ceil(math.e / epsilon)),
+                   int(math.ceil(math.log(1 / delta))), seed)
+
+    @property
+    def epsilon(self):
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+
+    @property
+    def error(self):
+        """ int: overcount bound for the current total """
+        return int(math.ceil(self.epsilon * self.total))
+
+    def _cells(self, items):
+        h1, h2 = _hashes(items, self.seed)
+        return ((h1[None, :] + self._rows * h2[None, :])
+                % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, items, counts=None):
+        """
+        Count `items` (a list of str) `counts` times each (default once).
+
+        Returns:
+            :class:`numpy.ndarray`: the items' estimates after the update.
+        """
+        if not items:
+            return np.zeros(0, dtype=np.uint32)
+        counts = (np.ones(len(items), dtype=np.uint32) if counts is None
+                  else np.asarray(counts, dtype=np.uint32))
+        cells = self._cells(items)
+        for row in range(self.depth):
+            np.add.at(self.table[row], cells[row], counts)
+        self.total += int(counts.sum())
+        return self.table[np.arange(self.depth)[:, None], cells].min(axis=0)
+
+    def estimate(self, items):
+        if not items:
+            return np.zeros(0, dtype=np.uint32)
+        cells = self._cells(items)
+        return self.table[np.arange(self.depth)[:, None], cells].min(axis=0)
+
+    def __getitem__(self, item):
+        return int(self.estimate([item])[0])
+
+    def _check_compatible(self, other):
+        if (self.width, self.depth, self.seed) != (
+                other.width, other.depth, other.seed):
+            raise ValueError("sketches differ in width, depth or seed")
+
+    def merge(self, other):
+        """ Add the counts of `other` into this sketch """
+        self._check_compatible(other)
+        self.table += other.table
+        self.total += other.total
+        return self
+
+
+class HeavyHitters(object):
+    """
+    Count-min sketch tracking the `k` items with the highest estimates.
+
+    Args:
+        k (int): Number of heavy hitters kept.
+        width, depth, seed: see :class:`CountMinSketch`.
+    """
+
+    def __init__(self, k=1000, width=2 ** 14, depth=4, seed=0, sketch=None):
+        self.k = k
+        self.sketch = sketch or CountMinSketch(width, depth, seed)
+        # item -> estimate; at most k entries
+        self.top = {}
+        # lazy min-heap of (estimate, item) over self.top
+        self._heap = []
+
+    @property
+    def total(self):
+        return self.sketch.total
+
+    @property
+    def error(self):
+        return self.sketch.error
+
+    def _minimum(self):
+        heap = self._heap
+        while heap and self.top.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else (0, None)
+
+    def _offer(self, item, estimate):
+        if item in self.top:
+            self.top[item] = estimate
+        elif len(self.top) < self.k:
+            self.top[item] = estimate
+        else:
+            low, low_item = self._minimum()
+            if estimate <= low:
+                return
+            del self.top[low_item]
+            heapq.heappop(self._heap)
+            self.top[item] = estimate
+        heapq.heappush(self._heap, (estimate, item))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(e, i) for i, e in self.top.items()]
+            heapq.heapify(self._heap)
+
+    def update(self, counts):
+        """ Count a ``{item: count}`` mapping (e.g. a Counter) """
+        items = list(counts)
+        estimates = self.sketch.add(items, [counts[i] for i in items])
+        low = self._minimum()[0] if len(self.top) >= self.k else -1
+        for item, estimate in zip(items, estimates.tolist()):
+            if estimate > low or item in self.top:
+                self._offer(item, estimate)
+                if len(self.top) >= self.k:
+                    low = self._minimum()[0]
+
+    def most_common(self, n=None):
+        """ ``(item, estimate)`` pairs, highest first """
+        return sorted(self.top.items(), key=lambda x: (-x[1], x[0]))[:n]
+
+    def merge(self, other):
+        """ Merge `other` in; candidates are re-ranked on the merged sketch """
+        self.sketch.merge(other.sketch)
+        candidates = list(set(self.top) | set(other.top))
+        estimates = self.sketch.estimate(candidates).tolist()
+        ranked = sorted(zip(candidates, estimates),
+                        key=lambda x: (-x[1], x[0]))[:self.k]
+        self.top = dict(ranked)
+        self._heap = [(e, i) for i, e in ranked]
+        heapq.heapify(self._heap)
+        return self
+
+
+class TermStatistics(object):
+    """
+    Heavy hitters per ``(institution, kind)``. Co-published documents count
+    for each of their institutions.
+
+    Args:
+        k (int): Heavy hitters kept per sketch.
+        width, depth, seed: Sketch parameters, shared by all sketches.
+        entities (bool): Also count gazetteer entities; needs spaCy.
+    """
+
+    def __init__(self, k=1000, width=2 ** 14, depth=4, seed=0,
+                 entities=True):
+        self.params = {"k": k, "width": width, "depth": depth, "seed": seed}
+        self.entities = entities
+        self.sketches = {}
+        self._matcher = None
+
+    def __getitem__(self, key):
+        if key not in self.sketches:
+            self.sketches[key] = HeavyHitters(**self.params)
+        return self.sketches[key]
+
+    @property
+    def institutions(self):
+        return sorted(set(i for i, _ in self.sketches))
+
+    @property
+    def nbytes(self):
+        """ int: memory held by the sketch tables """
+        return sum(h.sketch.table.nbytes for h in self.sketches.values())
+
+    def _entity_counts(self, texts):
+        if self._matcher is None:
+            import spacy
+            from src.features.entities import (
+                _financial_institution_aliases, _technology_aliases,
+                gazetteer_matcher_factory)
+            nlp = spacy.blank("en")
+            self._matcher = nlp, gazetteer_matcher_factory(nlp, {
+                "ORG": _financial_institution_aliases,
+                "TECH": _technology_aliases})
+        nlp, matcher = self._matcher
+        strings = nlp.vocab.strings
+        counts = collections.Counter()
+        for doc in nlp.pipe(texts):
+            counts.update(strings[m] for m, _, _ in matcher(doc))
+        return counts
+
+    def add_document(self, records):
+        """ Count the paragraph records of one file """
+        records = list(records)
+        institutions = split_institutions(records[0].get("institution")) or [
+            None]
+        tokens = collections.Counter()
+        ngrams = collections.Counter()
+        low, high = NGRAM_RANGE
+        for record in records:
+            words = tokenize(record.get("text", ""))
+            tokens.update(words)
+            for n in range(low, high + 1):
+                ngrams.update(" ".join(words[i:i + n])
+                              for i in range(len(words) - n + 1))
+        counts = {"token": tokens, "ngram": ngrams}
+        if self.entities:
+            counts["entity"] = self._entity_counts(
+                r.get("text", "") for r in records)
+        for institution in institutions:
+            for kind, counter in counts.items():
+                self[institution, kind].update(counter)
+
+    def update(self, records):
+        """ Count dataset `records`, grouped by filename """
+        n = 0
+        for _, group in itertools.groupby(
+                records, key=lambda r: r.get("filename")):
+            self.add_document(group)
+            n += 1
+        return n
+
+    def merge(self, other):
+        for key, hitters in other.sketches.items():
+            if key in self.sketches:
+                self.sketches[key].merge(hitters)
+            else:
+                self.sketches[key] = hitters
+        return self
+
+    def most_common(self, kind="ngram", institution=None, n=20):
+        """
+        Top `n` ``(item, estimate)`` of `kind`, for one institution or, if
+        `institution` is None, merged over all of them.
+        """
+        if institution is not None:
+            return self[institution, kind].most_common(n)
+        merged = HeavyHitters(**self.params)
+        for (_, k), hitters in self.sketches.items():
+            if k == kind:
+                merged.merge(hitters)
+        return merged.most_common(n)
+
+    def save(self, filename):
+        keys = sorted(self.sketches, key=lambda k: (str(k[0]), k[1]))
+        meta = {
+            "params": self.params,
+            "sketches": [{"institution": i, "kind": kind,
+                          "total": self.sketches[i, kind].total,
+                          "top": self.sketches[i, kind].most_common()}
+                         for i, kind in keys],
+        }
+        arrays = dict(("table_{}".format(n), self.sketches[key].sketch.table)
+                      for n, key in enumerate(keys))
+        np.savez_compressed(filename, meta=np.array(json.dumps(meta)),
+                            **arrays)
+
+    @classmethod
+    def load(cls, filename, entities=True):
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            stats = cls(entities=entities, **meta["params"])
+            params = meta["params"]
+            for n, entry in enumerate(meta["sketches"]):
+                sketch = CountMinSketch(
+                    params["width"], params["depth"], params["seed"],
+                    table=data["table_{}".format(n)], total=entry["total"])
+                hitters = HeavyHitters(params["k"], sketch=sketch)
+                for item, estimate in entry["top"]:
+                    hitters._offer(item, estimate)
+                stats.sketches[entry["institution"], entry["kind"]] = hitters
+        return stats
+
+
+def _count_shard(dataset_filename, shard, n_shards, options):
+    stats = TermStatistics(**options)
+    files = 0
+    for n, (_, group) in enumerate(itertools.groupby(
+            read_dataset(dataset_filename),
+            key=lambda r: r.get("filename"))):
+        if n % n_shards == shard:
+            stats.add_document(group)
+            files += 1
+    return stats, files
+
+
+def build_statistics(dataset_filename, workers=1, **options):
+    """
+    Count `dataset_filename` in `workers` processes, each taking every
+    `workers`-th document, and merge their sketches.
+    """
+    logger = logging.getLogger(__name__)
+    if workers <= 1:
+        stats, files = _count_shard(dataset_filename, 0, 1, options)
+        logger.info("counted %d documents", files)
+        return stats
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_count_shard, dataset_filename, shard,
+                                   workers, options)
+                   for shard in range(workers)]
+        stats = None
+        for future in futures:
+            shard_stats, files = future.result()
+            logger.info("merging shard of %d documents", files)
+            stats = shard_stats if stats is None else stats.merge(shard_stats)
+    return stats
+
+
+@click.group()
+def cli():
+    """ Heavy-hitter token, n-gram and entity sketches """
+
+
+@cli.command()
+@click.argument('dataset_filename', default='data/interim/blockchain_papers_dataset/dataset.json', type=click.Path(exists=True))
+@click.argument('sketch_filename', default='data/processed/term_sketches.npz', type=click.Path())
+@click.option('--k', default=1000, help='Heavy hitters kept per sketch.')
+@click.option('--width', default=2 ** 14,
+              help='Counters per row; overcount bound is e / width * total.')
+@click.option('--depth', default=4,
+              help='Rows; the bound fails with probability exp(-depth).')
+@click.option('--workers', default=1)
+@click.option('--merge', 'merge_filenames', multiple=True,
+              type=click.Path(exists=True),
+              help='Sketch file (same parameters) to merge into the result.')
+@click.option('--no-entities', is_flag=True,
+              help='Only tokens and n-grams; does not need spaCy.')
+def build(dataset_filename, sketch_filename, k, width, depth, workers,
+          merge_filenames, no_entities):
+    """ Sketch the dataset, optionally merging in earlier sketch files """
+    logger = logging.getLogger(__name__)
+    stats = build_statistics(
+        dataset_filename, workers, k=k, width=width, depth=depth,
+        entities=not no_entities)
+    for filename in merge_filenames:
+        stats.merge(TermStatistics.load(filename))
+    stats.save(sketch_filename)
+    logger.info("%d sketches, %.1f MiB of counters, epsilon %.2g, delta %.2g",
+                len(stats.sketches), stats.nbytes / 2 ** 20, math.e / width,
+                math.exp(-depth))
+
+
+@cli.command()
+@click.argument('sketch_filename', default='data/processed/term_sketches.npz', type=click.Path(exists=True))
+@click.option('--kind', default='ngram', type=click.Choice(KINDS))
+@click.option('--institution', default=None)
+@click.option('-n', default=20)
+def top(sketch_filename, kind, institution, n):
+    """ Print the heaviest items with their error bound """
+    stats = TermStatistics.load(sketch_filename, entities=False)
+    if institution is not None:
+        error = stats[institution, kind].error
+    else:
+        error = sum(h.error for (_, k), h in stats.sketches.items()
+                    if k == kind)
+    for item, estimate in stats.most_common(kind, institution, n):
+        click.echo("{:>10d}  {}".format(estimate, item))
+    click.echo("counts overestimate by at most {} (p >= {:.3f})".format(
+        error, 1 - math.exp(-stats.params["depth"])))
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline Stage Runner
+---------------------
+Declares the stages from docs.yml to features with their inputs, outputs
+and parameters, and runs only those whose inputs changed::
+
+    download:<pdf>  ->  extract:<pdf>  ->  dataset  ->  digests  ->  index,
+                                  catalog  ->           ->  corpus     graph,
+                                                                       cube
+
+Download and extraction are declared per docs.yml entry, so editing one
+entry only recomputes that document and what is built from the dataset.
+docs.yml metadata goes into the catalog (see :mod:`src.data.catalog`),
+which the dataset refers to by ``doc_id``.
+A stage is skipped when the sha256 of its parameters and of the content of
+its input files matches the previous successful run (recorded in
+``<data dir>/interim/.stage_cache.json``) and all its outputs exist.
+Independent stages run concurrently: CPU-bound ones (extraction) in worker
+processes, the others in threads.
+
+The index, graph and cube stages are incremental. The ``digests`` stage
+hashes every document's records (catalog metadata included) once per run
+into ``dataset.digests.json``; each incremental stage keeps the digests it
+last built from in a ``<output>.sources.json`` next to its output, and
+only recounts the documents whose digest changed and drops those that left
+the dataset.
+
+Usage::
+
+    python src/pipeline.py run                 # everything except corpus
+    python src/pipeline.py run dataset index   # and what they depend on
+    python src/pipeline.py run --refresh       # revalidate docs.yml sources
+    python src/pipeline.py status
+"""
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+CACHE_NAME = ".stage_cache.json"
+DEFAULT_TARGETS = ("dataset", "index", "graph", "cube")
+CERMINE_JAR = "cermine-impl-1.13-jar-with-dependencies.jar"
+
+
+class Stage(object):
+    """
+    A unit of work of the pipeline.
+
+    Args:
+        name (str): Unique name, e.g. ``"extract:d157.pdf"``.
+        func (callable): Called as ``func(*args)``; must be a module level
+            function if `process` is set.
+        inputs (List[str]): Files whose content the result depends on.
+        outputs (List[str]): Files the stage writes.
+        params (dict): Json-serializable parameters the result depends on.
+        after (List[str]): Names of the stages producing the inputs.
+        process (bool): Run in a worker process rather than a thread.
+        partial (bool): Still run when some upstream stages failed, with
+            whichever inputs exist.
+    """
+
+    def __init__(self, name, func, args=(), inputs=(), outputs=(),
+                 params=None, after=(), process=False, partial=False):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = [str(p) for p in inputs]
+        self.outputs = [str(p) for p in outputs]
+        self.params = params or {}
+        self.after = list(after)
+        self.process = process
+        self.partial = partial
+
+    def __repr__(self):
+        return "Stage({!r})".format(self.name)
+
+
+def cache_path(data_dir="data"):
+    """ Where the stage cache of the pipeline over `data_dir` is kept """
+    return Path(data_dir) / "interim" / CACHE_NAME
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageRunner(object):
+    """
+    Runs :class:`Stage` objects in dependency order, skipping up to date
+    ones.
+
+    Args:
+        stages (Iterable[Stage]): The pipeline.
+        cache_filename (str): Where stage keys and file digests are kept;
+            :func:`cache_path` of ``data`` by default.
+        workers (int): Size of each of the thread and process pools.
+        force (bool): Run every selected stage regardless of the cache.
+    """
+
+    def __init__(self, stages, cache_filename=None, workers=None,
+                 force=False):
+        self.stages = collections.OrderedDict((s.name, s) for s in stages)
+        self.cache_filename = Path(cache_filename or cache_path())
+        self.workers = workers or os.cpu_count() or 1
+        self.force = force
+        self.cache = {"stages": {}, "files": {}}
+        if self.cache_filename.is_file():
+            with open(self.cache_filename) as f:
+                self.cache = json.load(f)
+
+    def _save_cache(self):
+        self.cache_filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = str(self.cache_filename) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.cache_filename)
+
+    def digest(self, path):
+        """ Content sha256 of `path`, memoized on (size, mtime) """
+        # memoized by absolute path, so runs from another directory agree
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.cache["files"].get(path)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+        digest = file_digest(path)
+        self.cache["files"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def key(self, stage):
+        """ sha256 over the stage's parameters and input contents """
+        inputs = dict((os.path.abspath(p),
+                       self.digest(p) if os.path.isfile(p) else None)
+                      for p in stage.inputs)
+        payload = json.dumps({
+            "func": stage.func.__name__,
+            "args": [str(a) for a in stage.args],
+            "params": stage.params,
+            "inputs": inputs,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def up_to_date(self, stage, key=None):
+        """ Whether `stage` can be skipped; `key` if already computed """
+        if self.force:
+            return False
+        if not all(os.path.exists(p) for p in stage.outputs):
+            return False
+        return self.cache["stages"].get(stage.name) == (
+            key or self.key(stage))
+
+    def selection(self, targets=None):
+        """ Names of `targets` (prefixes allowed) and their upstream """
+        if not targets:
+            names = list(self.stages)
+        else:
+            names = [n for n in self.stages for t in targets
+                     if n == t or n.startswith(t + ":")]
+            unknown = [t for t in targets if not any(
+                n == t or n.startswith(t + ":") for n in self.stages)]
+            if unknown:
+                raise ValueError("unknown stages: {}".format(unknown))
+        selected = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name].after)
+        return [n for n in self.stages if n in selected]
+
+    def run(self, targets=None):
+        """
+        Run the selected stages.
+
+        Returns:
+            Dict[str, str]: stage name -> ``"ran"``, ``"cached"``,
+            ``"failed"`` or ``"blocked"`` (an upstream stage failed).
+        """
+        logger = logging.getLogger(__name__)
+        pending = self.selection(targets)
+        status = collections.OrderedDict()
+        # name -> key of the inputs a running stage started from; stored
+        # on success, so inputs changing meanwhile make it stale
+        running = {}
+        keys = {}
+        threads = concurrent.futures.ThreadPoolExecutor(self.workers)
+        processes = concurrent.futures.ProcessPoolExecutor(self.workers)
+        try:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    upstream = [status.get(a) for a in stage.after
+                                if a in self.stages]
+                    failed = [s for s in upstream
+                              if s in ("failed", "blocked")]
+                    if failed and not stage.partial:
+                        status[name] = "blocked"
+                        pending.remove(name)
+                    elif all(s is not None for s in upstream):
+                        pending.remove(name)
+                        keys[name] = self.key(stage)
+                        if self.up_to_date(stage, keys[name]):
+                            status[name] = "cached"
+                            logger.info("%-45s up to date", name)
+                            continue
+                        logger.info("%-45s running", name)
+                        pool = processes if stage.process else threads
+                        running[pool.submit(stage.func, *stage.args)] = name
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error("%-45s failed: %s", name, e)
+                        status[name] = "failed"
+                        self.cache["stages"].pop(name, None)
+                    else:
+                        status[name] = "ran"
+                        self.cache["stages"][name] = keys[name]
+                    self._save_cache()
+        finally:
+            threads.shutdown()
+            processes.shutdown()
+        return status
+
+    def status(self, targets=None):
+        """ Dict[str, bool]: whether each selected stage is up to date """
+        return collections.OrderedDict(
+            (name, self.up_to_date(self.stages[name]))
+            for name in self.selection(targets))
+
+
+def download_document(url, output):
+    """ Fetch `url` into the PDF store and link it as `output`; only a
+        changed document replaces `output` """
+    from src.data.pdf_store import PDFStore
+    store = PDFStore(os.path.dirname(output))
+    return store.fetch(url, os.path.basename(output)).status
+
+
+def extract_document(pdf, output, backend="pdfminer", cermine_jar=None):
+    """ Extract and normalize the paragraphs of one PDF into json lines """
+    from src.data.normalize import Normalizer
+    from src.data.pdf_store import PDFStore
+    PDFStore(os.path.dirname(pdf)).check(pdf)
+    if backend == "pdfminer":
+        from src.data.extract_pdf import extract_info
+        records = extract_info(pdf, max_workers=0)
+    elif backend == "cermine":
+        records = cermine_records(pdf, cermine_jar or CERMINE_JAR)
+    else:
+        raise ValueError("unknown extraction backend: {}".format(backend))
+    tmp = output + ".tmp"
+    with open(tmp, "w") as f:
+        for record in Normalizer().records(records):
+            f.write(json.dumps(record))
+            f.write("\n")
+    os.replace(tmp, output)
+
+
+def cermine_records(pdf, jar=CERMINE_JAR):
+    """ Run CERMINE over a single PDF and yield its paragraph records """
+    from src.data.make_dataset import extract_info
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(pdf, workdir)
+        subprocess.check_call([
+            "java", "-cp", jar, "pl.edu.icm.cermine.ContentExtractor",
+            "-path", workdir, "-outputs", "jats"])
+        name = os.path.splitext(os.path.basename(pdf))[0]
+        for record in extract_info(os.path.join(workdir, name + ".cermxml")):
+            yield record
+    finally:
+        shutil.rmtree(workdir)
+
+
+def build_catalog(docs_filename, catalog_filename):
+    """ Compile docs.yml into the metadata catalog if it changed """
+    from src.data.catalog import Catalog
+    Catalog.compile(docs_filename, catalog_filename)
+
+
+def build_dataset(record_files, filenames, dataset_filename,
+                  catalog_filename):
+    """ Concatenate per-document records, tagged with their doc_id """
+    from src.data.catalog import Catalog
+    from src.data.make_dataset import write_to_dataset
+    logger = logging.getLogger(__name__)
+    os.makedirs(os.path.dirname(dataset_filename), exist_ok=True)
+    catalog = Catalog(catalog_filename)
+    tmp = dataset_filename + ".tmp"
+    sink = write_to_dataset(tmp)
+    sink.__next__()
+    for record_file, filename in zip(record_files, filenames):
+        if not os.path.isfile(record_file):
+            logger.warning("no records for %s, left out", filename)
+            continue
+        doc_id = catalog.doc_id(filename)
+        with open(record_file) as f:
+            for line in f:
+                paragraph = json.loads(line)
+                paragraph["doc_id"] = doc_id
+                sink.send(paragraph)
+    sink.close()
+    os.replace(tmp, dataset_filename)
+
+
+def document_digests(dataset_filename):
+    """ filename -> sha256 of its records, catalog metadata joined in """
+    from src.data.records import read_dataset
+    digests = collections.defaultdict(hashlib.sha256)
+    for record in read_dataset(dataset_filename):
+        digests[record.get("filename")].update(json.dumps(
+            record, sort_keys=True, default=str).encode("utf-8"))
+    return dict((f, d.hexdigest()) for f, d in digests.items())
+
+
+def digests_path(dataset_filename):
+    """ Where the ``digests`` stage writes the document digests """
+    return os.path.splitext(str(dataset_filename))[0] + ".digests.json"
+
+
+def build_digests(dataset_filename, digests_filename):
+    """ Hash the records of every document, once for all stages """
+    digests = document_digests(dataset_filename)
+    tmp = digests_filename + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(digests, f, sort_keys=True)
+    os.replace(tmp, digests_filename)
+
+
+def load_digests(digests_filename):
+    with open(digests_filename) as f:
+        return json.load(f)
+
+
+def sources_path(output):
+    """ Where an incremental stage records the documents it has seen """
+    return os.path.splitext(str(output))[0] + ".sources.json"
+
+
+def load_sources(output):
+    path = sources_path(output)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_sources(output, state):
+    path = sources_path(output)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def changed_documents(digests, previous):
+    """
+    Filenames whose digest differs from the `previous` run (or which are
+    new), and those no longer in the dataset.
+    """
+    changed = sorted(f for f, d in digests.items() if previous.get(f) != d)
+    removed = sorted(set(previous) - set(digests))
+    return changed, removed
+
+
+def build_index(dataset_filename, digests_filename, index_path):
+    """ Re-index the documents that changed since the last run """
+    from src.features.search_index import SearchIndex
+    logger = logging.getLogger(__name__)
+    digests = load_digests(digests_filename)
+    changed, removed = changed_documents(
+        digests, load_sources(index_path).get("sources", {}))
+    logger.info("index: %d changed, %d removed documents", len(changed),
+                len(removed))
+    with SearchIndex(index_path) as index:
+        if removed:
+            index.delete_filenames(removed)
+        index.update(dataset_filename, refresh=changed)
+    save_sources(index_path, {"sources": digests})
+
+
+def build_graph(dataset_filename, digests_filename, graph_filename):
+    """ Recount the co-occurrences of the documents that changed """
+    from src.features.cooccurrence import CooccurrenceGraph
+    from src.data.records import read_dataset
+    logger = logging.getLogger(__name__)
+    digests = load_digests(digests_filename)
+    changed, removed = changed_documents(
+        digests, load_sources(graph_filename).get("sources", {}))
+    logger.info("graph: %d changed, %d removed documents", len(changed),
+                len(removed))
+    graph = CooccurrenceGraph.load(graph_filename)
+    for filename in removed:
+        graph.remove_document(filename)
+    graph.update(read_dataset(dataset_filename), refresh=changed)
+    graph.save(graph_filename)
+    save_sources(graph_filename, {"sources": digests})
+
+
+def build_cube(dataset_filename, digests_filename, cube_filename):
+    """ Recount the mentions of the documents that changed """
+    from src.features.cube import build_cube as _build_cube
+    from src.data.records import read_dataset
+    logger = logging.getLogger(__name__)
+    digests = load_digests(digests_filename)
+    state = load_sources(cube_filename)
+    changed, removed = changed_documents(digests, state.get("sources", {}))
+    logger.info("cube: %d changed, %d removed documents", len(changed),
+                len(removed))
+    # per-document counts of the previous run
+    documents = state.get("documents", {})
+    _build_cube(read_dataset(dataset_filename), documents=documents,
+                refresh=changed).save(cube_filename)
+    save_sources(cube_filename, {"sources": digests, "documents": documents})
+
+
+def build_corpus(dataset_filename, corpus_filename, lang, drop_junk=False,
+                 chunk=False):
+    from src.data.blockchain_dataset import BlockchainPapersDataset
+    from src.data.chunking import Chunker
+    from src.data.make_corpus import create_corpus, prepare_lang
+    from src.data.quality import QualityFilter
+    # the catalog stage already compiled docs.yml
+    dataset = BlockchainPapersDataset(
+        data_dir=os.path.dirname(dataset_filename), docs_filename=None)
+    prefilter = QualityFilter(drop=drop_junk)
+    chunker = Chunker(labeler=prefilter.label) if chunk else None
+    create_corpus(lang=prepare_lang(lang), dataset=dataset, chunker=chunker,
+                  prefilter=prefilter).save(corpus_filename)
+    prefilter.log_report()
+
+
+def default_stages(docs_filename="docs.yml", data_dir="data",
+                   backend="pdfminer", lang="en_core_web_lg", drop_junk=False,
+                   chunk=False):
+    """ The download -> extract -> dataset -> corpus / features pipeline """
+    from src.data.catalog import catalog_path, load_entries
+    data_dir = Path(data_dir)
+    external = data_dir / "external"
+    records_dir = data_dir / "interim" / "records"
+    processed = data_dir / "processed"
+    for path in (external, records_dir, processed):
+        path.mkdir(parents=True, exist_ok=True)
+    dataset = str(data_dir / "interim" / "blockchain_papers_dataset"
+                  / "dataset.json")
+
+    stages = []
+    entries = list(load_entries(docs_filename).values())
+    record_files = []
+    for entry in entries:
+        filename = entry["filename"]
+        pdf = str(external / filename)
+        records = str(records_dir / (os.path.splitext(filename)[0]
+                                     + ".jsonl"))
+        record_files.append(records)
+        stages.append(Stage(
+            "download:" + filename, download_document,
+            args=(entry["url"], pdf), outputs=[pdf],
+            params={"url": entry["url"]}))
+        stages.append(Stage(
+            "extract:" + filename, extract_document,
+            args=(pdf, records, backend), inputs=[pdf], outputs=[records],
+            params={"backend": backend}, after=["download:" + filename],
+            process=True))
+    catalog = catalog_path(dataset)
+    stages.append(Stage(
+        "catalog", build_catalog, args=(docs_filename, catalog),
+        inputs=[docs_filename], outputs=[catalog]))
+    # doc_ids are stable, so metadata edits need no new dataset, only the
+    # stages below that read the catalog
+    filenames = [e["filename"] for e in entries]
+    stages.append(Stage(
+        "dataset", build_dataset,
+        args=(record_files, filenames, dataset, catalog),
+        inputs=record_files, outputs=[dataset],
+        params={"filenames": filenames},
+        after=["catalog"] + ["extract:" + f for f in filenames],
+        partial=True))
+    digests = digests_path(dataset)
+    stages.append(Stage(
+        "digests", build_digests, args=(dataset, digests),
+        inputs=[dataset, catalog], outputs=[digests], after=["dataset"]))
+    for name, func, output in (
+            ("index", build_index, processed / "search_index"),
+            ("graph", build_graph, processed / "cooccurrence.json"),
+            ("cube", build_cube, processed / "term_cube.npz")):
+        stages.append(Stage(name, func, args=(dataset, digests, str(output)),
+                            inputs=[dataset, digests], outputs=[output],
+                            after=["digests"]))
+    corpus = str(processed / "corpus.acy")
+    stages.append(Stage(
+        "corpus", build_corpus,
+        args=(dataset, corpus, lang, drop_junk, chunk),
+        inputs=[dataset, catalog], outputs=[corpus],
+        params={"lang": lang, "drop_junk": drop_junk, "chunk": chunk},
+        after=["dataset"], process=True))
+    return stages
+
+
+@click.group()
+@click.option('--docs', 'docs_filename', default='docs.yml', type=click.Path(exists=True))
+@click.option('--data-dir', default='data', type=click.Path())
+@click.option('--backend', default='pdfminer',
+              type=click.Choice(['pdfminer', 'cermine']),
+              help='PDF extraction backend.')
+@click.option('--lang', default='en_core_web_lg',
+              help='spaCy pipeline for the corpus stage.')
+@click.option('--drop-junk', is_flag=True,
+              help='Leave paragraphs the quality prefilter rejects out of '
+                   'the corpus.')
+@click.option('--chunk', is_flag=True,
+              help='Split long paragraphs and merge short fragments before '
+                   'the corpus stage.')
+@click.pass_context
+def cli(ctx, docs_filename, data_dir, backend, lang, drop_junk, chunk):
+    """ Run the data pipeline, skipping stages whose inputs are unchanged """
+    ctx.obj = {"stages": default_stages(docs_filename, data_dir, backend,
+                                        lang, drop_junk, chunk),
+               "cache_filename": cache_path(data_dir)}
+
+
+@cli.command()
+@click.argument('targets', nargs=-1)
+@click.option('--workers', default=None, type=int)
+@click.option('--force', is_flag=True, help='Ignore the cache.')
+@click.option('--refresh', is_flag=True,
+              help='Revalidate all downloads with conditional requests first.')
+@click.pass_obj
+def run(obj, targets, workers, force, refresh):
+    """ Run TARGETS (default: all but corpus) and their upstream stages """
+    logger = logging.getLogger(__name__)
+    if refresh:
+        # unchanged documents answer 304 and keep their extraction cached
+        StageRunner(obj["stages"], obj["cache_filename"], workers=workers,
+                    force=True).run(["download"])
+    runner = StageRunner(obj["stages"], obj["cache_filename"],
+                         workers=workers, force=force)
+    status = runner.run(targets or DEFAULT_TARGETS)
+    counts = collections.Counter(status.values())
+    logger.info(", ".join("{} {}".format(n, s) for s, n in counts.items()))
+    if counts["failed"] or counts["blocked"]:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument('targets', nargs=-1)
+@click.pass_obj
+def status(obj, targets):
+    """ Show which stages would run """
+    runner = StageRunner(obj["stages"], obj["cache_filename"])
+    for name, fresh in runner.status(targets or DEFAULT_TARGETS).items():
+        click.echo("{:<10} {}".format("ok" if fresh else "stale", name))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    cli()
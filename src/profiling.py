@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline Profiling
+------------------
+Lightweight per-stage instrumentation for ``make_dataset``, ``make_corpus``
+and ``build_features``: wall time, CPU time, resident memory and item counts
+per stage and per spaCy pipeline component.
+
+Memory is reported two ways: the change in current RSS over each execution
+of a stage, summed (``rss_delta_kb``, what the stage itself allocated and
+kept), and the process-wide peak RSS reached by the time the stage last ran
+(``lifetime_peak_rss_kb``; ``ru_maxrss`` never decreases, so this is not the
+stage's own peak). Current RSS comes from :mod:`psutil` when it is
+installed, else from ``/proc/self/statm``. Memory is only sampled at stage
+boundaries: when a timeline span starts and ends, and when an iteration
+timed by :meth:`Tracer.iterate` starts and finishes. Per-item timings (per
+paragraph spans, items of an iteration, spaCy components) only read the
+clocks; components therefore report no memory of their own.
+
+Stages report to the process-wide tracer returned by :func:`get_tracer`,
+which is disabled (and costs one attribute lookup) until :func:`enable` is
+called, e.g. by the ``--trace`` option of the scripts::
+
+    python src/data/make_dataset.py ... --trace reports/make_dataset.trace.json
+
+The trace file is a Chrome trace (open it in ``chrome://tracing`` or
+Perfetto) whose ``stages`` key holds the aggregated totals; the same totals
+are logged as a table when the run ends.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MAX_EVENTS = 100000
+_PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024 if hasattr(os, "sysconf") else 4
+
+
+def lifetime_peak_rss_kb():
+    """ Peak resident set size of this process since it started, in KiB """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss_kb():
+    """ Resident set size of this process right now, in KiB (0 if unknown) """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss // 1024
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class StageStats(object):
+    __slots__ = ("calls", "wall", "cpu", "items", "rss_delta_kb",
+                 "lifetime_peak_rss_kb")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.items = 0
+        self.rss_delta_kb = 0
+        self.lifetime_peak_rss_kb = 0
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class _Span(object):
+    """ Context manager timing one execution of a stage """
+
+    __slots__ = ("tracer", "name", "event", "items", "_wall", "_cpu", "_rss")
+
+    def __init__(self, tracer, name, event=True):
+        self.tracer = tracer
+        self.name = name
+        self.event = event
+        self.items = 0
+
+    def count(self, n=1):
+        self.items += n
+
+    def __enter__(self):
+        self._rss = current_rss_kb() if self.event else None
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss_delta = (current_rss_kb() - self._rss
+                     if self._rss is not None else None)
+        self.tracer.record(self.name, self._wall, wall, cpu, self.items,
+                           self.event, rss_delta)
+        return False
+
+
+class _NullSpan(object):
+    """ Stand-in used while tracing is disabled """
+
+    def count(self, n=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """
+    Collects stage timings; thread-safe.
+
+    Args:
+        enabled (bool): When False every method is a cheap no-op.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = collections.OrderedDict()
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name, event=True):
+        """
+        ``with tracer.stage("xml_parse") as span: ...; span.count()``
+
+        Args:
+            event (bool): Also keep the span in the trace timeline and
+                sample memory around it; turn off for stages entered once
+                per paragraph or batch.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, event)
+
+    def _stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = StageStats()
+        return stats
+
+    def record(self, name, start, wall, cpu, items=0, event=True,
+               rss_delta=None):
+        """
+        Add one execution of `name`. `rss_delta` is ``None`` when memory
+        was not sampled around it.
+        """
+        with self._lock:
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.items += items
+            if event and len(self.events) < MAX_EVENTS:
+                self.events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(),
+                    "tid": threading.get_ident() % 2 ** 31,
+                    "ts": (start - self._origin) * 1e6, "dur": wall * 1e6,
+                    "args": {"items": items, "cpu_s": cpu,
+                             "rss_delta_kb": rss_delta},
+                })
+        if rss_delta is not None:
+            self.record_memory(name, rss_delta)
+
+    def record_memory(self, name, rss_delta):
+        """ Add an RSS change sampled at a boundary of `name` """
+        peak = lifetime_peak_rss_kb()
+        with self._lock:
+            stats = self._stats(name)
+            stats.rss_delta_kb += rss_delta
+            stats.lifetime_peak_rss_kb = max(stats.lifetime_peak_rss_kb,
+                                             peak)
+
+    def iterate(self, name, iterable):
+        """
+        Yield from `iterable`, timing each step as one item of `name`;
+        memory is sampled when the iteration starts and ends
+        """
+        if not self.enabled:
+            for item in iterable:
+                yield item
+            return
+        iterator = iter(iterable)
+        rss = current_rss_kb()
+        try:
+            while True:
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.record(name, wall, time.perf_counter() - wall,
+                            time.process_time() - cpu, 1, event=False)
+                yield item
+        finally:
+            self.record_memory(name, current_rss_kb() - rss)
+
+    def instrument(self, nlp, prefix="spacy/"):
+        """
+        Time every component of a spaCy pipeline, in place. A no-op if
+        tracing is disabled.
+        """
+        if not self.enabled:
+            return nlp
+        for name in list(nlp.pipe_names):
+            component = nlp.get_pipe(name)
+            if not isinstance(component, _TimedComponent):
+                _replace_pipe(nlp, name, _TimedComponent(
+                    self, prefix + name, component))
+        return nlp
+
+    def summary(self):
+        """ Plain text table of the aggregated stage statistics """
+        header = "{:<40} {:>7} {:>10} {:>10} {:>9} {:>10} {:>12} {:>17}"
+        lines = [header.format("stage", "calls", "wall s", "cpu s", "items",
+                               "items/s", "RSS delta MB", "lifetime peak MB")]
+        for name, s in self.stats.items():
+            rate = s.items / s.wall if s.wall and s.items else 0
+            lines.append(
+                "{:<40} {:>7d} {:>10.3f} {:>10.3f} {:>9d} {:>10.1f} "
+                "{:>12.1f} {:>17.1f}".format(
+                    name[:40], s.calls, s.wall, s.cpu, s.items, rate,
+                    s.rss_delta_kb / 1024.0,
+                    s.lifetime_peak_rss_kb / 1024.0))
+        return "\n".join(lines)
+
+    def write(self, filename):
+        """ Dump a Chrome trace with the aggregated ``stages`` alongside """
+        with self._lock:
+            data = {
+                "traceEvents": list(self.events),
+                "displayTimeUnit": "ms",
+                "stages": dict((name, stats.to_dict())
+                               for name, stats in self.stats.items()),
+            }
+        with open(filename, "w") as f:
+            json.dump(data, f)
+
+
+class _TimedComponent(object):
+    """ Wraps a spaCy pipeline component, attributing time to it alone """
+
+    def __init__(self, tracer, name, component):
+        self.tracer = tracer
+        self.trace_name = name
+        self.component = component
+
+    def __getattr__(self, attr):
+        if attr == "component":
+            raise AttributeError(attr)
+        return getattr(self.component, attr)
+
+    def __call__(self, doc):
+        with self.tracer.stage(self.trace_name, event=False) as span:
+            doc = self.component(doc)
+            span.count()
+        return doc
+
+    def pipe(self, docs, **kwargs):
+        # Components pull docs lazily from the previous component; time
+        # spent upstream is measured and subtracted so it isn't counted
+        # twice.
+        upstream = [0.0, 0.0]
+
+        def pull():
+            iterator = iter(docs)
+            while True:
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    doc = next(iterator)
+                except StopIteration:
+                    return
+                upstream[0] += time.perf_counter() - wall
+                upstream[1] += time.process_time() - cpu
+                yield doc
+
+        if hasattr(self.component, "pipe"):
+            results = iter(self.component.pipe(pull(), **kwargs))
+        else:
+            results = (self.component(doc) for doc in pull())
+        while True:
+            upstream[0] = upstream[1] = 0
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                doc = next(results)
+            except StopIteration:
+                return
+            self.tracer.record(
+                self.trace_name, wall,
+                time.perf_counter() - wall - upstream[0],
+                time.process_time() - cpu - upstream[1], 1, event=False)
+            yield doc
+
+
+# timed components waiting to be picked up by the spaCy 3 factory
+_PENDING_COMPONENTS = {}
+_TIMED_FACTORY = "profiling_timed_component"
+
+
+def _timed_component_factory(nlp, name, key):
+    return _PENDING_COMPONENTS.pop(key)
+
+
+def _replace_pipe(nlp, name, component):
+    """
+    Put `component` in the place of pipe `name`. spaCy 3 only replaces
+    pipes with registered factories, so there the wrapper is handed over
+    through one.
+    """
+    import spacy
+    if spacy.__version__.split(".")[0] == "2":
+        nlp.replace_pipe(name, component)
+        return
+    from spacy.language import Language
+    if not Language.has_factory(_TIMED_FACTORY):
+        Language.factory(_TIMED_FACTORY, func=_timed_component_factory)
+    key = str(id(component))
+    _PENDING_COMPONENTS[key] = component
+    try:
+        nlp.replace_pipe(name, _TIMED_FACTORY, config={"key": key})
+    finally:
+        _PENDING_COMPONENTS.pop(key, None)
+
+
+_tracer = Tracer(enabled=False)
+
+
+def get_tracer():
+    """ The process-wide :class:`Tracer` """
+    return _tracer
+
+
+_trace_filename = None
+
+
+def enable(trace_filename=None):
+    """
+    Turn tracing on. If `trace_filename` is given, the trace is written and
+    the summary logged when the process exits; the exit hook is registered
+    once, and a later `trace_filename` replaces the earlier one.
+    """
+    global _trace_filename
+    _tracer.enabled = True
+    if trace_filename:
+        if _trace_filename is None:
+            atexit.register(_finish)
+        _trace_filename = trace_filename
+    return _tracer
+
+
+def _finish():
+    logger = logging.getLogger(__name__)
+    _tracer.write(_trace_filename)
+    logger.info("stage profile (trace in %s):\n%s", _trace_filename,
+                _tracer.summary())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+import networkx as nx
+
+
+def cooccurrence_to_networkx(slice_, level="paragraph", min_weight=1,
+                             publishers=True):
+    """
+    Build a weighted :class:`networkx.Graph` from an aggregated co-occurrence
+    :class:`Slice`.
+
+    Args:
+        level (str): ``"paragraph"`` weighs edges by the number of paragraphs
+            mentioning both nodes, ``"document"`` by the number of documents.
+        min_weight (int): Drop lighter edges.
+        publishers (bool): Add ``PUB:`` nodes linked to what they mention.
+    """
+    edges = (slice_.paragraph_edges if level == "paragraph"
+             else slice_.document_edges)
+    graph = nx.Graph()
+    for node, count in slice_.nodes.items():
+        label, name = node.split(":", 1)
+        graph.add_node(node, label=label, name=name, mentions=count)
+    weighted = list(edges.items())
+    if publishers:
+        weighted.extend(slice_.publisher_edges.items())
+    for (a, b), weight in weighted:
+        if weight < min_weight:
+            continue
+        for node in (a, b):
+            if node not in graph:
+                label, name = node.split(":", 1)
+                graph.add_node(node, label=label, name=name, mentions=0)
+        graph.add_edge(a, b, weight=weight)
+    return graph
+
+
+def write_cooccurrence_graph(slice_, filename, **kwargs):
+    """ Export for Gephi / d3, format chosen by extension of `filename` """
+    logger = logging.getLogger(__name__)
+    graph = cooccurrence_to_networkx(slice_, **kwargs)
+    extension = os.path.splitext(filename)[1]
+    if extension == ".graphml":
+        nx.write_graphml(graph, filename)
+    elif extension == ".gexf":
+        nx.write_gexf(graph, filename)
+    elif extension == ".json":
+        with open(filename, "w") as f:
+            json.dump(nx.node_link_data(graph), f)
+    else:
+        raise ValueError("unsupported graph format: {}".format(extension))
+    logger.info("wrote %d nodes, %d edges to %s",
+                graph.number_of_nodes(), graph.number_of_edges(), filename)
+    return graph
+
+
+def plot_term_trends(cube, term, institutions=None, granularity="year",
+                     ax=None):
+    """
+    Line plot of `term` mentions per institution over time, read from a
+    :class:`TermCube` rather than the corpus.
+    """
+    import matplotlib.pyplot as plt
+    if ax is None:
+        _, ax = plt.subplots()
+    series = cube.by_institution(term, granularity=granularity)
+    for institution, points in sorted(series.items()):
+        if institutions is not None and institution not in institutions:
+            continue
+        if not any(value for _, value in points):
+            continue
+        periods, values = zip(*points)
+        ax.plot(periods, values, marker="o", label=institution)
+    ax.set_title(term)
+    ax.set_xlabel(granularity)
+    ax.set_ylabel("mentions")
+    ax.legend()
+    return ax
@@ -0,0 +1,20 @@
+from benchmarks import run_benchmarks as rb
+
+
+def test_a_failing_benchmark_does_not_stop_the_suite(monkeypatch):
+    def broken(workdir, size):
+        raise RuntimeError("boom")
+
+    def counting(workdir, size):
+        return lambda: 3
+
+    monkeypatch.setattr(rb, "BENCHMARKS", rb.collections.OrderedDict([
+        ("broken", (broken, ())), ("counting", (counting, ())),
+        ("missing", (counting, ("no_such_module",)))]))
+    results = rb.run_benchmarks("small", repeat=2)
+    assert results["broken"] == {"failed": "RuntimeError: boom"}
+    assert results["counting"]["items"] == 3
+    assert results["missing"] == {"skipped": "missing no_such_module"}
+    assert rb.compare(results, {"broken": {"min": 1.0},
+                                "counting": {"min": 1e-9}}, 0.1) == [
+        ("counting", 1e-9, results["counting"]["min"])]
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+import yaml
+
+from src.data.catalog import (
+    Catalog, MissingCatalogError, catalog_path, load_entries, require_catalog)
+from src.data.distributed_corpus import WorkQueue
+from src.data.records import read_dataset
+
+
+def _write_docs(path, entries):
+    with open(path, "w") as f:
+        yaml.safe_dump({"pdfs": entries}, f)
+
+
+ECB = {"filename": "ecb.pdf", "institution": "European Central Bank",
+       "date": "2017/9/1", "url": "http://example.org/ecb.pdf"}
+JOINT = {"filename": "joint.pdf", "institution": "Bundesbank, Deutsche Börse",
+         "date": "2018/3/1", "url": "http://example.org/joint.pdf"}
+BIS = {"filename": "bis.pdf", "institution": "BIS", "date": "2019/1/1",
+       "url": "http://example.org/bis.pdf"}
+
+
+@pytest.fixture
+def docs(tmp_path):
+    path = str(tmp_path / "docs.yml")
+    _write_docs(path, [ECB, JOINT])
+    return path
+
+
+def test_doc_ids_survive_docs_yml_edits(tmp_path, docs):
+    path = str(tmp_path / "catalog.sqlite")
+    catalog = Catalog.compile(docs, path)
+    ids = dict((f, catalog.doc_id(f)) for f in ("ecb.pdf", "joint.pdf"))
+    # a file the dataset holds but docs.yml does not list
+    extra = catalog.doc_id("unlisted.pdf")
+    assert not Catalog(path).update(docs)  # unchanged
+
+    # reorder, edit, add and remove entries
+    _write_docs(docs, [BIS, dict(JOINT, date="2018/4/1")])
+    assert Catalog(path).update(docs)
+    catalog = Catalog(path)
+    assert catalog.doc_id("joint.pdf") == ids["joint.pdf"]
+    assert catalog.doc_id("ecb.pdf") == ids["ecb.pdf"]
+    assert catalog.doc_id("unlisted.pdf") == extra
+    assert catalog.doc_id("bis.pdf") not in set(ids.values()) | {extra}
+    assert catalog.get(ids["joint.pdf"])["date"] == "2018/4/1"
+    # dropped from docs.yml: only the filename is left
+    assert catalog.get(ids["ecb.pdf"]) == {"filename": "ecb.pdf"}
+
+
+def test_select_and_join(tmp_path, docs):
+    catalog = Catalog.compile(docs, str(tmp_path / "catalog.sqlite"))
+    ecb, joint = catalog.doc_id("ecb.pdf"), catalog.doc_id("joint.pdf")
+    assert catalog.institutions == [
+        "Bundesbank", "Deutsche Börse", "European Central Bank"]
+    assert catalog.select(institution={"Deutsche Börse"}) == {joint}
+    assert catalog.select(date_range=("2017-01-01", "2018-01-01")) == {ecb}
+    assert catalog.date_range == ("2017-09-01", "2018-03-02")
+    record = catalog.join({"doc_id": joint, "text": "t"})
+    assert record["institution"] == JOINT["institution"]
+    assert record["text"] == "t"
+
+
+def test_records_with_doc_id_need_the_catalog(tmp_path, docs):
+    dataset = str(tmp_path / "dataset.json")
+    with open(dataset, "w") as f:
+        f.write(json.dumps({"doc_id": 1, "text": "t"}) + "\n")
+    with pytest.raises(MissingCatalogError):
+        list(read_dataset(dataset))
+    queue = WorkQueue(str(tmp_path / "run"))
+    try:
+        queue.create(dataset)
+        with pytest.raises(MissingCatalogError):
+            queue.read_unit([[0, 100]])
+    finally:
+        queue.close()
+
+    Catalog.compile(docs, catalog_path(dataset)).doc_id("ecb.pdf")
+    assert next(read_dataset(dataset))["filename"] == "ecb.pdf"
+
+
+def test_records_without_doc_id_are_read_as_they_are(tmp_path):
+    dataset = str(tmp_path / "dataset.json")
+    with open(dataset, "w") as f:
+        f.write(json.dumps({"filename": "old.pdf", "text": "t"}) + "\n")
+    assert list(read_dataset(dataset)) == [{"filename": "old.pdf",
+                                            "text": "t"}]
+
+
+def test_lookups_do_not_create_the_catalog(tmp_path):
+    path = str(tmp_path / "catalog.sqlite")
+    catalog = Catalog(path)
+    with pytest.raises(MissingCatalogError):
+        catalog.get(1)
+    with pytest.raises(MissingCatalogError):
+        catalog.select(institution={"BIS"})
+    with pytest.raises(MissingCatalogError):
+        catalog.filenames
+    dataset = str(tmp_path / "dataset.json")
+    with pytest.raises(MissingCatalogError):
+        require_catalog(dataset)
+    assert not (tmp_path / "catalog.sqlite").exists()
+    # still missing on the next read rather than an empty catalog
+    with pytest.raises(MissingCatalogError):
+        require_catalog(dataset)
+
+
+def test_dataset_without_docs_yml_needs_the_catalog(tmp_path):
+    pytest.importorskip("textacy")
+    from src.data.blockchain_dataset import BlockchainPapersDataset
+    dataset = BlockchainPapersDataset(data_dir=str(tmp_path),
+                                      docs_filename=None)
+    with pytest.raises(MissingCatalogError):
+        dataset.catalog
+    assert not (tmp_path / "catalog.sqlite").exists()
+
+
+def test_load_entries_last_one_wins(tmp_path):
+    path = str(tmp_path / "docs.yml")
+    _write_docs(path, [ECB, JOINT, dict(ECB, date="2017/10/1")])
+    entries = load_entries(path)
+    assert list(entries) == ["ecb.pdf", "joint.pdf"]
+    assert entries["ecb.pdf"]["date"] == "2017/10/1"
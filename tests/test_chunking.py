@@ -0,0 +1,76 @@
+import pytest
+
+from src.data.chunking import SEPARATOR, Chunker, locate, split_text
+
+
+def _record(paragraph_id, text, section_id="sec-0", **fields):
+    return dict({"filename": "a.pdf", "section_id": section_id,
+                 "paragraph_id": paragraph_id, "text": text}, **fields)
+
+
+def test_split_text_cuts_at_sentence_ends_then_whitespace():
+    text = "First sentence here. Second one (quoted.) Third sentence."
+    pieces = split_text(text, max_chars=30)
+    assert [text[s:e] for s, e in pieces] == [
+        "First sentence here.", "Second one (quoted.)", "Third sentence."]
+    words = "aaaa bbbb cccc"
+    assert [words[s:e] for s, e in split_text(words, 9)] == [
+        "aaaa bbbb", "cccc"]
+    # no whitespace at all: a hard cut
+    assert split_text("x" * 25, 10) == [(0, 10), (10, 20), (20, 25)]
+    assert split_text("short", 10) == [(0, 5)]
+    assert split_text("", 10) == []
+
+
+def test_chunks_merge_fragments_of_a_section_only():
+    records = [
+        _record(0, "A table cell"),
+        _record(1, "Some prose that is long enough to stand on its own."),
+        _record(2, "Another cell", section_id="sec-1"),
+    ]
+    chunks = list(Chunker(max_chars=200, min_chars=20).chunks(records))
+    assert [c["text"] for c in chunks] == [
+        "A table cell" + SEPARATOR + records[1]["text"], "Another cell"]
+    assert [c["chunk_id"] for c in chunks] == ["a.pdf#0", "a.pdf#1"]
+    assert "paragraph_id" not in chunks[0]
+    assert chunks[1]["section_id"] == "sec-1"
+
+
+def test_long_paragraphs_are_split():
+    text = "One sentence. " * 20
+    chunks = list(Chunker(max_chars=50, min_chars=5).chunks(
+        [_record(0, text.strip())]))
+    assert all(len(c["text"]) <= 50 for c in chunks)
+    assert " ".join(c["text"] for c in chunks) == text.strip()
+
+
+def test_locate_maps_offsets_back_to_records():
+    records = [_record(0, "Tiny."), _record(1, "Dear ECB, " * 8)]
+    chunk, = Chunker(max_chars=200, min_chars=10).chunks(records)
+    start = chunk["text"].index("ECB")
+    assert locate(chunk, start, start + 3) == ("a.pdf#sec-0#1", 5, 8)
+    assert locate(chunk, 0, 4) == ("a.pdf#sec-0#0", 0, 4)
+    # on the separator, and a range clipped to its first record
+    assert locate(chunk, 5) is None
+    assert locate(chunk, 2, 12) == ("a.pdf#sec-0#0", 2, 5)
+
+
+def test_merged_chunks_do_not_keep_a_paragraph_label():
+    records = [_record(0, "12 | 34 | 56", quality="numeric"),
+               _record(1, "Prose long enough to stand alone.", quality="ok"),
+               _record(2, "More prose long enough to stand alone.",
+                       quality="ok")]
+    merged, alone = Chunker(max_chars=60, min_chars=20).chunks(records)
+    assert "quality" not in merged
+    assert alone["quality"] == "ok"
+
+    def labeler(text):
+        return "ok" if "Prose" in text else "numeric"
+    merged, alone = Chunker(max_chars=60, min_chars=20,
+                            labeler=labeler).chunks(records)
+    assert merged["quality"] == "ok"
+
+
+def test_min_chars_above_max_chars_is_rejected():
+    with pytest.raises(ValueError):
+        Chunker(max_chars=10, min_chars=20)
@@ -0,0 +1,90 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+from src.features.cooccurrence import CooccurrenceGraph  # noqa: E402
+
+GAZETTEERS = {
+    "ORG": {"ECB": ("ecb", "european central bank")},
+    "TECH": {"DLT": ("dlt", "distributed ledger"), "Corda": ("corda",)},
+}
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    nlp = spacy.blank("en")
+    # stands in for the statistical NER of the full pipeline
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([
+        {"label": "ORG", "pattern": "the Acme Clearing House"},
+        {"label": "ORG", "pattern": "European Central Bank"},
+    ])
+    return nlp
+
+
+def _record(filename, paragraph_id, text, institution="ECB",
+            date="2018/3/1"):
+    return {"filename": filename, "section_id": "sec-0",
+            "paragraph_id": paragraph_id, "text": text,
+            "institution": institution, "date": date}
+
+
+def _graph(nlp):
+    return CooccurrenceGraph(nlp=nlp, gazetteers=GAZETTEERS)
+
+
+def test_mentions_join_gazetteer_and_ner(nlp):
+    graph = _graph(nlp)
+    doc = nlp("The European Central Bank and the Acme Clearing House "
+              "tested DLT.")
+    # the NER span of a gazetteer match keeps the canonical name
+    assert graph.mentions(doc) == {
+        "ORG:ECB", "ORG:Acme Clearing House", "TECH:DLT"}
+
+
+def test_update_delete_and_readd(nlp, tmp_path):
+    records = [
+        _record("a.pdf", 0, "The ECB on DLT."),
+        _record("a.pdf", 1, "Corda and a distributed ledger."),
+        _record("b.pdf", 0, "the Acme Clearing House uses Corda",
+                institution="BIS", date="2019/1/1"),
+    ]
+    graph = _graph(nlp)
+    assert graph.update(records) == ["a.pdf", "b.pdf"]
+    a = graph.documents["a.pdf"]
+    assert a.paragraphs == 2
+    assert a.nodes == {"ORG:ECB": 1, "TECH:DLT": 2, "TECH:Corda": 1}
+    assert a.paragraph_edges[("TECH:Corda", "TECH:DLT")] == 1
+    total = graph.aggregate()
+    assert total.documents == 2
+    assert total.nodes["TECH:Corda"] == 2
+    assert total.publisher_edges[("PUB:BIS", "ORG:Acme Clearing House")] == 1
+
+    # already counted: skipped unless refreshed
+    assert graph.update(records) == []
+    assert graph.update(records[2:], refresh=["b.pdf"]) == ["b.pdf"]
+    assert graph.aggregate().nodes == total.nodes
+
+    path = str(tmp_path / "graph.json")
+    graph.save(path)
+    graph = CooccurrenceGraph.load(path, nlp=nlp, gazetteers=GAZETTEERS)
+    graph.remove_document("b.pdf")
+    assert "ORG:Acme Clearing House" not in graph.aggregate().nodes
+    assert set(graph.slices) == {("ECB", "2018-03-01")}
+    assert graph.update(records) == ["b.pdf"]
+    assert graph.aggregate().nodes == total.nodes
+    assert graph.aggregate(institution="BIS").documents == 1
+
+
+def test_runs_of_a_file_are_counted_together(nlp):
+    records = [
+        _record("a.pdf", 0, "The ECB on DLT."),
+        _record("b.pdf", 0, "Corda."),
+        _record("a.pdf", 1, "Corda and DLT."),
+    ]
+    graph = _graph(nlp)
+    assert graph.update(iter(records)) == ["a.pdf", "b.pdf"]
+    a = graph.documents["a.pdf"]
+    assert a.paragraphs == 2
+    assert a.nodes == {"ORG:ECB": 1, "TECH:DLT": 2, "TECH:Corda": 1}
+    assert graph.aggregate().documents == 2
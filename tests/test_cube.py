@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("spacy")
+
+from src.features.cube import TermCube, build_cube  # noqa: E402
+
+
+def _records():
+    return [
+        {"filename": "joint.pdf", "institution": "Bundesbank, Deutsche Börse",
+         "date": "2017/9/1", "section_id": "sec-0", "paragraph_id": 0,
+         "text": "A DLT prototype for settlement."},
+        {"filename": "ecb.pdf", "institution": "European Central Bank",
+         "date": "2017/9/1", "section_id": "sec-0", "paragraph_id": 0,
+         "text": "The DLT project."},
+        # a second run of the first document
+        {"filename": "joint.pdf", "institution": "Bundesbank, Deutsche Börse",
+         "date": "2017/9/1", "section_id": "sec-1", "paragraph_id": 0,
+         "text": "More on DLT."},
+    ]
+
+
+def test_co_published_document_counts_once_in_totals():
+    cube = build_cube(_records())
+    assert cube.institutions == [
+        "Bundesbank", "Deutsche Börse", "European Central Bank"]
+    # each co-publisher gets the full counts of the joint document
+    assert cube.by_institution("TECH:DLT", "month") == {
+        "Bundesbank": [("2017-09", 2)],
+        "Deutsche Börse": [("2017-09", 2)],
+        "European Central Bank": [("2017-09", 1)],
+    }
+    # over all institutions, the joint document counts once
+    assert cube.time_series("TECH:DLT") == [("2017", 3.0)]
+    assert cube.time_series("TECH:DLT", per_paragraphs=3) == [("2017", 3.0)]
+    # naming both co-publishers counts it once per co-publisher
+    assert cube.time_series(
+        "TECH:DLT", institution=["Bundesbank", "Deutsche Börse"]) == [
+            ("2017", 4.0)]
+
+
+def test_totals_survive_save_and_load(tmp_path):
+    filename = str(tmp_path / "cube.npz")
+    build_cube(_records()).save(filename)
+    cube = TermCube.load(filename)
+    assert cube.time_series("TECH:DLT", granularity="quarter") == [
+        ("2017Q3", 3.0)]
+    with pytest.raises(ValueError):
+        cube.slice(institutions=["Bundesbank"]).save(filename)
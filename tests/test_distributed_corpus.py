@@ -0,0 +1,116 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from src.data.distributed_corpus import (
+    DONE, FAILED, PENDING, WorkQueue, run_worker)
+
+
+def _write_dataset(path):
+    records = []
+    for name, paragraphs in (("a.pdf", 3), ("b.pdf", 1), ("c.pdf", 4)):
+        for i in range(paragraphs):
+            records.append({"filename": name, "section_id": "sec-0",
+                            "paragraph_id": i, "text": "text"})
+    # a second run of a.pdf; its unit must still hold the whole document
+    records.append({"filename": "a.pdf", "section_id": "sec-1",
+                    "paragraph_id": 0, "text": "text"})
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+class _Processor(object):
+    """ Writes the records of a unit as json; the first unit with a
+        document in `flaky` fails after writing, once per run """
+
+    def __init__(self, flaky=()):
+        self.flaky = set(flaky)
+
+    def __call__(self, records, output_filename):
+        with open(output_filename, "w") as f:
+            json.dump(records, f)
+        run_dir = os.path.dirname(os.path.dirname(output_filename))
+        marker = os.path.join(run_dir, "flaked")
+        if set(r["filename"] for r in records) & self.flaky and not (
+                os.path.exists(marker)):
+            open(marker, "w").close()
+            raise RuntimeError("flaky")
+        return len(records)
+
+
+def _worker(run_dir):
+    run_worker(run_dir, processor=_Processor(flaky={"c.pdf"}),
+               lease_seconds=5, poll_seconds=0.05)
+
+
+@pytest.fixture
+def run(tmp_path):
+    dataset = str(tmp_path / "dataset.json")
+    _write_dataset(dataset)
+    run_dir = str(tmp_path / "run")
+    queue = WorkQueue(run_dir)
+    assert queue.create(dataset) == 3
+    yield queue, dataset, run_dir
+    queue.close()
+
+
+def test_units_hold_whole_documents(run):
+    queue, _, _ = run
+    units = [queue.read_unit(json.loads(ranges)) for ranges, in
+             queue.db.execute("SELECT ranges FROM units ORDER BY id")]
+    assert [[r["filename"] for r in unit] for unit in units] == [
+        ["a.pdf"] * 4, ["b.pdf"], ["c.pdf"] * 4]
+
+
+def test_expired_lease_retry_and_merge_across_processes(run):
+    queue, _, run_dir = run
+    # a worker that takes a unit and dies
+    unit_id, _, _ = queue.claim("dead", lease_seconds=0.01)
+    processes = [multiprocessing.Process(target=_worker, args=(run_dir,))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    assert queue.counts() == {DONE: 3}
+    # the dead worker's late result is not accepted
+    assert not queue.complete(unit_id, "dead", "late.acy")
+    attempts = dict(queue.db.execute("SELECT filename, attempts FROM units"))
+    assert attempts["a.pdf"] == 2  # expired lease, claimed again
+    assert attempts["c.pdf"] == 2  # failed once, retried
+    parts = queue.parts()
+    assert [unit for unit, _ in parts] == [1, 2, 3]
+    merged = []
+    for _, output in parts:
+        with open(output) as f:
+            merged.extend(r["filename"] for r in json.load(f))
+    assert merged == ["a.pdf"] * 4 + ["b.pdf"] + ["c.pdf"] * 4
+    assert not [name for name in os.listdir(queue.parts_dir)
+                if name.endswith(".tmp")]
+
+
+def test_units_fail_after_max_attempts(run):
+    queue, _, _ = run
+    for _ in range(2):
+        unit_id, _, _ = queue.claim("w", lease_seconds=60, max_attempts=2)
+        queue.fail(unit_id, "w", "boom", max_attempts=2)
+    states = dict(queue.db.execute("SELECT id, state FROM units"))
+    assert states == {1: FAILED, 2: PENDING, 3: PENDING}
+
+
+def test_changed_dataset_is_refused(run):
+    queue, dataset, run_dir = run
+    assert queue.matches(dataset)
+    with open(dataset, "a") as f:
+        f.write(json.dumps({"filename": "d.pdf", "text": "new"}) + "\n")
+    assert not queue.matches(dataset)
+    with pytest.raises(ValueError):
+        run_worker(run_dir, processor=_Processor())
+    queue.reset()
+    assert queue.counts() == {}
+    assert queue.create(dataset) == 4
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+from src.features.embeddings import EmbeddingStore  # noqa: E402
+
+WORDS = ["ledger", "token", "bond", "cash", "node", "bank", "swap", "fee"]
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    nlp = spacy.blank("en")
+    rng = np.random.RandomState(0)
+    for word in WORDS:
+        nlp.vocab.set_vector(word, rng.normal(size=16).astype(np.float32))
+    return nlp
+
+
+def _records(n=200):
+    rng = np.random.RandomState(1)
+    for i in range(n):
+        # one paragraph in twenty is published by the Bank of England
+        yield {"filename": "doc{}.pdf".format(i % 10), "section_id": "s",
+               "paragraph_id": i, "date": "2018/1/1",
+               "institution": ("Bank of England" if i % 20 == 0
+                               else "European Central Bank"),
+               "text": " ".join(rng.choice(WORDS, 5))}
+
+
+def test_empty_store(tmp_path, nlp):
+    store = EmbeddingStore.build([], tmp_path / "store", nlp)
+    assert len(EmbeddingStore(tmp_path / "store")) == 0
+    assert store.search(np.ones(16), k=3) == []
+    assert np.isnan(store.recall())
+
+
+def test_selective_filter_still_returns_k_hits(tmp_path, nlp):
+    store = EmbeddingStore.build(_records(), tmp_path / "store", nlp,
+                                 n_lists=20)
+    query = store.vectors[1]
+    hits = store.search(query, k=8, nprobe=1, institution="Bank of England")
+    assert len(hits) == 8
+    assert all(store.records[i]["institution"] == ["Bank of England"]
+               for i, _ in hits)
+    assert store.recall(k=8, nprobe=1, institution="Bank of England") > 0.9
+
+
+def test_similar_excludes_the_same_file(tmp_path, nlp):
+    store = EmbeddingStore.build(_records(), tmp_path / "store", nlp,
+                                 n_lists=20)
+    hits = store.similar("doc0.pdf#s#0", k=5, nprobe=1)
+    assert len(hits) == 5
+    assert not any(key.startswith("doc0.pdf#") for key, _ in hits)
@@ -0,0 +1,109 @@
+import json
+import random
+
+import pytest
+import yaml
+from click.testing import CliRunner
+
+pytest.importorskip("pdfminer")
+
+from src.data import extract_pdf, synthetic  # noqa: E402
+from src.data.extract_pdf import (  # noqa: E402
+    count_pages, extract_info, extract_page, extract_page_range)
+
+
+def _pages():
+    return [
+        [(16, "Introduction"), None,
+         (10, "Distributed ledgers record"),
+         (10, "transactions across nodes and"), None],
+        # the paragraph carries on over the page break
+        [(10, "settle them without a central"), (10, "party."), None,
+         (16, "Results"), None,
+         (10, "The prototype works."), None],
+    ]
+
+
+def test_sections_and_paragraphs(tmp_path):
+    path = str(tmp_path / "paper.pdf")
+    synthetic.write_pdf(path, _pages())
+    assert count_pages(path) == 2
+    records = list(extract_info(path, max_workers=0))
+    assert records == [
+        {"section_id": "sec-1", "paragraph_id": 0, "page": 1,
+         "text": "Distributed ledgers record\ntransactions across nodes and\n"
+                 "settle them without a central\nparty."},
+        {"section_id": "sec-2", "paragraph_id": 0, "page": 2,
+         "text": "The prototype works."},
+    ]
+
+
+def test_parallel_extraction_matches_serial(tmp_path):
+    rng = random.Random(1)
+    pages = synthetic.pdf_pages(rng, n_sections=3, n_paragraphs=4)
+    path = str(tmp_path / "paper.pdf")
+    synthetic.write_pdf(path, pages)
+    serial = list(extract_info(path, max_workers=0))
+    assert list(extract_info(path, max_workers=2)) == serial
+    assert sorted(set(r["section_id"] for r in serial)) == [
+        "sec-1", "sec-2", "sec-3"]
+    assert [r["page"] for r in serial] == sorted(r["page"] for r in serial)
+
+
+def test_running_headers_do_not_break_paragraphs(tmp_path):
+    header = (8, "Working Paper Series No 2018")
+    pages = [
+        [header, None, (16, "Introduction"), None,
+         (10, "Distributed ledgers record"),
+         (10, "transactions across nodes and"), None, (8, "1")],
+        [header, None, (10, "settle them without a central"),
+         (10, "party."), None, (10, "The prototype works."), None,
+         (8, "Page 2")],
+    ]
+    path = str(tmp_path / "paper.pdf")
+    synthetic.write_pdf(path, pages)
+    records = list(extract_info(path, max_workers=0))
+    # the header of the first page cannot be told from a paragraph yet
+    assert [r["text"] for r in records] == [
+        "Working Paper Series No 2018",
+        "Distributed ledgers record\ntransactions across nodes and\n"
+        "settle them without a central\nparty.",
+        "The prototype works."]
+    assert [r["section_id"] for r in records] == ["sec-0", "sec-1", "sec-1"]
+
+
+def test_page_ranges_parse_once_per_run(tmp_path):
+    rng = random.Random(2)
+    path = str(tmp_path / "paper.pdf")
+    synthetic.write_pdf(path, synthetic.pdf_pages(rng, 4, 6,
+                                                  lines_per_page=20))
+    n = count_pages(path)
+    assert n > 4
+    assert extract_page_range(path, 1, 4) == [
+        extract_page(path, i) for i in range(1, 4)]
+    assert list(extract_info(path, max_workers=0, pages_per_task=3)) == (
+        list(extract_info(path, max_workers=0, pages_per_task=1)))
+
+
+def test_failed_documents_are_left_out_whole(tmp_path, monkeypatch):
+    external = tmp_path / "external"
+    external.mkdir()
+    for name in ("a.pdf", "b.pdf"):
+        synthetic.write_pdf(str(external / name), [[(10, name)]])
+    docs = tmp_path / "docs.yml"
+    docs.write_text(yaml.safe_dump({"pdfs": [
+        {"filename": "a.pdf", "institution": "ECB"},
+        {"filename": "b.pdf", "institution": "BIS"}]}))
+
+    def extract_info(filename, executor=None):
+        yield {"section_id": "sec-0", "paragraph_id": 0, "text": filename}
+        if filename.endswith("a.pdf"):
+            raise ValueError("broken page")
+    monkeypatch.setattr(extract_pdf, "extract_info", extract_info)
+    output = tmp_path / "dataset" / "dataset.json"
+    result = CliRunner().invoke(extract_pdf.main, [
+        str(external), str(docs), str(output), "--workers", "1"])
+    assert result.exit_code == 0, result.output
+    with open(str(output)) as f:
+        records = [json.loads(line) for line in f]
+    assert [r["text"] for r in records] == [str(external / "b.pdf")]
@@ -0,0 +1,40 @@
+from src.data.normalize import DEFAULT_NORMALIZER, Normalizer, is_normalized
+
+
+def test_joins_words_split_over_a_line_break():
+    assert DEFAULT_NORMALIZER("a distrib-\nuted  ledger") == (
+        "a distributed ledger")
+
+
+def test_keeps_the_hyphen_of_compounds():
+    assert DEFAULT_NORMALIZER("peer-\nto-peer networks") == (
+        "peer-to-peer networks")
+    assert DEFAULT_NORMALIZER("state-of-\nthe-art") == "state-of-the-art"
+    assert DEFAULT_NORMALIZER("a blockchain-\nbased system") == (
+        "a blockchain-based system")
+    # spelled with a hyphen elsewhere in the batch
+    assert DEFAULT_NORMALIZER.batch(
+        ["the e-\nmoney directive", "regulated e-money"]) == [
+        "the e-money directive", "regulated e-money"]
+
+
+def test_urls_and_whitespace():
+    assert DEFAULT_NORMALIZER(
+        "  see https://www.ecb.europa.eu/pub.pdf,\tand www.bis.org. ") == (
+        "see , and .")
+    assert Normalizer(urls=False)("see  www.bis.org") == "see www.bis.org"
+
+
+def test_batch_keeps_texts_apart():
+    texts = ["first ", "", " second\tpart", "ends with-\n", "lower"]
+    assert DEFAULT_NORMALIZER.batch(texts) == [
+        "first", "", "second part", "ends with-", "lower"]
+
+
+def test_records_are_tagged():
+    records = list(Normalizer(urls=False).records(
+        [{"text": "a\nb"}] * 3, batch_size=2))
+    assert [r["text"] for r in records] == ["a b"] * 3
+    assert is_normalized(records[0])
+    assert not is_normalized(records[0], required=("urls",))
+    assert not is_normalized({"text": "a"})
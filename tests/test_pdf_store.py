@@ -0,0 +1,129 @@
+import http.server
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from src.data.pdf_store import IntegrityError, PDFStore
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """ Serves ``server.documents[path]`` with an ETag, answering 304 to a
+        matching If-None-Match """
+
+    def do_GET(self):
+        body = self.server.documents[self.path]
+        etag = '"{}"'.format(hash(body) & 0xffffffff)
+        self.server.requests.append(
+            (self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.documents = {"/a.pdf": b"%PDF-1.4 first", "/b.pdf": b"%PDF-1.4 b"}
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PDFStore(str(tmp_path / "external"),
+                    str(tmp_path / "raw" / "pdf_store"))
+
+
+def test_conditional_refresh(server, store):
+    url = server.url + "/a.pdf"
+    first = store.fetch(url, "a.pdf")
+    assert first.status == "downloaded"
+    path = os.path.join(store.links_dir, "a.pdf")
+    mtime = os.stat(path).st_mtime_ns
+
+    # a new store instance revalidates with the stored ETag
+    again = PDFStore(store.links_dir, store.store_dir).fetch(url, "a.pdf")
+    assert again == first._replace(status="not_modified")
+    assert server.requests[-1][1] is not None
+    assert os.stat(path).st_mtime_ns == mtime
+
+    # without refresh, stored documents are not requested at all
+    n = len(server.requests)
+    cached = PDFStore(store.links_dir, store.store_dir).fetch(
+        url, "a.pdf", refresh=False)
+    assert cached.status == "cached"
+    assert len(server.requests) == n
+
+    server.documents["/a.pdf"] = b"%PDF-1.4 second"
+    changed = PDFStore(store.links_dir, store.store_dir).fetch(url, "a.pdf")
+    assert changed.status == "downloaded"
+    assert changed.sha256 != first.sha256
+    with open(path, "rb") as f:
+        assert f.read() == b"%PDF-1.4 second"
+
+
+def test_same_content_is_stored_once(server, store):
+    server.documents["/copy.pdf"] = server.documents["/a.pdf"]
+    a = store.fetch(server.url + "/a.pdf", "a.pdf")
+    copy = store.fetch(server.url + "/copy.pdf", "copy.pdf")
+    assert a.sha256 == copy.sha256
+    assert os.path.samefile(store.blob_path(a.sha256),
+                            os.path.join(store.links_dir, "copy.pdf"))
+
+
+def test_check_and_repair(server, store):
+    fetched = store.fetch(server.url + "/a.pdf", "a.pdf")
+    path = os.path.join(store.links_dir, "a.pdf")
+    store.check(path)
+    # corrupts the blob through its hard link
+    with open(path, "r+b") as f:
+        f.write(b"XXXX")
+    with pytest.raises(IntegrityError):
+        store.check(path)
+
+    assert store.verify(repair=True) == [fetched.sha256]
+    assert not os.path.exists(path)
+    assert not os.path.exists(store.blob_path(fetched.sha256))
+    assert "a.pdf" not in store.index["files"]
+    assert store.fetch(server.url + "/a.pdf", "a.pdf").status == "downloaded"
+    store.check(path)
+
+
+def _fetch_all(links_dir, store_dir, base_url, names):
+    store = PDFStore(links_dir, store_dir)
+    for name in names:
+        store.fetch(base_url + "/" + name, name)
+
+
+def test_concurrent_processes_keep_every_entry(server, store):
+    names = ["doc{}.pdf".format(i) for i in range(24)]
+    for i, name in enumerate(names):
+        server.documents["/" + name] = "%PDF-1.4 {}".format(i).encode()
+    processes = [
+        multiprocessing.Process(target=_fetch_all, args=(
+            store.links_dir, store.store_dir, server.url, names[i::4]))
+        for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    index = store.index
+    assert sorted(index["files"]) == sorted(names)
+    assert len(index["urls"]) == len(names)
@@ -0,0 +1,109 @@
+import json
+import os
+
+import pytest
+
+from src import pipeline
+from src.pipeline import Stage, StageRunner
+
+CALLS = []
+
+
+def _copy(source, target):
+    CALLS.append(target)
+    with open(source) as f, open(target, "w") as out:
+        out.write(f.read())
+
+
+def _fail(source, target):
+    CALLS.append(target)
+    raise RuntimeError("broken")
+
+
+def _copy_and_edit(source, target):
+    # the input changes while the stage runs
+    _copy(source, target)
+    with open(source, "a") as f:
+        f.write(" and more")
+
+
+@pytest.fixture
+def files(tmp_path):
+    del CALLS[:]
+    source = tmp_path / "source.txt"
+    source.write_text("text")
+    return dict((name, str(tmp_path / name))
+                for name in ("source.txt", "a.txt", "b.txt", "cache.json"))
+
+
+def _stages(files, first=_copy):
+    return [
+        Stage("a", first, args=(files["source.txt"], files["a.txt"]),
+              inputs=[files["source.txt"]], outputs=[files["a.txt"]]),
+        Stage("b", _copy, args=(files["a.txt"], files["b.txt"]),
+              inputs=[files["a.txt"]], outputs=[files["b.txt"]],
+              after=["a"]),
+    ]
+
+
+def _run(files, first=_copy, force=False, targets=None):
+    runner = StageRunner(_stages(files, first), files["cache.json"],
+                         workers=2, force=force)
+    return dict(runner.run(targets))
+
+
+def test_up_to_date_stages_are_skipped(files):
+    assert _run(files) == {"a": "ran", "b": "ran"}
+    assert _run(files) == {"a": "cached", "b": "cached"}
+    assert len(CALLS) == 2
+    runner = StageRunner(_stages(files), files["cache.json"])
+    assert runner.status() == {"a": True, "b": True}
+
+
+def test_changed_inputs_and_missing_outputs_rerun(files):
+    _run(files)
+    with open(files["source.txt"], "w") as f:
+        f.write("other text")
+    assert _run(files) == {"a": "ran", "b": "ran"}
+    with open(files["b.txt"]) as f:
+        assert f.read() == "other text"
+
+    del CALLS[:]
+    os.remove(files["b.txt"])
+    assert _run(files) == {"a": "cached", "b": "ran"}
+    assert CALLS == [files["b.txt"]]
+
+
+def test_force_reruns_everything(files):
+    _run(files)
+    assert _run(files, force=True) == {"a": "ran", "b": "ran"}
+    assert _run(files, targets=["b"]) == {"a": "cached", "b": "cached"}
+
+
+def test_failures_block_downstream_and_are_retried(files):
+    assert _run(files, first=_fail) == {"a": "failed", "b": "blocked"}
+    with open(files["cache.json"]) as f:
+        assert json.load(f)["stages"] == {}
+    assert _run(files) == {"a": "ran", "b": "ran"}
+
+
+def test_inputs_changed_during_a_run_leave_the_stage_stale(files):
+    assert _run(files, first=_copy_and_edit)["a"] == "ran"
+    runner = StageRunner(_stages(files), files["cache.json"])
+    assert runner.status(["a"]) == {"a": False}
+    assert _run(files)["a"] == "ran"
+    with open(files["a.txt"]) as f:
+        assert f.read() == "text and more"
+
+
+def test_digests_stage_writes_per_document_digests(tmp_path):
+    dataset = str(tmp_path / "dataset.json")
+    with open(dataset, "w") as f:
+        for name, text in (("a.pdf", "x"), ("a.pdf", "y"), ("b.pdf", "z")):
+            f.write(json.dumps({"filename": name, "text": text}) + "\n")
+    digests = pipeline.digests_path(dataset)
+    assert digests == str(tmp_path / "dataset.digests.json")
+    pipeline.build_digests(dataset, digests)
+    assert pipeline.load_digests(digests) == pipeline.document_digests(
+        dataset)
+    assert sorted(pipeline.load_digests(digests)) == ["a.pdf", "b.pdf"]
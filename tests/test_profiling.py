@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from src import profiling
+from src.profiling import Tracer
+
+
+@pytest.fixture
+def rss_reads(monkeypatch):
+    calls = []
+
+    def current_rss_kb():
+        calls.append(1)
+        return 1024 * len(calls)
+    monkeypatch.setattr(profiling, "current_rss_kb", current_rss_kb)
+    return calls
+
+
+def test_spans_and_iterations_sample_memory_at_boundaries(rss_reads):
+    tracer = Tracer(enabled=True)
+    with tracer.stage("parse") as span:
+        span.count(3)
+    assert len(rss_reads) == 2
+    assert list(tracer.iterate("read", range(100))) == list(range(100))
+    assert len(rss_reads) == 4
+    for _ in range(10):
+        with tracer.stage("per_paragraph", event=False):
+            pass
+    assert len(rss_reads) == 4
+
+    stats = tracer.stats
+    assert (stats["parse"].calls, stats["parse"].items) == (1, 3)
+    assert stats["parse"].rss_delta_kb == 1024
+    assert (stats["read"].calls, stats["read"].items) == (100, 100)
+    assert stats["read"].rss_delta_kb == 1024
+    assert stats["per_paragraph"].calls == 10
+    assert stats["per_paragraph"].rss_delta_kb == 0
+    assert [e["name"] for e in tracer.events] == ["parse"]
+
+
+def test_abandoned_iteration_still_records_memory(rss_reads):
+    tracer = Tracer(enabled=True)
+    iterator = tracer.iterate("read", range(10))
+    next(iterator)
+    iterator.close()
+    assert len(rss_reads) == 2
+    assert tracer.stats["read"].items == 1
+
+
+def test_disabled_tracer_records_nothing(rss_reads):
+    tracer = Tracer()
+    with tracer.stage("parse"):
+        pass
+    assert list(tracer.iterate("read", range(3))) == [0, 1, 2]
+    assert not tracer.stats and not rss_reads
+
+
+def test_instrumented_spacy_components_are_timed():
+    spacy = pytest.importorskip("spacy")
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": "ORG", "pattern": "ECB"}])
+    tracer = Tracer(enabled=True)
+    tracer.instrument(nlp)
+    tracer.instrument(nlp)  # components are wrapped once
+    assert nlp.pipe_names == ["sentencizer", "entity_ruler"]
+    assert isinstance(nlp.get_pipe("entity_ruler"),
+                      profiling._TimedComponent)
+
+    docs = list(nlp.pipe(["The ECB said so. Twice."] * 5, batch_size=2))
+    assert [e.text for e in docs[0].ents] == ["ECB"]
+    assert len(list(docs[0].sents)) == 2
+    nlp("The ECB.")
+    for name in ("spacy/sentencizer", "spacy/entity_ruler"):
+        assert tracer.stats[name].items == 6
+
+
+def test_enable_registers_the_exit_hook_once(monkeypatch, tmp_path):
+    hooks = []
+    monkeypatch.setattr(profiling.atexit, "register", hooks.append)
+    monkeypatch.setattr(profiling, "_trace_filename", None)
+    monkeypatch.setattr(profiling, "_tracer", Tracer())
+    first = str(tmp_path / "first.json")
+    last = str(tmp_path / "last.json")
+    profiling.enable(first)
+    profiling.enable()
+    profiling.enable(last)
+    assert hooks == [profiling._finish]
+
+    with profiling.get_tracer().stage("parse"):
+        pass
+    hooks[0]()
+    with open(last) as f:
+        assert "parse" in json.load(f)["stages"]
@@ -0,0 +1,86 @@
+import click
+import pytest
+
+from src.data.quality import (
+    DEFAULT_THRESHOLDS, OK, QualityFilter, features, parse_thresholds,
+    threshold_option)
+
+PROSE = ("The central bank has been testing a distributed ledger for the "
+         "settlement of payments between the banks of the euro area.")
+PROSE_WITH_YEARS = ("Pilots ran in 2016, 2017, 2018 and 2019 before the "
+                    "central bank decided that the ledger was ready for the "
+                    "settlement of payments.")
+REFERENCES = ("Nakamoto, S. (2008). Bitcoin: A peer-to-peer electronic cash "
+              "system. Smith et al. (2017), pp. 12-19 [3], [4, 7].")
+
+
+def _record(filename, text):
+    return {"filename": filename, "text": text}
+
+
+@pytest.mark.parametrize("text, label", [
+    (PROSE, OK),
+    (PROSE_WITH_YEARS, OK),
+    (REFERENCES, "references"),
+    ("Too short.", "short"),
+    ("12.5 | 13.7 | 99.1 | 42.0 | 17.3 | 88.8 | 10.1 | 76.4 | 55.5", "numeric"),
+    ("Die Zentralbank hat ein verteiltes Kassenbuch für die Abwicklung "
+     "von Zahlungen getestet.", "non_english"),
+])
+def test_labels(text, label):
+    assert QualityFilter().label(text) == label
+
+
+def test_years_alone_are_no_citations():
+    assert features(PROSE_WITH_YEARS)["reference_density"] == 0
+    assert features(REFERENCES)["reference_density"] > DEFAULT_THRESHOLDS[
+        "max_reference_density"]
+
+
+def test_repeated_short_paragraphs_are_headers():
+    header = "European Central Bank Working Paper Series No 12 / Page 3"
+    records = [_record("a.pdf", header.replace("3", str(n)))
+               for n in range(3)] + [_record("a.pdf", PROSE)]
+    labels = [r["quality"] for r in QualityFilter().records(records)]
+    assert labels == ["header"] * 3 + [OK]
+
+
+def test_drop_keeps_only_ok_and_reports_every_document():
+    records = [_record("a.pdf", PROSE), _record("a.pdf", "Too short."),
+               _record("b.pdf", REFERENCES), _record("b.pdf", PROSE)]
+    kept = list(QualityFilter().records(iter(records)))
+    assert [r["quality"] for r in kept] == [OK, "short", "references", OK]
+
+    prefilter = QualityFilter(drop=True)
+    kept = list(prefilter.records(iter(records)))
+    assert [r["text"] for r in kept] == [PROSE, PROSE]
+    assert list(prefilter.report) == ["a.pdf", "b.pdf"]
+    assert prefilter.report["b.pdf"]["junk_paragraphs"] == 1
+    assert prefilter.report["b.pdf"]["junk_chars"] == len(REFERENCES)
+
+
+def test_records_are_streamed_document_by_document():
+    seen = []
+
+    def records():
+        for name in ("a.pdf", "b.pdf", "c.pdf"):
+            seen.append(name)
+            yield _record(name, PROSE)
+    stream = QualityFilter().records(records())
+    assert next(stream)["filename"] == "a.pdf"
+    # only the record ending the first run has been read
+    assert seen == ["a.pdf", "b.pdf"]
+
+
+def test_thresholds():
+    assert parse_thresholds(["min_chars=5", "max_digit_ratio=0.5"]) == {
+        "min_chars": 5, "max_digit_ratio": 0.5}
+    assert QualityFilter(min_chars=5).label("Short text is fine.") == OK
+    with pytest.raises(ValueError, match="unknown threshold"):
+        parse_thresholds(["max_words=3"])
+    with pytest.raises(ValueError, match="must be an int"):
+        parse_thresholds(["min_chars=a lot"])
+    with pytest.raises(ValueError):
+        QualityFilter(max_words=3)
+    with pytest.raises(click.BadParameter):
+        threshold_option(None, None, ["max_words=3"])
@@ -0,0 +1,103 @@
+import json
+
+from src.features.search_index import SearchIndex
+
+
+def _write(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return str(path)
+
+
+def _record(filename, paragraph_id, text, institution="Bank of England"):
+    return {"filename": filename, "section_id": "sec-0",
+            "paragraph_id": paragraph_id, "text": text,
+            "institution": institution, "date": "2018/3/13"}
+
+
+def test_build_and_search(tmp_path):
+    dataset = _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement of tokens"),
+        _record("b.pdf", 0, "distributed ledger governance",
+                institution="Bundesbank, Deutsche Börse"),
+    ])
+    with SearchIndex.build(dataset, tmp_path / "index") as index:
+        hits = index.search("settlement")
+        assert [h.key for h in hits] == ["a.pdf#sec-0#0"]
+        assert hits[0].text == "atomic settlement of tokens"
+        assert not index.search("ledger", institution="Bank of England")
+        assert index.search("ledger", institution="Deutsche Börse")
+
+
+def test_update_replaces_refreshed_filenames(tmp_path):
+    dataset = _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement"),
+    ])
+    path = tmp_path / "index"
+    SearchIndex.build(dataset, path).close()
+    _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "delivery versus payment"),
+        _record("b.pdf", 0, "wholesale settlement"),
+    ])
+    with SearchIndex(path) as index:
+        assert index.update(dataset) == 1
+        assert index.filenames == {"a.pdf", "b.pdf"}
+        # a.pdf was already indexed, so its old text is still searched
+        assert set(h.filename for h in index.search("settlement")) == {
+            "a.pdf", "b.pdf"}
+        assert index.update(dataset, refresh=["a.pdf"]) == 1
+        assert len(index) == 2
+        assert [h.filename for h in index.search("settlement")] == ["b.pdf"]
+        assert [h.filename for h in index.search("delivery")] == ["a.pdf"]
+
+
+def test_delete_and_compact(tmp_path):
+    dataset = _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement"),
+        _record("b.pdf", 0, "wholesale settlement"),
+    ])
+    path = tmp_path / "index"
+    with SearchIndex.build(dataset, path) as index:
+        index.delete_filenames(["a.pdf"])
+        index.compact()
+        assert len(index.manifest["segments"]) == 1
+    with SearchIndex(path) as index:
+        assert [h.filename for h in index.search("settlement")] == ["b.pdf"]
+        assert index.search("wholesale")[0].text == "wholesale settlement"
+
+
+def test_compact_after_deleting_everything(tmp_path):
+    dataset = _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement"),
+    ])
+    path = tmp_path / "index"
+    with SearchIndex.build(dataset, path) as index:
+        index.delete_filenames(["a.pdf"])
+        index.compact()
+    with SearchIndex(path) as index:
+        assert index.manifest["segments"] == []
+        assert len(index) == 0
+        assert index.search("settlement") == []
+
+
+def test_update_after_a_crashed_write(tmp_path):
+    dataset = _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement"),
+    ])
+    path = tmp_path / "index"
+    SearchIndex.build(dataset, path).close()
+    # leftovers of a crash mid-write and of one before the manifest save
+    (path / "seg-000002.tmp").mkdir()
+    (path / "seg-000002.tmp" / "docs.jsonl").write_text("partial")
+    (path / "seg-000002").mkdir()
+    _write(tmp_path / "dataset.json", [
+        _record("a.pdf", 0, "atomic settlement"),
+        _record("b.pdf", 0, "wholesale settlement"),
+    ])
+    with SearchIndex(path) as index:
+        assert index.update(dataset) == 1
+    with SearchIndex(path) as index:
+        assert index.manifest["segments"] == ["seg-000001", "seg-000002"]
+        assert len(index.search("settlement")) == 2
+    assert not (path / "seg-000002.tmp").exists()
@@ -0,0 +1,67 @@
+import collections
+import random
+
+import numpy as np
+import pytest
+
+from src.features.sketches import CountMinSketch, HeavyHitters
+
+
+def _stream(n=20000, vocabulary=2000, seed=0):
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary)]
+    items = ["w{}".format(i) for i in range(vocabulary)]
+    return rng.choices(items, weights, k=n)
+
+
+def _shards(stream, n):
+    return [collections.Counter(stream[i::n]) for i in range(n)]
+
+
+def test_merged_count_min_keeps_the_error_bound():
+    stream = _stream()
+    truth = collections.Counter(stream)
+    merged = CountMinSketch(width=512, depth=4)
+    for shard in _shards(stream, 3):
+        sketch = CountMinSketch(width=512, depth=4)
+        items = list(shard)
+        sketch.add(items, [shard[i] for i in items])
+        merged.merge(sketch)
+
+    whole = CountMinSketch(width=512, depth=4)
+    items = list(truth)
+    whole.add(items, [truth[i] for i in items])
+    assert merged.total == whole.total == len(stream)
+    assert np.array_equal(merged.table, whole.table)
+
+    estimates = merged.estimate(items)
+    true = np.array([truth[i] for i in items])
+    assert (estimates >= true).all()
+    # overcounts beyond the bound happen with probability at most delta
+    over = (estimates > true + merged.error).mean()
+    assert over <= merged.delta
+
+
+def test_merged_heavy_hitters_contain_the_frequent_items():
+    stream = _stream()
+    truth = collections.Counter(stream)
+    merged = None
+    for shard in _shards(stream, 4):
+        hitters = HeavyHitters(k=50, width=1024, depth=4)
+        hitters.update(shard)
+        merged = hitters if merged is None else merged.merge(hitters)
+    assert len(merged.top) == 50
+    threshold = merged.total / merged.k + merged.error
+    frequent = set(i for i, n in truth.items() if n > threshold)
+    assert frequent
+    assert frequent <= set(merged.top)
+    for item, estimate in merged.most_common(10):
+        assert truth[item] <= estimate <= truth[item] + merged.error
+
+
+def test_incompatible_sketches_do_not_merge():
+    with pytest.raises(ValueError):
+        CountMinSketch(width=512, seed=0).merge(CountMinSketch(width=512,
+                                                               seed=1))
+    with pytest.raises(ValueError):
+        CountMinSketch(width=512).merge(CountMinSketch(width=256))
@@ -0,0 +1,113 @@
+import json
+import threading
+
+import pytest
+
+from src.data import stream_dataset
+from src.data.normalize import Normalizer
+from src.data.stream_dataset import StreamingPipeline
+
+
+WORDS = ("Alpha", "Beta", "Gamma", "Delta")
+
+
+def _count_pages(pdf):
+    with open(pdf) as f:
+        return int(f.read().split()[0])
+
+
+def _extract_page(pdf, number):
+    """ Stands in for the pdfminer layout of page `number` of `pdf` """
+    with open(pdf) as f:
+        fail = "fail" in f.read()
+    if fail and number == 1:
+        raise ValueError("unreadable page")
+    name = pdf.rsplit("/", 1)[-1]
+    # running headers repeat over pages, so every page says something else
+    return [("{} of {}.".format(WORDS[number], name), False)]
+
+
+class _FailingNormalizer(Normalizer):
+
+    def records(self, records):
+        for record in super(_FailingNormalizer, self).records(records):
+            if "c.pdf" in record["text"]:
+                raise RuntimeError("assembler broke")
+            yield record
+
+
+@pytest.fixture
+def external(tmp_path, monkeypatch):
+    monkeypatch.setattr(stream_dataset, "count_pages", _count_pages)
+    monkeypatch.setattr(stream_dataset, "extract_page", _extract_page)
+    external = tmp_path / "external"
+    external.mkdir()
+    return external
+
+
+def _entries(external, documents):
+    entries = []
+    for name, content in documents:
+        (external / name).write_text(content)
+        entries.append({"filename": name, "url": "http://example.org/" + name,
+                        "institution": "ECB"})
+    return entries
+
+
+def _run(pipeline, output):
+    """ Run `pipeline`, failing instead of hanging """
+    result = {}
+
+    def target():
+        try:
+            result["stats"] = pipeline.run(output)
+        except Exception as e:
+            result["error"] = e
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "the pipeline hangs"
+    return result
+
+
+def _read(output):
+    with open(output) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_documents_stay_contiguous_and_in_order(external, tmp_path):
+    entries = _entries(external, [("a.pdf", "3"), ("b.pdf", "2"),
+                                  ("c.pdf", "4")])
+    output = str(tmp_path / "dataset.json")
+    stats = _run(StreamingPipeline(entries, str(external), download_workers=1,
+                                   extract_workers=2, queue_size=1,
+                                   max_pending_pages=2), output)["stats"]
+    assert (stats["documents"], stats["pages"], stats["records"]) == (3, 9, 9)
+    records = _read(output)
+    assert [r["filename"] for r in records] == ["a.pdf"] * 3 + [
+        "b.pdf"] * 2 + ["c.pdf"] * 4
+    assert [r["text"] for r in records[:3]] == [
+        "{} of a.pdf.".format(w) for w in WORDS[:3]]
+
+
+def test_a_failing_document_is_left_out(external, tmp_path):
+    entries = _entries(external, [("a.pdf", "2"), ("b.pdf", "3 fail"),
+                                  ("c.pdf", "2")])
+    output = str(tmp_path / "dataset.json")
+    stats = _run(StreamingPipeline(entries, str(external), download_workers=1,
+                                   extract_workers=2), output)["stats"]
+    assert (stats["documents"], stats["failed"]) == (2, 1)
+    assert [r["filename"] for r in _read(output)] == ["a.pdf"] * 2 + [
+        "c.pdf"] * 2
+
+
+def test_a_failing_assembler_stops_the_run(external, tmp_path):
+    entries = _entries(external, [
+        ("{}.pdf".format(name), "3") for name in "abcdefghij"])
+    pipeline = StreamingPipeline(
+        entries, str(external), download_workers=1, extract_workers=1,
+        queue_size=1, max_pending_pages=1, normalizer=_FailingNormalizer())
+    result = _run(pipeline, str(tmp_path / "dataset.json"))
+    assert str(result["error"]) == "assembler broke"
+    assert pipeline.stats["documents"] == 2
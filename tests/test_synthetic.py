@@ -0,0 +1,69 @@
+import filecmp
+import json
+
+from src.data import synthetic
+from src.data.catalog import Catalog
+from src.data.make_dataset import extract_info
+from src.data.normalize import DEFAULT_NORMALIZER, is_normalized
+from src.data.records import read_dataset
+
+DOCUMENTS = [
+    {"filename": "ecb.pdf", "institution": "European Central Bank",
+     "date": "2017/9/1"},
+    {"filename": "bis.pdf", "institution": "BIS", "date": "2019/1/1"},
+]
+
+
+def test_same_seed_same_bytes(tmp_path):
+    for run in ("a", "b"):
+        synthetic.write_dataset(str(tmp_path / run / "dataset.json"),
+                                seed=3, documents=DOCUMENTS)
+        synthetic.write_cermxml(str(tmp_path / run / "cermxml"),
+                                seed=3, documents=DOCUMENTS)
+    assert filecmp.cmp(str(tmp_path / "a" / "dataset.json"),
+                       str(tmp_path / "b" / "dataset.json"), shallow=False)
+    names = ["ecb.cermxml", "bis.cermxml", "ecb-2.cermxml", "bis-3.cermxml"]
+    match, mismatch, errors = filecmp.cmpfiles(
+        str(tmp_path / "a" / "cermxml"), str(tmp_path / "b" / "cermxml"),
+        names, shallow=False)
+    assert (mismatch, errors) == ([], [])
+
+    synthetic.write_dataset(str(tmp_path / "other.json"), seed=4,
+                            documents=DOCUMENTS)
+    assert not filecmp.cmp(str(tmp_path / "a" / "dataset.json"),
+                           str(tmp_path / "other.json"), shallow=False)
+
+
+def test_dataset_records_refer_to_the_catalog(tmp_path):
+    path = str(tmp_path / "dataset.json")
+    n = synthetic.write_dataset(path, documents=DOCUMENTS)
+    with open(path) as f:
+        stored = [json.loads(line) for line in f]
+    assert len(stored) == n
+    # as make_dataset writes them: no metadata besides the doc_id
+    assert set(stored[0]) == {"doc_id", "section_id", "paragraph_id",
+                              "text", "normalization"}
+    assert all(is_normalized(r) for r in stored)
+
+    records = list(read_dataset(path))
+    n_documents, n_sections, _ = synthetic.SIZES["small"]
+    assert len(set(r["filename"] for r in records)) == n_documents
+    assert set(r["section_id"] for r in records) == set(
+        "sec-{}".format(s) for s in range(n_sections))
+    assert all(r["institution"] and r["text"] for r in records)
+    catalog = Catalog.for_dataset(path)
+    assert catalog.select(institution={"BIS"}) == set(
+        catalog.doc_id(name) for name in ("bis.pdf", "bis-3.pdf"))
+
+
+def test_cermxml_is_read_by_make_dataset(tmp_path):
+    path = synthetic.write_cermxml(str(tmp_path), documents=DOCUMENTS)[0]
+    paragraphs = list(extract_info(path))
+    _, n_sections, n_paragraphs = synthetic.SIZES["small"]
+    sections = set(p["section_id"] for p in paragraphs)
+    assert len(sections) == n_sections
+    assert len(paragraphs) <= n_sections * n_paragraphs
+    # words hyphenated over line breaks are joined again by normalization
+    assert any("-\n" in p["text"] for p in paragraphs)
+    records = list(DEFAULT_NORMALIZER.records(paragraphs))
+    assert not any("\n" in r["text"] for r in records)